@@ -0,0 +1,91 @@
+'''
+Benchmark de validación de /upload_geometries.
+
+Compara el camino anterior (json.loads + LayerUploadRequest con FeatureModel,
+lo que hacía FastAPI con el parámetro de cuerpo) con el TypeAdapter de
+routes/utils/geojson.py validando directamente los bytes JSON.
+
+    python -m benchmarks.upload_validation [n_features] [vertices_por_poligono]
+'''
+
+import json
+import math
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+from pydantic import BaseModel
+
+from routes.utils.geojson import upload_adapter
+
+
+class FeatureModel(BaseModel):
+    geometry: Dict[str, Any]
+    properties: Dict[str, Any]
+
+
+class LayerUploadRequest(BaseModel):
+    layer_name: str
+    project_id: Optional[int] = None
+    features: List[FeatureModel]
+    dedupe_tolerance_m: Optional[float] = None
+
+
+def make_body(n_features: int, vertices: int) -> bytes:
+    features = []
+    for i in range(n_features):
+        cx, cy = -3.7 + (i % 1000) * 0.001, 40.4 + (i // 1000) * 0.001
+        ring = [
+            [cx + 0.0004 * math.cos(2 * math.pi * k / vertices), cy + 0.0004 * math.sin(2 * math.pi * k / vertices)]
+            for k in range(vertices)
+        ]
+        ring.append(ring[0])
+        features.append(
+            {
+                "geometry": {"type": "Polygon", "coordinates": [ring]},
+                "properties": {"id": None, "name": f"parcela {i}", "area": 12.5},
+            }
+        )
+    return json.dumps({"layer_name": "bench", "project_id": 1, "features": features}).encode()
+
+
+def bench(label: str, func, body: bytes, n_features: int, repeat: int = 3) -> float:
+    best = math.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(body)
+        best = min(best, time.perf_counter() - start)
+    rate = n_features / best
+    print(f"{label:<50} {best * 1000:9.1f} ms  {rate:12,.0f} features/s")
+    return rate
+
+
+def main():
+    n_features = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    vertices = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    body = make_body(n_features, vertices)
+    print(f"{n_features} polígonos de {vertices + 1} vértices, {len(body) / 1e6:.1f} MB\n")
+
+    before = bench(
+        "antes: json.loads + LayerUploadRequest",
+        lambda b: LayerUploadRequest.model_validate(json.loads(b)),
+        body,
+        n_features,
+    )
+    bench(
+        "antes + model_dump_json() del print del handler",
+        lambda b: LayerUploadRequest.model_validate(json.loads(b)).model_dump_json(),
+        body,
+        n_features,
+    )
+    after = bench(
+        "después: upload_adapter.validate_json",
+        upload_adapter.validate_json,
+        body,
+        n_features,
+    )
+    print(f"\nspeed-up: x{after / before:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -26,8 +26,125 @@ from qgis.core import (
     QgsRasterLayer,
     QgsWkbTypes,
 )
+import gzip
+import hashlib
 import json
-
+import math
+import uuid
+
+try:
+    import msgpack  # opcional: si está instalado se suben geometrías WKB en msgpack
+except ImportError:
+    msgpack = None
+
+
+# Número de features por chunk al subir capas grandes
+UPLOAD_CHUNK_SIZE = 2000
+UPLOAD_CHUNK_RETRIES = 3
+
+# Debe coincidir con routes/utils/geometry.py::HASH_PRECISION del servidor
+HASH_PRECISION = 9
+
+
+def geometry_hash(geometry):
+    """
+    Hash canónico de una geometría GeoJSON; copia de
+    routes/utils/geometry.py::geometry_hash (servidor). Mantener ambas iguales.
+    """
+
+    def normalize(value):
+        if isinstance(value, (list, tuple)):
+            return [normalize(v) for v in value]
+        return float(round(value, HASH_PRECISION))
+
+    if geometry.get("type") == "GeometryCollection":
+        canonical = [geometry_hash(g) for g in geometry.get("geometries") or []]
+    else:
+        canonical = normalize(geometry.get("coordinates") or [])
+    raw = json.dumps([geometry.get("type"), canonical], separators=(",", ":"))
+    return hashlib.sha1(raw.encode()).hexdigest()[:16]
+
+
+def clave_idempotencia():
+    """
+    Idempotency-Key de un envío: una clave nueva cada vez que se pulsa "Enviar
+    cambios", reutilizada en todos los reintentos de ese envío (timeout, 401 y
+    refresco del token), para que el servidor no lo procese dos veces. Un envío
+    posterior con el mismo contenido lleva otra clave y sí se procesa.
+    """
+    return uuid.uuid4().hex
+
+
+def imprimir_server_timing(response):
+    """
+    Muestra el desglose de la latencia en el servidor (cabecera Server-Timing:
+    auth.verify, rpc.<nombre>, serialize...) en la consola de Python de QGIS.
+    """
+    timing = response.headers.get("Server-Timing")
+    if timing:
+        request = response.request
+        print(f"{request.method} {request.url} [{response.status_code}]: {timing}")
+
+
+def topojson_a_features(topology, object_name="features"):
+    """
+    Decodifica la respuesta TopoJSON de get_layer (format="topojson") a la misma
+    lista de features que devuelve el formato GeoJSON: {id, geometry, ...propiedades}.
+    Inversa de routes/utils/topojson.py::to_topology (servidor).
+    """
+    transform = topology.get("transform") or {"scale": [1, 1], "translate": [0, 0]}
+    (sx, sy), (tx, ty) = transform["scale"], transform["translate"]
+    # Se redondea a la rejilla para recuperar exactamente las coordenadas cuantizadas
+    digits = max(0, int(round(-math.log10(min(sx, sy))))) if sx and sy else 0
+
+    def position(x, y):
+        return [round(tx + x * sx, digits), round(ty + y * sy, digits)]
+
+    arcs = []
+    for arc in topology.get("arcs", []):
+        x = y = 0
+        points = []
+        for dx, dy in arc:
+            x += dx
+            y += dy
+            points.append(position(x, y))
+        arcs.append(points)
+
+    def line(refs):
+        points = []
+        for ref in refs:
+            arc = arcs[ref] if ref >= 0 else arcs[~ref][::-1]
+            # El primer punto de cada arco repite el último del anterior
+            points.extend(arc[1:] if points else arc)
+        return points
+
+    def geometry(obj):
+        geom_type = obj.get("type")
+        if geom_type is None:
+            return None
+        if geom_type == "Point":
+            coords = obj.get("coordinates")
+            return {"type": geom_type, "coordinates": position(*coords) if coords else []}
+        if geom_type == "MultiPoint":
+            return {"type": geom_type, "coordinates": [position(*p) for p in obj["coordinates"]]}
+        if geom_type == "LineString":
+            return {"type": geom_type, "coordinates": line(obj["arcs"])}
+        if geom_type in ("MultiLineString", "Polygon"):
+            return {"type": geom_type, "coordinates": [line(r) for r in obj["arcs"]]}
+        if geom_type == "MultiPolygon":
+            return {
+                "type": geom_type,
+                "coordinates": [[line(r) for r in polygon] for polygon in obj["arcs"]],
+            }
+        if geom_type == "GeometryCollection":
+            return {"type": geom_type, "geometries": [geometry(g) for g in obj["geometries"]]}
+        raise ValueError(f"Tipo de geometría no soportado: {geom_type}")
+
+    collection = topology.get("objects", {}).get(object_name) or {}
+    return [
+        {"id": obj.get("id"), "geometry": geometry(obj), **(obj.get("properties") or {})}
+        for obj in collection.get("geometries", [])
+    ]
 
 class ConfirmDialog(QDialog):
     def __init__(self, message, parent=None):
@@ -135,6 +252,7 @@ class QgisSupabaseSyncPlugin:
     def __init__(self, iface):
         self.iface = iface
         self.capas_api = []
+        self.snapshots = {}  # layer_id -> {id: (version, geometría JSON)}
         self.layer = None  # <<< IMPORTANTE
         self.access_token = None
         self.refresh_token = None
@@ -171,6 +289,25 @@ class QgisSupabaseSyncPlugin:
         dialog = ConfirmDialog(message, self.iface.mainWindow())
         return dialog.exec_() == QDialog.Accepted
 
+    def actualizar_proyectos(self):
+        """
+        Recarga la lista de proyectos del usuario sin volver a iniciar sesión;
+        si falla se mantiene la lista que se tenía.
+        """
+        cookies = {"access_token": self.access_token}
+        if self.refresh_token:
+            cookies["refresh_token"] = self.refresh_token
+        try:
+            response = self.request_con_refresh(
+                "GET",
+                "http://127.0.0.1:8000/api/auth/projects",
+                cookies,
+                params={"refresh": "true"},
+            )
+            self.projects = response.json().get("projects", [])
+        except requests.exceptions.RequestException as e:
+            print(f"No se pudo actualizar la lista de proyectos: {e}")
+
     def mostrar_selector_proyectos(self):
         from qgis.PyQt.QtWidgets import QComboBox
 
@@ -178,6 +315,7 @@ class QgisSupabaseSyncPlugin:
             QMessageBox.warning(None, "Error", "Debes iniciar sesión primero")
             return
 
+        self.actualizar_proyectos()
         if not self.projects:
             QMessageBox.information(
                 None, "Info", "No hay proyectos disponibles para este usuario"
@@ -309,20 +447,30 @@ class QgisSupabaseSyncPlugin:
             return value
         return str(value)  # para cualquier tipo complejo, convertir a string
 
-    def serialize_feature(self, feature):
+    def serialize_feature(self, feature, binary=False):
         """
         Serializa una feature de QGIS a dict JSON.
+        Con binary=True la geometría va como WKB (clave "wkb") para msgpack.
         PRESERVA el ID original.
         """
-        geom = json.loads(feature.geometry().asJson())
         props = {
             field.name(): self.qvariant_to_python(feature.attribute(field.name()))
             for field in feature.fields()
         }
         feature_id = props.get("id")  # aquí preservamos el id original
-        return {"geometry": geom, "properties": props, "id": feature_id}
+        geom = json.loads(feature.geometry().asJson())
+        # Hash para la negociación have/want (solo features nuevas)
+        geom_hash = (
+            geometry_hash(geom)
+            if geom and feature_id in (None, "", "NULL")
+            else None
+        )
+        if binary:
+            wkb = bytes(feature.geometry().asWkb())
+            return {"wkb": wkb, "properties": props, "id": feature_id, "hash": geom_hash}
+        return {"geometry": geom, "properties": props, "id": feature_id, "hash": geom_hash}
 
-    def serialize_layer(self, layer):
+    def serialize_layer(self, layer, binary=False):
         """
         Serializa toda la capa a un dict con layer_name y features.
         Solo capas vectoriales.
@@ -334,8 +482,10 @@ class QgisSupabaseSyncPlugin:
         layer_data = {"layer_name": layer.name(), "features": []}
 
         for feat in layer.getFeatures():
-            feat_dict = self.serialize_feature(feat)
-            if feat_dict["geometry"] is None:
+            if not feat.hasGeometry():
+                continue
+            feat_dict = self.serialize_feature(feat, binary=binary)
+            if not binary and feat_dict["geometry"] is None:
                 continue
             layer_data["features"].append(feat_dict)
         if not layer_data["features"]:
@@ -397,7 +547,17 @@ class QgisSupabaseSyncPlugin:
                 "crs": "EPSG:4326",
                 "zoom": scale,
                 "max_zoom_out": 1e9,
+                # Capas editables: geometría original. Con un LOD simplificado, al
+                # guardar se sobrescribirían las filas con la geometría simplificada
+                "lod": 0,
+                # Sin descartar ni colapsar features pequeñas: un punto colapsado
+                # guardado como update sustituiría a la parcela
+                "cull": "none",
             },
+            # GeoJSON y no TopoJSON: editar exige las coordenadas a 9 decimales
+            # (geometry_hash) y a esa precisión, una vez comprimida la respuesta
+            # (requests envía Accept-Encoding), el TopoJSON no ocupa menos
+            "format": "geojson",
         }
 
         url = "http://127.0.0.1:8000/api/qgis/get_layer"
@@ -409,13 +569,24 @@ class QgisSupabaseSyncPlugin:
 
         try:
             response = requests.post(url, json=payload, cookies=cookies)
+            imprimir_server_timing(response)
             response.raise_for_status()
         except requests.exceptions.RequestException as e:
             self.iface.messageBar().pushCritical("Error", f"No se pudo conectar: {e}")
             return
 
         response_data = response.json()
-        features = response_data.get("features", [])
+        # Solo se puede guardar lo descargado a resolución completa y sin colapsar
+        editable = (
+            response_data.get("lod", 0) == 0
+            and (response_data.get("extent") or {}).get("cull", "none") != "collapse"
+        )
+        if not editable:
+            print("Capa descargada simplificada: se abre en solo lectura")
+        if "topology" in response_data:
+            features = topojson_a_features(response_data["topology"])
+        else:
+            features = response_data.get("features", [])
         if not features:
             self.iface.messageBar().pushInfo("Info", "No hay geometrías en esta área")
             return
@@ -452,9 +623,9 @@ class QgisSupabaseSyncPlugin:
             )
             prov = mem_layer.dataProvider()
 
-            # Recolectar todos los atributos, asegurando que 'id' esté presente
+            # Recolectar todos los atributos, asegurando que 'id' y 'version' estén presentes
             all_keys = sorted(
-                set("id").union(
+                {"id", "version"}.union(
                     {
                         key
                         for f in feature_list
@@ -477,8 +648,8 @@ class QgisSupabaseSyncPlugin:
                 attr_list = [
                     (
                         feat.get("properties", {}).get(key, "")
-                        if key != "id"
-                        else str(feat.get("id", ""))
+                        if key not in ("id", "version")
+                        else str(feat.get(key, "") or "")
                     )
                     for key in all_keys
                 ]
@@ -488,6 +659,20 @@ class QgisSupabaseSyncPlugin:
             prov.addFeatures(feats)
             mem_layer.updateExtents()
 
+            if editable:
+                # Estado descargado: id -> (versión, geometría) para detectar cambios al guardar
+                self.snapshots[mem_layer.id()] = {
+                    str(feat.get("id")): (
+                        feat.get("version"),
+                        f.geometry().asJson(),
+                    )
+                    for feat, f in zip(feature_list, feats)
+                    if feat.get("id") is not None
+                }
+            else:
+                # Sin snapshot sincronizar_cambios no envía updates ni deletes de esta capa
+                mem_layer.setReadOnly(True)
+
             QgsProject.instance().addMapLayer(mem_layer)
             self.capas_api.append(mem_layer.id())
 
@@ -500,6 +685,186 @@ class QgisSupabaseSyncPlugin:
     #                          GUARDAR CAMBIOS
     # ================================================================
 
+    def negociar_features(self, layer_data, cookies):
+        """
+        Have/want: envía solo los hashes de las features nuevas y se queda con
+        las que el servidor no tiene. Las features con id se gestionan en
+        sincronizar_cambios, así que no se vuelven a subir.
+        """
+        nuevas = [f for f in layer_data["features"] if f.get("hash")]
+        if not nuevas:
+            return []
+
+        data, headers = self.codificar_payload(
+            {
+                "project_id": self.selected_project_id,
+                "hashes": [f["hash"] for f in nuevas],
+            }
+        )
+        try:
+            result = self.request_con_refresh(
+                "POST",
+                "http://127.0.0.1:8000/api/qgis/negotiate",
+                cookies,
+                data=data,
+                headers=headers,
+            ).json()
+        except requests.exceptions.RequestException as e:
+            # Sin negociación se suben todas, el servidor descarta los duplicados
+            print(f"Negociación no disponible: {e}")
+            return nuevas
+
+        want = set(result.get("want", []))
+        return [f for f in nuevas if f["hash"] in want]
+
+    def codificar_payload(self, payload):
+        """
+        Codifica el cuerpo de una subida: msgpack (geometrías WKB) si está
+        disponible, si no JSON; en ambos casos comprimido con gzip.
+        Devuelve (bytes, cabeceras).
+        """
+        if msgpack is not None:
+            data = msgpack.packb(payload, use_bin_type=True)
+            content_type = "application/msgpack"
+        else:
+            data = json.dumps(payload).encode("utf-8")
+            content_type = "application/json"
+        return gzip.compress(data, compresslevel=5, mtime=0), {
+            "Content-Type": content_type,
+            "Content-Encoding": "gzip",
+        }
+
+    def request_con_refresh(self, method, url, cookies, **kwargs):
+        """
+        Lanza la petición y, si devuelve 401, refresca el token y reintenta una vez.
+        """
+        response = requests.request(method, url, cookies=cookies, **kwargs)
+        if response.status_code == 401 and self.refresh_access_token():
+            cookies["access_token"] = self.access_token
+            cookies["refresh_token"] = self.refresh_token
+            response = requests.request(method, url, cookies=cookies, **kwargs)
+        imprimir_server_timing(response)
+        response.raise_for_status()
+        return response
+
+    def sincronizar_cambios(self, layer, layer_data, cookies):
+        """
+        Envía en una sola petición las features descargadas que han cambiado
+        de geometría (updates con su versión) y las que se han borrado (deletes).
+        """
+        snapshot = self.snapshots.get(layer.id())
+        if not snapshot or "id" not in layer.fields().names():
+            return
+
+        updates = []
+        geometrias_nuevas = {}
+        vistos = set()
+        for feat in layer.getFeatures():
+            feature_id = str(self.qvariant_to_python(feat.attribute("id")))
+            if feature_id not in snapshot:
+                continue
+            vistos.add(feature_id)
+            version, geom_original = snapshot[feature_id]
+            geom_actual = feat.geometry().asJson()
+            if geom_actual == geom_original:
+                continue
+            geometrias_nuevas[feature_id] = geom_actual
+            updates.append(
+                {
+                    "id": int(feature_id),
+                    "geometry": json.loads(geom_actual),
+                    "version": int(version) if version not in (None, "") else None,
+                }
+            )
+        deletes = [int(fid) for fid in snapshot if fid not in vistos]
+
+        if not updates and not deletes:
+            return
+
+        result = self.request_con_refresh(
+            "POST",
+            "http://127.0.0.1:8000/api/qgis/sync_geometries",
+            cookies,
+            json={
+                "layer_name": layer_data["layer_name"],
+                "project_id": self.selected_project_id,
+                "updates": updates,
+                "deletes": deletes,
+            },
+        ).json()
+
+        # Actualizar el estado local con las versiones nuevas
+        for row in result.get("updates") or []:
+            if row.get("code") == "OK_UPDATE":
+                fid = str(row["id"])
+                snapshot[fid] = (row.get("version"), geometrias_nuevas[fid])
+        for row in result.get("deletes") or []:
+            if row.get("code") == "OK_DELETE":
+                snapshot.pop(str(row["id"]), None)
+
+        if result.get("conflicts"):
+            QMessageBox.warning(
+                None,
+                "Conflicto",
+                f"{len(result['conflicts'])} features de {layer.name()} fueron "
+                "modificadas por otro usuario. Vuelve a cargar la capa.",
+            )
+
+    def subir_capa_por_chunks(self, layer_data, cookies):
+        """
+        Sube una capa grande en chunks numerados dentro de una sesión de subida.
+        Cada chunk se confirma por separado; ante un corte solo se reenvían
+        los chunks que el servidor no tiene.
+        """
+        base_url = "http://127.0.0.1:8000/api/qgis/upload_sessions"
+        features = layer_data["features"]
+        chunks = [
+            features[i : i + UPLOAD_CHUNK_SIZE]
+            for i in range(0, len(features), UPLOAD_CHUNK_SIZE)
+        ]
+
+        session = self.request_con_refresh(
+            "POST",
+            base_url,
+            cookies,
+            json={
+                "layer_name": layer_data["layer_name"],
+                "project_id": self.selected_project_id,
+                "total_chunks": len(chunks),
+            },
+        ).json()
+        session_url = f"{base_url}/{session['session_id']}"
+
+        pendientes = list(range(len(chunks)))
+        for intento in range(UPLOAD_CHUNK_RETRIES):
+            for index in pendientes:
+                data, headers = self.codificar_payload({"features": chunks[index]})
+                try:
+                    self.request_con_refresh(
+                        "PUT",
+                        f"{session_url}/chunks/{index}",
+                        cookies,
+                        data=data,
+                        headers=headers,
+                    )
+                except requests.exceptions.RequestException as e:
+                    print(f"Chunk {index} no confirmado (intento {intento + 1}): {e}")
+
+            # Preguntar al servidor qué falta en lugar de fiarse de las respuestas
+            estado = self.request_con_refresh("GET", session_url, cookies).json()
+            pendientes = estado.get("missing", [])
+            if not pendientes:
+                break
+        else:
+            raise requests.exceptions.RequestException(
+                f"Quedan {len(pendientes)} chunks sin confirmar"
+            )
+
+        result = self.request_con_refresh(
+            "POST", f"{session_url}/finalize", cookies
+        ).json()
+        return result.get("inserted", 0)
+
     def guardar_cambios(self):
         # Verificar que el usuario esté logueado
         if not self.access_token:
@@ -535,17 +900,51 @@ class QgisSupabaseSyncPlugin:
             total_inserted = 0
 
             for layer in layers_to_upload:
-                layer_data = self.serialize_layer(layer)
+                layer_data = self.serialize_layer(layer, binary=msgpack is not None)
                 if not layer_data or not layer_data.get("features"):
                     continue
 
+                # Modificaciones y bajas de features descargadas
+                try:
+                    self.sincronizar_cambios(layer, layer_data, cookies)
+                except requests.exceptions.RequestException as e:
+                    QMessageBox.critical(
+                        None,
+                        "Error",
+                        f"No se pudieron sincronizar los cambios de {layer.name()}: {e}",
+                    )
+
+                # Solo se suben las features que el servidor no conoce
+                layer_data["features"] = self.negociar_features(layer_data, cookies)
+                if not layer_data["features"]:
+                    continue
+
+                # Capas grandes: subida por chunks reanudable
+                if len(layer_data["features"]) > UPLOAD_CHUNK_SIZE:
+                    try:
+                        total_inserted += self.subir_capa_por_chunks(layer_data, cookies)
+                    except requests.exceptions.RequestException as e:
+                        QMessageBox.critical(
+                            None,
+                            "Error",
+                            f"No se pudo enviar la capa {layer.name()}: {e}",
+                        )
+                    continue
+
                 payload = {
+                    "layer_name": layer_data["layer_name"],
                     "project_id": self.selected_project_id,  # <- aquí va el project_id seleccionado
                     "features": layer_data["features"],
                 }
 
+                data, headers = self.codificar_payload(payload)
+                # Misma clave en los reintentos de este envío: no se procesan dos veces
+                headers["Idempotency-Key"] = clave_idempotencia()
+
                 try:
-                    response = requests.post(url, json=payload, cookies=cookies)
+                    response = requests.post(
+                        url, data=data, cookies=cookies, headers=headers
+                    )
                     response.raise_for_status()
                     result = response.json()
                     total_inserted += result.get("inserted", 0)
@@ -554,7 +953,9 @@ class QgisSupabaseSyncPlugin:
                     if response.status_code == 401 and self.refresh_access_token():
                         cookies["access_token"] = self.access_token
                         cookies["refresh_token"] = self.refresh_token
-                        response = requests.post(url, json=layer_data, cookies=cookies)
+                        response = requests.post(
+                            url, data=data, cookies=cookies, headers=headers
+                        )
                         response.raise_for_status()
                         result = response.json()
                         total_inserted += result.get("inserted", 0)
@@ -1,18 +1,74 @@
 from urllib import response
-from fastapi import APIRouter, Depends, HTTPException, Response, Request
+from fastapi import APIRouter, Depends, Header, HTTPException, Response, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import FileResponse, JSONResponse
 import json
 from supabase_auth.errors import AuthApiError
-from .utils.limiter import limiter
-from .utils.supabase_manager import supabase_client, get_authenticated_supabase_client
+from .utils.limiter import (
+    RATE_LIMIT_IMPORT_MB,
+    RATE_LIMIT_READ_ROWS,
+    RATE_LIMIT_WRITE_FEATURES,
+    charge,
+    debit,
+    ensure_budget,
+    limiter,
+)
+from .utils.supabase_manager import get_supabase_client, get_authenticated_supabase_client
+from .utils.body_codec import DecodingRoute, request_payload
+from .utils.dedupe import NearDuplicateIndex
+from .utils.geojson import (
+    FeatureIn,
+    chunk_adapter,
+    feature_adapter,
+    openapi_request_body,
+    upload_adapter,
+    validate_payload,
+)
+from .utils.geometry import (
+    LOD_TOLERANCES,
+    bbox_union,
+    geometry_bbox,
+    lod_for_scale,
+    meters_to_degrees,
+    pixel_size_degrees,
+)
+from .utils.importers import (
+    IMPORT_BATCH_SIZE,
+    IMPORT_MAX_BYTES,
+    GeoPackageLayer,
+    ImportFormatError,
+    iter_geojson_features,
+    spool_to_tempfile,
+)
+from .utils.jobs import Job, job_manager
+from .utils.memberships import project_memberships
+from .utils.metrics import FEATURES_RETURNED
+from .utils.idempotency import fingerprint, payload_fingerprint, upload_idempotency
+from .utils.qgis_rpc import (
+    delete_geometries_batch,
+    get_known_geometry_hashes,
+    insert_geometries_batch,
+    update_geometries_batch,
+)
+from .utils.write_buffer import write_buffer
+from .utils.snapshots import snapshot_manager
+from .utils.tiles import tile_store
+from .utils.topojson import to_topology
+from .utils.tracing import span
+from .utils.upload_sessions import (
+    ChunkConflict,
+    UploadSession,
+    run_chunk_once,
+    upload_sessions,
+)
 import asyncio
-from pydantic import BaseModel
-from dotenv import load_dotenv
-from typing import List, Dict, Any, Optional
+from pydantic import BaseModel, Field, ValidationError
+from typing import Callable, List, Dict, Any, Literal, Optional
+import os
 
 
-load_dotenv()
-
-router = APIRouter(prefix="/api/qgis", tags=["QGIS"])
+# DecodingRoute: acepta cuerpos gzip/zstd y msgpack con geometrías WKB
+router = APIRouter(prefix="/api/qgis", tags=["QGIS"], route_class=DecodingRoute)
 
 
 ### Models
@@ -26,6 +82,15 @@ class Extents(BaseModel):
     max_zoom_out: float = (
         1000000000  # Escala máxima permitida (menor número = más zoom in)
     )
+    # Nivel de detalle: 0 = geometría original (por defecto, la única editable:
+    # sync_geometries reescribiría las filas con la geometría simplificada).
+    # None = se elige según zoom, solo para capas de consulta
+    lod: Optional[int] = 0
+    # Features más pequeñas que min_pixels píxeles: "none" (por defecto),
+    # "drop" (no se envían) o "collapse" (se envían como punto). "collapse" es
+    # solo para capas de consulta: el punto no puede guardarse como la geometría
+    cull: Literal["drop", "collapse", "none"] = "none"
+    min_pixels: float = 1.0
 
 
 class FeatureModel(BaseModel):
@@ -35,11 +100,42 @@ class FeatureModel(BaseModel):
 
 class LayerQueryRequest(BaseModel):
     extents: Extents
+    # "topojson": las aristas compartidas entre parcelas vecinas se envían una sola vez
+    format: Literal["geojson", "topojson"] = "geojson"
+    # Decimales de la rejilla de cuantización TopoJSON. 6 (~0.1 m) para visualizar:
+    # con más decimales los deltas son casi aleatorios y, ya comprimida la respuesta,
+    # el TopoJSON deja de ser menor que el GeoJSON. Para editar hacen falta 9 (los de
+    # geometry_hash: con menos, cada feature cargada contaría como modificada al
+    # sincronizar), y a 9 decimales compensa más pedir GeoJSON comprimido
+    precision: int = Field(6, ge=0, le=12)
 
 
-class LayerUploadRequest(BaseModel):
+class UploadSessionCreateRequest(BaseModel):
     layer_name: str
-    features: List[FeatureModel]
+    project_id: int
+    total_chunks: Optional[int] = None
+    dedupe_tolerance_m: Optional[float] = None
+
+
+class FeatureUpdate(BaseModel):
+    id: int
+    geometry: Dict[str, Any]
+    # Versión leída por el cliente; si no coincide con la actual se devuelve ERROR_CONFLICT
+    version: Optional[int] = None
+
+
+class NegotiateRequest(BaseModel):
+    project_id: int
+    # Hashes canónicos (geometry_hash) de las features que el cliente quiere subir
+    hashes: List[str]
+
+
+class SyncRequest(BaseModel):
+    layer_name: Optional[str] = None
+    project_id: int
+    inserts: List[FeatureModel] = []
+    updates: List[FeatureUpdate] = []
+    deletes: List[int] = []
 
 
 ### Routes
@@ -51,8 +147,9 @@ async def get_all_qgis():
     Devuelve todos los registros de QGIS con geometría deserializada.
     """
     try:
-        response = supabase_client.rpc("get_all_qgis_geometries").execute()
+        response = await get_supabase_client().rpc("get_all_qgis_geometries").execute()
         data = response.data if response.data else []
+        FEATURES_RETURNED.inc(len(data), "qgis_all")
         return {"success": True, "features": data}
     except Exception as e:
         raise HTTPException(
@@ -69,7 +166,7 @@ async def get_layers(auth_data=Depends(get_authenticated_supabase_client)):
 
     try:
         # Usar select con ST_AsGeoJSON para obtener geometría como GeoJSON
-        response = supabase.rpc(
+        response = await supabase.rpc(
             "get_qgis_geojson"  # optional: could create an RPC function in Postgres
         ).execute()
 
@@ -89,6 +186,7 @@ async def get_layers(auth_data=Depends(get_authenticated_supabase_client)):
             }
             for row in data
         ]
+        FEATURES_RETURNED.inc(len(features), "get_layer_simple")
 
         # Calcular extent (bounding box) opcionalmente
         # extent = supabase.rpc("get_qgis_extent").execute().data
@@ -112,6 +210,7 @@ import traceback
 @router.post("/get_layer")
 async def get_layers(
     request: LayerQueryRequest,
+    http_request: Request,
     auth_data=Depends(get_authenticated_supabase_client),
 ):
     supabase, user_id = auth_data
@@ -128,12 +227,26 @@ async def get_layers(
                 "max_allowed": extents.max_zoom_out,
             },
         )
+    # El coste (filas devueltas) solo se conoce después: aquí se comprueba que
+    # quede cupo y al final se descuentan las filas
+    ensure_budget(http_request, "get_layer", RATE_LIMIT_READ_ROWS)
 
     try:
         srid = int(extents.crs.split(":")[-1])
+        # Geometría simplificada precalculada (solo se elige columna); según la escala
+        # únicamente si el cliente lo pide con lod=None
+        lod = extents.lod if extents.lod is not None else lod_for_scale(extents.zoom)
+        lod = min(max(lod, 0), len(LOD_TOLERANCES) - 1)
+        # Tamaño mínimo (grados) por debajo del cual una feature no se ve a esta escala
+        min_size = (
+            pixel_size_degrees(extents.zoom) * extents.min_pixels
+            if extents.zoom and extents.cull != "none"
+            else 0.0
+        )
 
-        response = await asyncio.to_thread(
-            lambda: supabase.rpc(
+        # query = RPC + parseo de supabase-py (rpc.get_geometries_in_extent es solo la red)
+        with span("query"):
+            response = await supabase.rpc(
                 "get_geometries_in_extent",
                 {
                     "x_min": extents.xMin,
@@ -142,23 +255,42 @@ async def get_layers(
                     "y_max": extents.yMax,
                     "srid": srid,
                     "user_id": str(user_id),
+                    "lod": lod,
+                    "min_size": min_size,
+                    "cull_mode": extents.cull,
                 },
             ).execute()
-        )
 
         # Normalizar data
-        if response.data is None:
-            data = []
-        elif isinstance(response.data, dict):
-            data = [response.data]
-        else:
-            data = response.data
+        with span("normalize"):
+            if response.data is None:
+                data = []
+            elif isinstance(response.data, dict):
+                data = [response.data]
+            else:
+                data = response.data
 
         print("|----------------------------------------------------|")
         print("RPC raw response:", response)
         print("RPC data:", data)
+        debit(http_request, "get_layer", RATE_LIMIT_READ_ROWS, len(data))
+        FEATURES_RETURNED.inc(len(data), "get_layer")
 
-        return {"success": True, "features": data, "extent": extents.dict()}
+        if request.format == "topojson":
+            with span("topojson"):
+                topology = await asyncio.to_thread(to_topology, data, request.precision)
+            content = {
+                "success": True,
+                "topology": topology,
+                "extent": extents.dict(),
+                "lod": lod,
+            }
+        else:
+            content = {"success": True, "features": data, "extent": extents.dict(), "lod": lod}
+
+        # Se serializa aquí (y no al devolver el dict) para medirlo como tramo propio
+        with span("serialize"):
+            return JSONResponse(content)
 
     except Exception as e:
         import traceback
@@ -170,77 +302,818 @@ async def get_layers(
         )
 
 
-@router.post("/upload_geometries")
+@router.post(
+    "/upload_geometries",
+    openapi_extra=openapi_request_body(upload_adapter, "UploadEnvelope"),
+)
 async def upload_geometries(
-    request: LayerUploadRequest, auth_data=Depends(get_authenticated_supabase_client)
+    http_request: Request,
+    response: Response,
+    auth_data=Depends(get_authenticated_supabase_client),
+    idempotency_key: Optional[str] = Header(None),
+    background: bool = False,
 ):
     """
     Sube geometrías a la tabla QGIS de Postgres usando RPC function.
     Solo cuenta insertados nuevos.
+
+    Con la cabecera Idempotency-Key los reintentos devuelven el resultado
+    ya calculado en lugar de volver a procesar el envío.
+
+    Con ?background=true responde 202 con un job_id y la inserción se hace en
+    la cola de trabajos; el estado se consulta en /api/qgis/jobs/{job_id}.
+
+    Cuerpo: {layer_name, project_id, features: [{geometry, properties}],
+    dedupe_tolerance_m?} (ver routes/utils/geojson.py, UploadEnvelope).
     """
     supabase, user_id = auth_data
-    print(f"request:-----------||n{request.model_dump_json()}")
+    with span("validate"):
+        request = await _validated_payload(http_request, upload_adapter)
+    features = request["features"]
+    dedupe_tolerance_m = request.get("dedupe_tolerance_m")
+    print(f"Upload: capa {request['layer_name']}, {len(features)} features")
     # Verificar project_id
-    project_id = getattr(request, "project_id", None)
+    project_id = request.get("project_id")
     if project_id is None:
         raise HTTPException(
             status_code=400, detail="No se proporcionó project_id para las geometrías"
         )
-    if not request.features:
+    await project_memberships.ensure_access(supabase, user_id, project_id)
+    if not features:
         raise HTTPException(
             status_code=400, detail="No se proporcionaron features para subir"
         )
+    charge(http_request, "write", RATE_LIMIT_WRITE_FEATURES, len(features))
+
+    async def process():
+        if background:
+            return await _submit_upload_job(
+                supabase, user_id, project_id, features, dedupe_tolerance_m
+            )
+        return await _upload_features(
+            supabase, user_id, project_id, features, dedupe_tolerance_m
+        )
+
+    if not idempotency_key:
+        result = await process()
+    else:
+        result, replayed = await upload_idempotency.run(
+            str(user_id),
+            idempotency_key,
+            # Del contenido validado, no de los bytes: un reintento con otra
+            # codificación u otro orden de features es el mismo envío
+            await asyncio.to_thread(payload_fingerprint, request),
+            process,
+        )
+        if replayed:
+            print(f"Idempotency-Key repetida ({idempotency_key}), se devuelve el resultado guardado")
+            response.headers["Idempotent-Replayed"] = "true"
+
+    if background:
+        return JSONResponse(
+            status_code=202,
+            content=result,
+            headers={
+                "Location": result["status_url"],
+                **(
+                    {"Idempotent-Replayed": "true"}
+                    if "Idempotent-Replayed" in response.headers
+                    else {}
+                ),
+            },
+        )
+    return result
+
+
+async def _submit_upload_job(
+    supabase,
+    user_id: str,
+    project_id: int,
+    features: List[FeatureIn],
+    dedupe_tolerance_m: Optional[float],
+) -> Dict[str, Any]:
+    async def run(job: Job):
+        return await _upload_features(
+            supabase,
+            user_id,
+            project_id,
+            features,
+            dedupe_tolerance_m,
+            on_progress=job.set_progress,
+        )
+
+    try:
+        job = await job_manager.submit(user_id, "upload_geometries", run, total=len(features))
+    except asyncio.QueueFull:
+        raise HTTPException(
+            status_code=503, detail="Cola de trabajos llena, inténtalo más tarde"
+        )
+    print(f"Job {job.job_id} encolado: {len(features)} features")
+    return {
+        "success": True,
+        "job_id": job.job_id,
+        "status": job.status,
+        "status_url": f"{router.prefix}/jobs/{job.job_id}",
+    }
+
+
+@router.get("/jobs/{job_id}")
+async def get_job_status(job_id: str, auth_data=Depends(get_authenticated_supabase_client)):
+    """
+    Estado de un trabajo en segundo plano: progreso, contadores y errores.
+    """
+    _, user_id = auth_data
+    job = await job_manager.get(job_id, user_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado o caducado")
+    return {"success": True, **job.to_dict()}
+
+
+@router.post("/negotiate")
+async def negotiate_upload(
+    request: NegotiateRequest, auth_data=Depends(get_authenticated_supabase_client)
+):
+    """
+    Primer paso de la subida: el cliente envía los hashes de sus features y
+    el servidor responde con los que no conoce ("want"). Solo esas features
+    se suben después con /upload_geometries.
+    """
+    supabase, user_id = auth_data
+    await project_memberships.ensure_access(supabase, user_id, request.project_id)
+    hashes = list(dict.fromkeys(request.hashes))
+
+    try:
+        known = await get_known_geometry_hashes(supabase, request.project_id, hashes)
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Error al consultar hashes: {str(e)}"
+        )
+
+    want = [h for h in hashes if h not in known]
+    print(f"Negociación: {len(hashes)} hashes, {len(want)} nuevos")
+    return {"success": True, "known": len(hashes) - len(want), "want": want}
+
+
+@router.post("/sync_geometries")
+async def sync_geometries(
+    request: SyncRequest,
+    http_request: Request,
+    auth_data=Depends(get_authenticated_supabase_client),
+):
+    """
+    Sincroniza los cambios de una capa en una sola petición: altas, modificaciones
+    (por id, con versión opcional) y bajas. Cada tipo de operación se aplica
+    en bloque con un único RPC por lote.
+    """
+    supabase, user_id = auth_data
+    await project_memberships.ensure_access(supabase, user_id, request.project_id)
+
+    update_ids = [u.id for u in request.updates]
+    if len(set(update_ids)) != len(update_ids):
+        raise HTTPException(status_code=400, detail="Hay ids repetidos en updates")
+    overlap = set(update_ids) & set(request.deletes)
+    if overlap:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Los ids {sorted(overlap)} aparecen a la vez en updates y deletes",
+        )
+
+    charge(
+        http_request,
+        "write",
+        RATE_LIMIT_WRITE_FEATURES,
+        len(request.inserts) + len(request.updates) + len(request.deletes),
+    )
+
+    try:
+        with span("write"):
+            insert_rows, update_rows, delete_rows = await asyncio.gather(
+                insert_geometries_batch(
+                    supabase,
+                    user_id,
+                    request.project_id,
+                    [f.geometry for f in request.inserts],
+                )
+                if request.inserts
+                else _no_rows(),
+                update_geometries_batch(
+                    supabase,
+                    user_id,
+                    request.project_id,
+                    [
+                        {"id": u.id, "geometry": u.geometry, "version": u.version}
+                        for u in request.updates
+                    ],
+                )
+                if request.updates
+                else _no_rows(),
+                delete_geometries_batch(
+                    supabase, user_id, request.project_id, list(request.deletes)
+                )
+                if request.deletes
+                else _no_rows(),
+            )
+    except Exception as e:
+        tb = traceback.format_exc()
+        print("TRACEBACK ERROR:", tb)
+        raise HTTPException(
+            status_code=500, detail=f"Error al sincronizar geometrías: {str(e)}"
+        )
+
+    def count(rows, code):
+        return sum(1 for r in rows if r.get("code") == code)
+
+    def ids(rows, code):
+        return [r["id"] for r in rows if r.get("code") == code and r.get("id") is not None]
+
+    _mark_project_dirty(
+        request.project_id,
+        user_id,
+        supabase,
+        changed=ids(insert_rows, "OK_INSERT") + ids(update_rows, "OK_UPDATE"),
+        deleted=ids(delete_rows, "OK_DELETE"),
+    )
+
+    conflicts = [r for r in update_rows if r.get("code") == "ERROR_CONFLICT"]
+    not_found = [
+        r["id"] for r in update_rows + delete_rows if r.get("code") == "ERROR_NOT_FOUND"
+    ]
+
+    return {
+        "success": True,
+        "inserted": count(insert_rows, "OK_INSERT"),
+        "duplicates": count(insert_rows, "OK_DUPLICATE"),
+        "updated": count(update_rows, "OK_UPDATE"),
+        "deleted": count(delete_rows, "OK_DELETE"),
+        "inserts": insert_rows,
+        "updates": update_rows,
+        "deletes": delete_rows,
+        "conflicts": conflicts or None,
+        "not_found": not_found or None,
+    }
+
+
+async def _no_rows() -> List[Dict[str, Any]]:
+    return []
+
+@router.post("/upload_sessions")
+async def create_upload_session(
+    request: UploadSessionCreateRequest,
+    auth_data=Depends(get_authenticated_supabase_client),
+):
+    """
+    Abre una sesión de subida por chunks para una capa.
+    """
+    supabase, user_id = auth_data
+    if request.total_chunks is not None and request.total_chunks <= 0:
+        raise HTTPException(status_code=400, detail="total_chunks debe ser mayor que 0")
+    await project_memberships.ensure_access(supabase, user_id, request.project_id)
+
+    session = await asyncio.to_thread(
+        upload_sessions.create,
+        user_id,
+        request.project_id,
+        request.layer_name,
+        total_chunks=request.total_chunks,
+        dedupe_tolerance_m=request.dedupe_tolerance_m,
+    )
+    print(f"Sesión de subida {session.session_id} abierta ({request.layer_name})")
+    return {"success": True, **session.summary()}
+
+
+@router.put(
+    "/upload_sessions/{session_id}/chunks/{chunk_index}",
+    openapi_extra=openapi_request_body(chunk_adapter, "ChunkEnvelope"),
+)
+async def upload_session_chunk(
+    session_id: str,
+    chunk_index: int,
+    http_request: Request,
+    auth_data=Depends(get_authenticated_supabase_client),
+):
+    """
+    Recibe un chunk numerado, lo inserta y lo confirma de forma independiente.
+    Reenviar un chunk ya confirmado devuelve el mismo resultado; el mismo
+    índice con un contenido distinto es un conflicto (409).
+    """
+    supabase, user_id = auth_data
+    session = await _get_upload_session(session_id, user_id)
+    body_hash = fingerprint(await http_request.body())
+
+    if chunk_index in session.committed:
+        if session.body_hashes[chunk_index] != body_hash:
+            raise HTTPException(
+                status_code=409,
+                detail=f"El chunk {chunk_index} ya se recibió con un contenido distinto",
+            )
+        return {"success": True, "chunk": chunk_index, "replayed": True, **session.committed[chunk_index]}
+    if session.finalized:
+        raise HTTPException(status_code=409, detail="La sesión de subida ya está finalizada")
+    if chunk_index < 0 or (
+        session.total_chunks is not None and chunk_index >= session.total_chunks
+    ):
+        raise HTTPException(status_code=400, detail=f"Índice de chunk fuera de rango: {chunk_index}")
+
+    request = await _validated_payload(http_request, chunk_adapter)
+    charge(http_request, "write", RATE_LIMIT_WRITE_FEATURES, len(request["features"]))
+
+    try:
+        result, replayed = await run_chunk_once(
+            session,
+            chunk_index,
+            body_hash,
+            lambda: _upload_features(
+                supabase,
+                user_id,
+                session.project_id,
+                request["features"],
+                session.dedupe_tolerance_m,
+            ),
+        )
+    except ChunkConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"success": True, "chunk": chunk_index, "replayed": replayed, **result}
+
+
+@router.get("/upload_sessions/{session_id}")
+async def get_upload_session(
+    session_id: str, auth_data=Depends(get_authenticated_supabase_client)
+):
+    """
+    Estado de la sesión: chunks confirmados, en curso y pendientes.
+    """
+    _, user_id = auth_data
+    session = await _get_upload_session(session_id, user_id)
+    return {"success": True, **session.summary()}
+
+
+@router.post("/upload_sessions/{session_id}/finalize")
+async def finalize_upload_session(
+    session_id: str, auth_data=Depends(get_authenticated_supabase_client)
+):
+    """
+    Cierra la sesión y devuelve el resumen agregado de todos los chunks.
+    """
+    _, user_id = auth_data
+    await _get_upload_session(session_id, user_id)
+    # Atómico entre workers: un chunk no puede confirmarse a la vez que se cierra
+    session = await asyncio.to_thread(upload_sessions.finalize, session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Sesión de subida no encontrada o caducada")
+
+    if not session.finalized:
+        raise HTTPException(
+            status_code=409,
+            detail={
+                "error": "Faltan chunks por confirmar",
+                "missing": session.missing(),
+                "in_progress": sorted(session.in_flight),
+            },
+        )
+
+    summary = session.summary()
+    print(
+        f"Sesión de subida {session_id} finalizada: "
+        f"{summary['inserted']} insertados en {len(summary['received'])} chunks"
+    )
+    return {
+        "success": True,
+        "message": (
+            "Se grabaron los datos correctamente"
+            if summary["inserted"] > 0
+            else "No hay nuevos cambios"
+        ),
+        **summary,
+    }
+
+
+IMPORT_CONTENT_TYPES = {
+    "application/geo+json": "geojson",
+    "application/json": "geojson",
+    "application/geopackage+sqlite3": "gpkg",
+}
+
+
+@router.post("/import", openapi_extra={"x-streaming-body": True})
+async def import_file(
+    http_request: Request,
+    project_id: int,
+    auth_data=Depends(get_authenticated_supabase_client),
+    format: Optional[Literal["geojson", "gpkg"]] = None,
+    layer: Optional[str] = None,
+    dedupe_tolerance_m: Optional[float] = None,
+):
+    """
+    Importa un fichero GeoJSON (FeatureCollection) o GeoPackage completo al proyecto.
+
+    El cuerpo es el fichero tal cual (admite Content-Encoding gzip/zstd) y se
+    vuelca a disco según llega; el formato sale de ?format= o del Content-Type.
+    La importación corre en la cola de trabajos: responde 202 con el job_id y el
+    progreso se consulta en /api/qgis/jobs/{job_id}.
+
+    Las features se leen en streaming y se insertan por tramos de IMPORT_BATCH_SIZE
+    con el mismo pipeline que /upload_geometries; solo se guarda la geometría
+    (EPSG:4326; las capas GeoPackage en otro SRS se rechazan).
+    """
+    supabase, user_id = auth_data
+    # Antes de leer el cuerpo: no se vuelca a disco un fichero para un proyecto ajeno
+    await project_memberships.ensure_access(supabase, user_id, project_id)
+    content_type = http_request.headers.get("content-type", "").split(";")[0].strip().lower()
+    file_format = format or IMPORT_CONTENT_TYPES.get(content_type)
+    if file_format is None:
+        raise HTTPException(
+            status_code=415,
+            detail="Formato no reconocido: usa ?format=geojson|gpkg o el Content-Type del fichero",
+        )
+
+    # El cupo se cobra con el tamaño declarado antes de leer el cuerpo: si se
+    # cobrara al terminar, varias subidas en paralelo pasarían todas la comprobación
+    try:
+        declared = int(http_request.headers["content-length"])
+    except KeyError:
+        raise HTTPException(status_code=411, detail="Falta Content-Length")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Content-Length inválido")
+    if declared > IMPORT_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"El fichero supera {IMPORT_MAX_BYTES} bytes")
+    declared_mb = -(-declared // (1024 * 1024))
+    charge(http_request, "import", RATE_LIMIT_IMPORT_MB, declared_mb)
+    path, size = await spool_to_tempfile(
+        http_request.stream(),
+        http_request.headers.get("content-encoding", "identity"),
+        suffix=f".{file_format}",
+    )
+    print(f"Import {file_format}: {size} bytes recibidos para el proyecto {project_id}")
+    # Con Content-Encoding se cobra además lo que ocupa descomprimido
+    debit(http_request, "import", RATE_LIMIT_IMPORT_MB, -(-size // (1024 * 1024)) - declared_mb)
+
+    try:
+        if file_format == "gpkg":
+            source = await asyncio.to_thread(GeoPackageLayer, path, layer)
+            total, unit = await asyncio.to_thread(source.count), "features"
+        else:
+            source, total, unit = None, size, "bytes"
+    except ImportFormatError as e:
+        os.unlink(path)
+        raise HTTPException(status_code=400, detail=str(e))
+
+    async def run(job: Job):
+        job.unit = unit
+        try:
+            return await _import_features(
+                supabase, user_id, project_id, path, source, dedupe_tolerance_m, job
+            )
+        finally:
+            if source is not None:
+                source.close()
+            os.unlink(path)
+
+    try:
+        job = await job_manager.submit(user_id, f"import_{file_format}", run, total=total)
+    except asyncio.QueueFull:
+        if source is not None:
+            source.close()
+        os.unlink(path)
+        raise HTTPException(
+            status_code=503, detail="Cola de trabajos llena, inténtalo más tarde"
+        )
+    print(f"Job {job.job_id} encolado: importación {file_format} ({size} bytes)")
+    status_url = f"{router.prefix}/jobs/{job.job_id}"
+    return JSONResponse(
+        status_code=202,
+        content={
+            "success": True,
+            "job_id": job.job_id,
+            "status": job.status,
+            "status_url": status_url,
+        },
+        headers={"Location": status_url},
+    )
+
+
+# Errores de validación que se guardan en el resultado de una importación
+IMPORT_MAX_ERRORS = 100
+
+
+async def _import_features(
+    supabase,
+    user_id: str,
+    project_id: int,
+    path: str,
+    source: Optional[GeoPackageLayer],
+    dedupe_tolerance_m: Optional[float],
+    job: Job,
+) -> Dict[str, Any]:
+    """
+    Lee el fichero por tramos en un hilo (parseo y validación) e inserta cada
+    tramo antes de leer el siguiente: la memoria queda acotada a un tramo.
+    """
+    if source is not None:
+        features = source.iter_features(IMPORT_BATCH_SIZE)
+        file = None
+    else:
+        file = open(path, "rb")
+        features = iter_geojson_features(file, on_read=job.set_progress)
+
+    read = inserted = duplicates = invalid = 0
+    errors: List[Dict[str, Any]] = []
+
+    def next_batch() -> List[FeatureIn]:
+        nonlocal read, invalid
+        batch = []
+        for feature in features:
+            read += 1
+            try:
+                # Solo la geometría: la tabla QGIS no guarda atributos, y un
+                # properties.id del fichero haría que se tratase como ya existente
+                geometry = feature.get("geometry") if isinstance(feature, dict) else None
+                batch.append(feature_adapter.validate_python({"geometry": geometry}))
+            except ValidationError as e:
+                invalid += 1
+                if len(errors) < IMPORT_MAX_ERRORS:
+                    first = e.errors(include_url=False)[0]
+                    location = ".".join(str(part) for part in first["loc"])
+                    errors.append({"feature": read - 1, "error": f"{location}: {first['msg']}"})
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                break
+        return batch
 
+    try:
+        while True:
+            try:
+                batch = await asyncio.to_thread(next_batch)
+            except ImportFormatError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            if not batch:
+                break
+            summary = await _upload_features(
+                supabase, user_id, project_id, batch, dedupe_tolerance_m
+            )
+            inserted += summary["inserted"]
+            duplicates += summary["duplicates"]
+            for error in summary["errors"] or []:
+                if len(errors) < IMPORT_MAX_ERRORS:
+                    errors.append(error)
+            if source is not None:
+                job.set_progress(read)
+    finally:
+        if file is not None:
+            file.close()
+
+    print(
+        f"Import job {job.job_id}: {read} features leídas, {inserted} insertadas, "
+        f"{duplicates} duplicadas, {invalid} inválidas"
+    )
+    return {
+        "success": True,
+        "read": read,
+        "inserted": inserted,
+        "duplicates": duplicates,
+        "invalid": invalid,
+        "message": (
+            "Se grabaron los datos correctamente" if inserted > 0 else "No hay nuevos cambios"
+        ),
+        "errors": errors or None,
+    }
+
+
+@router.api_route("/projects/{project_id}/snapshot.fgb", methods=["GET", "HEAD"])
+async def get_project_snapshot(
+    project_id: int, auth_data=Depends(get_authenticated_supabase_client)
+):
+    """
+    Snapshot FlatGeobuf del proyecto (índice espacial incluido). Admite
+    peticiones Range: el driver FlatGeobuf de QGIS/GDAL (/vsicurl/) descarga
+    solo la cabecera, el índice y las features del extent visible.
+    """
+    supabase, user_id = auth_data
+    await project_memberships.ensure_access(supabase, user_id, project_id)
+    try:
+        path = await snapshot_manager.ensure(project_id, user_id, supabase)
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Error al generar el snapshot: {str(e)}"
+        )
+    return FileResponse(
+        path,
+        media_type="application/flatgeobuf",
+        filename=f"project_{project_id}.fgb",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+@router.get("/projects/{project_id}/snapshot")
+async def get_project_snapshot_status(
+    project_id: int, auth_data=Depends(get_authenticated_supabase_client)
+):
+    supabase, user_id = auth_data
+    await project_memberships.ensure_access(supabase, user_id, project_id)
+    return {"success": True, **snapshot_manager.status(project_id, user_id)}
+
+
+@router.post("/projects/{project_id}/snapshot")
+async def rebuild_project_snapshot(
+    project_id: int, auth_data=Depends(get_authenticated_supabase_client)
+):
+    """
+    Fuerza la regeneración completa del snapshot (p.ej. tras cambios hechos
+    directamente en la base de datos, que no pasan por esta API).
+    """
+    supabase, user_id = auth_data
+    await project_memberships.ensure_access(supabase, user_id, project_id)
+    snapshot_manager.request_rebuild(project_id, user_id, supabase, full=True)
+    return JSONResponse(
+        status_code=202,
+        content={"success": True, **snapshot_manager.status(project_id, user_id)},
+    )
+
+
+class TileSeedRequest(BaseModel):
+    max_zoom: Optional[int] = None
+
+
+@router.post("/projects/{project_id}/tiles")
+async def seed_project_tiles(
+    project_id: int,
+    request: TileSeedRequest = TileSeedRequest(),
+    auth_data=Depends(get_authenticated_supabase_client),
+):
+    """
+    Genera la pirámide de teselas vectoriales del proyecto hasta max_zoom
+    (por defecto TILES_MAX_ZOOM). Después se mantiene sola: cada escritura
+    regenera únicamente las teselas afectadas.
+    """
+    supabase, user_id = auth_data
+    await project_memberships.ensure_access(supabase, user_id, project_id)
+    if request.max_zoom is not None and not 0 <= request.max_zoom <= 20:
+        raise HTTPException(status_code=400, detail="max_zoom debe estar entre 0 y 20")
+    tile_store.seed(project_id, user_id, supabase, request.max_zoom)
+    return JSONResponse(
+        status_code=202,
+        content={"success": True, **tile_store.status(project_id, user_id)},
+    )
+
+
+@router.get("/projects/{project_id}/tiles.json")
+async def get_project_tilejson(
+    project_id: int,
+    http_request: Request,
+    auth_data=Depends(get_authenticated_supabase_client),
+):
+    """
+    TileJSON de la pirámide (plantilla de URL, zooms, bbox y capas).
+    """
+    supabase, user_id = auth_data
+    await project_memberships.ensure_access(supabase, user_id, project_id)
+    if not tile_store.exists(project_id, user_id):
+        raise HTTPException(status_code=404, detail="El proyecto no tiene teselas generadas")
+    meta = await asyncio.to_thread(tile_store.metadata, project_id, user_id)
+    base = str(http_request.base_url).rstrip("/")
+    return {
+        "tilejson": "3.0.0",
+        "name": meta.get("name"),
+        "scheme": "xyz",
+        "tiles": [f"{base}{router.prefix}/projects/{project_id}/tiles/{{z}}/{{x}}/{{y}}.pbf"],
+        "minzoom": int(meta.get("minzoom", 0)),
+        "maxzoom": int(meta.get("maxzoom", 0)),
+        "bounds": [float(v) for v in meta.get("bounds", "-180,-85,180,85").split(",")],
+        **json.loads(meta.get("json", "{}")),
+    }
+
+
+@router.get("/projects/{project_id}/tiles/{z}/{x}/{y}.pbf")
+async def get_project_tile(
+    project_id: int,
+    z: int,
+    x: int,
+    y: int,
+    auth_data=Depends(get_authenticated_supabase_client),
+):
+    """
+    Tesela vectorial (MVT, gzip) servida directamente desde el MBTiles del proyecto.
+    """
+    supabase, user_id = auth_data
+    await project_memberships.ensure_access(supabase, user_id, project_id)
+    if not tile_store.exists(project_id, user_id):
+        raise HTTPException(status_code=404, detail="El proyecto no tiene teselas generadas")
+    with span("tile"):
+        data = await asyncio.to_thread(tile_store.get_tile, project_id, user_id, z, x, y)
+    if data is None:
+        return Response(status_code=204)
+    return Response(
+        content=data,
+        media_type="application/vnd.mapbox-vector-tile",
+        headers={"Content-Encoding": "gzip", "Cache-Control": "no-cache"},
+    )
+
+
+def _mark_project_dirty(
+    project_id: int, user_id: str, supabase, changed=(), deleted=()
+) -> None:
+    """
+    Avisa a los artefactos derivados del proyecto y usuario (snapshot
+    FlatGeobuf y teselas) de los ids insertados/modificados y borrados.
+    """
+    changed, deleted = list(changed), list(deleted)
+    snapshot_manager.mark_dirty(project_id, user_id, supabase, changed=changed, deleted=deleted)
+    tile_store.mark_dirty(project_id, user_id, supabase, changed=changed, deleted=deleted)
+
+
+async def _validated_payload(http_request: Request, adapter) -> Any:
+    """
+    Valida el cuerpo con el TypeAdapter compilado (camino rápido para envíos grandes).
+    """
+    try:
+        return validate_payload(adapter, await request_payload(http_request))
+    except ValidationError as e:
+        raise RequestValidationError(e.errors(include_url=False))
+
+
+async def _get_upload_session(session_id: str, user_id: str) -> UploadSession:
+    session = await asyncio.to_thread(upload_sessions.get, session_id, user_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Sesión de subida no encontrada o caducada")
+    return session
+
+
+async def _upload_features(
+    supabase,
+    user_id: str,
+    project_id: int,
+    features: List[FeatureIn],
+    dedupe_tolerance_m: Optional[float] = None,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+) -> Dict[str, Any]:
+    """
+    Inserta las features nuevas (sin id) y devuelve el resumen del envío.
+    on_progress(procesadas, total) se llama tras cada tramo insertado.
+    """
     try:
         inserted_count = 0
+        duplicate_count = 0
+        inserted_ids = []
         errors = []
 
-        for feature in request.features:
-            props = feature.properties or {}
-            feature_id = props.get("id")
+        # Insertar solo features sin id
+        new_features = [
+            feature
+            for feature in features
+            if (feature.get("properties") or {}).get("id") in (None, "", "NULL")
+        ]
 
-            # Insertar solo si no tiene id
-            if feature_id not in (None, "", "NULL"):
-                continue
+        dedupe_index = None
+        with span("dedupe"):
+            if dedupe_tolerance_m and new_features:
+                dedupe_index = await _load_near_duplicate_index(
+                    supabase, project_id, new_features, dedupe_tolerance_m
+                )
 
-            try:
-                geom_json = feature.geometry
-                response = await asyncio.to_thread(
-                    lambda: supabase.rpc(
-                        "insert_geometry",
-                        {
-                            "geom_json": geom_json,
-                            "user_id": str(user_id),
-                            "project_id": project_id,
-                        },
-                    ).execute()
+            if dedupe_index is None:
+                to_insert = new_features
+            else:
+                # Hausdorff es O(n·m) en Python puro: fuera del event loop
+                to_insert = await asyncio.to_thread(
+                    _filter_near_duplicates, dedupe_index, new_features
                 )
+                duplicate_count += len(new_features) - len(to_insert)
 
-                # Normalizar respuesta a lista
-                data_list = []
-                if response.data:
-                    if isinstance(response.data, list):
-                        data_list = response.data
-                    elif isinstance(response.data, dict):
-                        data_list = [response.data]
-
-                    # Contar solo insertados
-                    for row in data_list:
-                        if row.get("code") == "OK_INSERT":
-                            inserted_count += 1
-
-            except Exception as feat_error:
-                errors.append(
-                    {
-                        "error": str(feat_error),
-                        "geometry_type": feature.geometry.get("type", "unknown"),
-                    }
+        # Las inserciones pasan por el write buffer (group commit con otras peticiones);
+        # se envían en tramos para poder informar del progreso
+        step = write_buffer.max_features
+        for start in range(0, len(to_insert), step):
+            if on_progress is not None:
+                on_progress(duplicate_count + start, len(new_features))
+            chunk = to_insert[start : start + step]
+            with span("insert"):
+                rows = await write_buffer.insert(
+                    supabase, user_id, project_id, [f["geometry"] for f in chunk]
                 )
-                continue
+            for feature, row in zip(chunk, rows):
+                code = row.get("code")
+                if code == "OK_INSERT":
+                    inserted_count += 1
+                    inserted_ids.append(row.get("id"))
+                elif code == "OK_DUPLICATE":
+                    duplicate_count += 1
+                else:
+                    errors.append(
+                        {
+                            "error": row.get("error") or code,
+                            "geometry_type": feature["geometry"].get("type", "unknown"),
+                        }
+                    )
+
+        if on_progress is not None:
+            on_progress(len(new_features), len(new_features))
+        if inserted_ids:
+            _mark_project_dirty(
+                project_id, user_id, supabase, changed=[i for i in inserted_ids if i is not None]
+            )
 
         return {
             "success": True,
             "inserted": inserted_count,
+            "duplicates": duplicate_count,
             "message": (
                 "Se grabaron los datos correctamente"
                 if inserted_count > 0
@@ -253,3 +1126,67 @@ async def upload_geometries(
         raise HTTPException(
             status_code=500, detail=f"Error al subir geometrías: {str(e)}"
         )
+
+
+async def _load_near_duplicate_index(
+    supabase, project_id: int, features: List[FeatureIn], tolerance_m: float
+) -> NearDuplicateIndex:
+    """
+    Carga las geometrías del proyecto que caen en el bbox del envío
+    (ampliado con la tolerancia) y construye el índice de casi duplicados.
+    """
+    bbox = None
+    for feature in features:
+        bbox = bbox_union(bbox, geometry_bbox(feature["geometry"]))
+
+    ref_latitude = (bbox[1] + bbox[3]) / 2 if bbox else 0.0
+    index = NearDuplicateIndex(tolerance_m, ref_latitude)
+    if bbox is None:
+        return index
+
+    pad_x, pad_y = meters_to_degrees(tolerance_m, ref_latitude)
+    response = await supabase.rpc(
+        "get_project_geometries_in_extent",
+        {
+            "p_project_id": project_id,
+            "x_min": bbox[0] - pad_x,
+            "y_min": bbox[1] - pad_y,
+            "x_max": bbox[2] + pad_x,
+            "y_max": bbox[3] + pad_y,
+            "srid": 4326,
+        },
+    ).execute()
+
+    rows = response.data or []
+    if isinstance(rows, dict):
+        rows = [rows]
+    await asyncio.to_thread(_index_rows, index, rows)
+
+    print(f"Near-duplicate index: {len(rows)} geometrías existentes en el bbox")
+    return index
+
+
+def _index_rows(index: NearDuplicateIndex, rows: List[Dict[str, Any]]) -> None:
+    for row in rows:
+        geometry = row.get("geometry")
+        if isinstance(geometry, str):
+            geometry = json.loads(geometry)
+        if geometry:
+            index.add(geometry, row.get("id"))
+
+
+def _filter_near_duplicates(
+    index: NearDuplicateIndex, features: List[FeatureIn]
+) -> List[FeatureIn]:
+    """
+    Features que no son casi duplicadas de una existente ni de otra anterior del envío.
+    """
+    to_insert = []
+    for feature in features:
+        is_duplicate, _ = index.find(feature["geometry"])
+        if is_duplicate:
+            continue
+        # Las geometrías de este mismo envío también cuentan como existentes
+        index.add(feature["geometry"])
+        to_insert.append(feature)
+    return to_insert
@@ -0,0 +1,5 @@
+from dotenv import load_dotenv
+
+# Una sola vez y antes que nada: los módulos de routes leen su configuración
+# (os.getenv) al importarse
+load_dotenv()
@@ -1,12 +1,11 @@
-from supabase_auth.errors import AuthApiError
+import time
+from .utils.gotrue import GoTrueError, password_grant, refresh_grant, revoke
+from .utils.jwt_verifier import TokenError, token_verifier
 from .utils.limiter import limiter
-from .utils.supabase_manager import supabase_client
-import asyncio
-from fastapi import APIRouter, HTTPException, Response, Request
+from .utils.memberships import project_memberships
+from .utils.supabase_manager import client_for_token, get_authenticated_supabase_client
+from fastapi import APIRouter, Depends, HTTPException, Response, Request
 from pydantic import BaseModel
-from dotenv import load_dotenv
-
-load_dotenv()
 
 router = APIRouter(prefix="/api/auth", tags=["Auth"])
 
@@ -28,61 +27,64 @@ class LoginResponse(BaseModel):
     projects: list[ProjectItem]
 
 
-### Routes
-@router.post("/login", response_model=LoginResponse)
-@limiter.limit("5/minute")
-async def login(request: Request, creds: Credentials, response: Response):
-    try:
-        print(f"Login attempt for email: {creds.email}")
+class ProjectsResponse(BaseModel):
+    projects: list[ProjectItem]
 
-        auth_response = await asyncio.to_thread(
-            supabase_client.auth.sign_in_with_password,
-            {
-                "email": creds.email,
-                "password": creds.password,
-            },
-        )
 
+### Routes
+def _set_session_cookies(response: Response, session: dict) -> None:
+    for key in ("access_token", "refresh_token"):
         response.set_cookie(
-            key="access_token",
-            value=auth_response.session.access_token,
+            key=key,
+            value=session[key],
             httponly=True,
             secure=True,  # Only over HTTPS in production
             samesite="lax",
-            max_age=auth_response.session.expires_in,
+            max_age=session["expires_in"],
         )
-        response.set_cookie(
-            key="refresh_token",
-            value=auth_response.session.refresh_token,
-            httponly=True,
-            secure=True,
-            samesite="lax",
-            max_age=auth_response.session.expires_in,
-        )
-        user_id = str(auth_response.user.id)
-        # 🔹 RPC: proyectos del usuario
-        projects_response = await asyncio.to_thread(
-            lambda: supabase_client.rpc(
-                "get_projects_by_user", {"p_user_id": user_id}
-            ).execute()
-        )
-        print("Raw projects_response:", projects_response.data)
 
-        projects = projects_response.data or []
-        projects = [
-            {"project_id": p["project_id"], "project_name": p["project_name"]}
-            for p in projects
-        ]
 
-        print(f"Login successful for user: {auth_response.user.id}")
+@router.post("/login", response_model=LoginResponse)
+@limiter.limit("5/minute")
+async def login(request: Request, creds: Credentials, response: Response):
+    try:
+        print(f"Login attempt for email: {creds.email}")
+
+        # Sin estado compartido: la sesión solo vive en la respuesta (cookies)
+        session = await password_grant(creds.email, creds.password)
+        _set_session_cookies(response, session)
+
+        user_id = str(session["user"]["id"])
+        expires_at = session.get("expires_at") or time.time() + session["expires_in"]
+        supabase = await client_for_token(session["access_token"], expires_at)
+        # 🔹 RPC: proyectos del usuario (se recargan en cada login)
+        project_memberships.invalidate(user_id)
+        projects = await project_memberships.projects(supabase, user_id)
+        print("Projects:", projects)
+
+        print(f"Login successful for user: {user_id}")
         return LoginResponse(
             message="Login successful",
-            user_id=str(auth_response.user.id),
+            user_id=user_id,
             projects=projects,
         )
-    except AuthApiError as e:
-        print(f"AuthApiError: {e}")
-        raise HTTPException(status_code=401, detail="User or Password are incorrect")
+    except GoTrueError as e:
+        print(f"GoTrueError ({e.status}, {e.code}): {e}")
+        if e.invalid_credentials:
+            raise HTTPException(status_code=401, detail="User or Password are incorrect")
+        if e.status == 429:
+            # Límite de Supabase Auth: el cliente debe esperar, no pedir otra contraseña
+            raise HTTPException(
+                status_code=429,
+                detail="Too many login attempts, try again later",
+                headers={"Retry-After": str(e.retry_after)},
+            )
+        if e.status in (400, 422):
+            # Petición rechazada por otro motivo (email sin confirmar, formato...)
+            raise HTTPException(status_code=e.status, detail=str(e))
+        raise HTTPException(
+            status_code=500, detail="Authentication failed, try again later"
+        )
     except Exception as e:
         import traceback
 
@@ -97,7 +99,20 @@ async def login(request: Request, creds: Credentials, response: Response):
 @limiter.limit("5/minute")
 async def logout(request: Request, response: Response):
     try:
-        await asyncio.to_thread(supabase_client.auth.sign_out)
+        access_token = request.cookies.get("access_token")
+        try:
+            claims = await token_verifier.verify(access_token) if access_token else None
+        except TokenError:
+            claims = None  # token caducado o inválido: solo se borran las cookies
+        if claims:
+            try:
+                # Revoca en Supabase la sesión de este token (sus refresh tokens)
+                await revoke(access_token)
+            except GoTrueError as e:
+                print(f"Logout: GoTrue no revocó la sesión ({e.status}): {e}")
+            await token_verifier.revoke(access_token, claims["exp"])
+            project_memberships.invalidate(claims["sub"])
+
         response.delete_cookie(
             key="access_token", httponly=True, secure=True, samesite="lax"
         )
@@ -117,27 +132,26 @@ async def refresh(request: Request, response: Response):
         if not refresh_token:
             raise HTTPException(status_code=401, detail="No refresh token")
 
-        auth_response = await asyncio.to_thread(
-            supabase_client.auth.refresh_session, refresh_token
-        )
-
-        response.set_cookie(
-            key="access_token",
-            value=auth_response.session.access_token,
-            httponly=True,
-            secure=True,
-            samesite="lax",
-            max_age=auth_response.session.expires_in,
-        )
-        response.set_cookie(
-            key="refresh_token",
-            value=auth_response.session.refresh_token,
-            httponly=True,
-            secure=True,
-            samesite="lax",
-            max_age=auth_response.session.expires_in,
-        )
+        session = await refresh_grant(refresh_token)
+        _set_session_cookies(response, session)
 
         return {"message": "Token refreshed"}
     except Exception as e:
         raise HTTPException(status_code=401, detail="Token refresh failed")
+
+
+@router.get("/projects", response_model=ProjectsResponse)
+@limiter.limit("30/minute")
+async def list_projects(
+    request: Request,
+    refresh: bool = False,
+    auth_data=Depends(get_authenticated_supabase_client),
+):
+    """
+    Proyectos del usuario, desde la caché de pertenencia (la misma que
+    comprueba el project_id en las rutas QGIS). ?refresh=true la invalida antes.
+    """
+    supabase, user_id = auth_data
+    if refresh:
+        project_memberships.invalidate(user_id)
+    return ProjectsResponse(projects=await project_memberships.projects(supabase, user_id))
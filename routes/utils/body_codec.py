@@ -0,0 +1,225 @@
+import io
+import os
+import zlib
+from typing import Any, BinaryIO, Callable, Iterator
+
+from fastapi import HTTPException, Request
+from fastapi.routing import APIRoute
+
+from .geometry import wkb_to_geojson
+from .tracing import span
+
+try:
+    import msgpack
+except ImportError:  # dependencia opcional: pip install msgpack
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:  # dependencia opcional: pip install zstandard
+    zstandard = None
+
+# Límite del cuerpo ya descomprimido (protección frente a "zip bombs"). El plugin
+# sube en chunks de 2000 features (UPLOAD_CHUNK_SIZE): con parcelas de unos cientos
+# de vértices a 9 decimales son ~10-25 MB de GeoJSON, así que 64 MiB deja margen.
+# Los ficheros grandes van por /import, que tiene su propio límite (IMPORT_MAX_BYTES)
+MAX_DECODED_BODY_BYTES = int(os.getenv("MAX_DECODED_BODY_BYTES", 64 * 1024 * 1024))
+
+MSGPACK_CONTENT_TYPES = ("application/msgpack", "application/x-msgpack", "application/vnd.msgpack")
+
+_READ_SIZE = 1024 * 1024
+
+
+def _too_large():
+    return HTTPException(
+        status_code=413,
+        detail=f"El cuerpo descomprimido supera {MAX_DECODED_BODY_BYTES} bytes",
+    )
+
+
+def decode_content_encoding(body: bytes, encoding: str) -> bytes:
+    """
+    Descomprime el cuerpo según Content-Encoding (gzip, deflate o zstd).
+    """
+    encoding = encoding.strip().lower()
+    if encoding in ("", "identity"):
+        return body
+
+    if encoding in ("gzip", "x-gzip", "deflate"):
+        wbits = 16 + zlib.MAX_WBITS if encoding != "deflate" else zlib.MAX_WBITS
+        decompressor = zlib.decompressobj(wbits)
+        out = bytearray()
+        data = body
+        try:
+            while data:
+                out += decompressor.decompress(data, _READ_SIZE)
+                if len(out) > MAX_DECODED_BODY_BYTES:
+                    raise _too_large()
+                data = decompressor.unconsumed_tail
+            out += decompressor.flush()
+        except zlib.error as e:
+            raise HTTPException(status_code=400, detail=f"Cuerpo {encoding} inválido: {e}")
+        return bytes(out)
+
+    if encoding == "zstd":
+        if zstandard is None:
+            raise HTTPException(
+                status_code=415, detail="Content-Encoding zstd no disponible en el servidor"
+            )
+        out = bytearray()
+        try:
+            with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(body)) as reader:
+                while chunk := reader.read(_READ_SIZE):
+                    out += chunk
+                    if len(out) > MAX_DECODED_BODY_BYTES:
+                        raise _too_large()
+        except zstandard.ZstdError as e:
+            raise HTTPException(status_code=400, detail=f"Cuerpo zstd inválido: {e}")
+        return bytes(out)
+
+    raise HTTPException(status_code=415, detail=f"Content-Encoding no soportado: {encoding}")
+
+
+def check_content_encoding(encoding: str) -> str:
+    """
+    Normaliza Content-Encoding y comprueba que se puede descomprimir (415 si no).
+    """
+    encoding = encoding.strip().lower()
+    if encoding in ("", "identity", "gzip", "x-gzip", "deflate"):
+        return encoding
+    if encoding == "zstd":
+        if zstandard is None:
+            raise HTTPException(
+                status_code=415, detail="Content-Encoding zstd no disponible en el servidor"
+            )
+        return encoding
+    raise HTTPException(status_code=415, detail=f"Content-Encoding no soportado: {encoding}")
+
+
+def iter_decompressed(fileobj: BinaryIO, encoding: str) -> Iterator[bytes]:
+    """
+    Descomprime un fichero por bloques de como mucho _READ_SIZE bytes (gzip,
+    deflate o zstd), para cuerpos demasiado grandes para tenerlos en memoria.
+    La salida está acotada por bloque, así que el llamador puede cortar antes
+    de escribir un bloque que supere su límite (cuerpos que se expanden a GB).
+    """
+    encoding = check_content_encoding(encoding)
+    if encoding in ("", "identity"):
+        while chunk := fileobj.read(_READ_SIZE):
+            yield chunk
+        return
+
+    if encoding == "zstd":
+        try:
+            with zstandard.ZstdDecompressor().stream_reader(fileobj) as reader:
+                while chunk := reader.read(_READ_SIZE):
+                    yield chunk
+        except zstandard.ZstdError as e:
+            raise HTTPException(status_code=400, detail=f"Cuerpo zstd inválido: {e}")
+        return
+
+    wbits = 16 + zlib.MAX_WBITS if encoding != "deflate" else zlib.MAX_WBITS
+    decompressor = zlib.decompressobj(wbits)
+    try:
+        while data := fileobj.read(_READ_SIZE):
+            while data:
+                chunk = decompressor.decompress(data, _READ_SIZE)
+                if chunk:
+                    yield chunk
+                data = decompressor.unconsumed_tail
+        tail = decompressor.flush()
+        if tail:
+            yield tail
+    except zlib.error as e:
+        raise HTTPException(status_code=400, detail=f"Cuerpo {encoding} inválido: {e}")
+
+
+def is_msgpack(content_type: str) -> bool:
+    return content_type.split(";")[0].strip().lower() in MSGPACK_CONTENT_TYPES
+
+
+def decode_msgpack_envelope(body: bytes) -> Any:
+    """
+    Decodifica un envío msgpack: mismo sobre que el JSON, pero cada feature
+    puede traer la geometría como WKB en "wkb" en lugar de GeoJSON en "geometry".
+    Los atributos conservan sus tipos (int, float, bool, str, None).
+    """
+    if msgpack is None:
+        raise HTTPException(
+            status_code=415, detail="Cuerpos msgpack no disponibles en el servidor"
+        )
+    try:
+        payload = msgpack.unpackb(body, raw=False)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Cuerpo msgpack inválido: {e}")
+
+    if isinstance(payload, dict):
+        for key in ("features", "inserts", "updates"):
+            for feature in payload.get(key) or []:
+                wkb = feature.pop("wkb", None) if isinstance(feature, dict) else None
+                if wkb is not None:
+                    try:
+                        feature["geometry"] = wkb_to_geojson(wkb)
+                    except Exception as e:
+                        raise HTTPException(status_code=400, detail=f"WKB inválido: {e}")
+    return payload
+
+
+async def request_payload(request: Request) -> Any:
+    """
+    Cuerpo listo para validar: el objeto ya decodificado si llegó en msgpack,
+    o los bytes JSON tal cual (para TypeAdapter.validate_json).
+    """
+    decoded = request.scope.get("decoded_payload")
+    if decoded is not None:
+        return decoded
+    return await request.body()
+
+
+class DecodingRoute(APIRoute):
+    """
+    Ruta que acepta cuerpos comprimidos (Content-Encoding gzip/deflate/zstd)
+    y cuerpos msgpack con geometrías WKB. El handler recibe siempre el mismo
+    modelo que con JSON plano.
+
+    Las rutas con openapi_extra={"x-streaming-body": True} leen el cuerpo
+    en streaming ellas mismas (iter_decompressed) y no pasan por aquí.
+    """
+
+    def get_route_handler(self) -> Callable:
+        original_handler = super().get_route_handler()
+        if (self.openapi_extra or {}).get("x-streaming-body"):
+            return original_handler
+
+        async def handler(request: Request):
+            encoding = request.headers.get("content-encoding", "identity")
+            content_type = request.headers.get("content-type", "")
+            binary = is_msgpack(content_type)
+            if encoding.lower() in ("", "identity") and not binary:
+                return await original_handler(request)
+
+            with span("decode"):
+                body = decode_content_encoding(await request.body(), encoding)
+
+            headers = [
+                (k, v)
+                for k, v in request.scope["headers"]
+                if k not in (b"content-encoding", b"content-type", b"content-length")
+            ]
+            headers.append((b"content-type", b"application/json"))
+            headers.append((b"content-length", str(len(body)).encode()))
+            decoded = Request({**request.scope, "headers": headers}, request.receive)
+            decoded._body = body
+            if binary:
+                # FastAPI usa request.json(), que devuelve este valor ya decodificado
+                with span("decode"):
+                    decoded._json = decode_msgpack_envelope(body)
+                decoded.scope["decoded_payload"] = decoded._json
+
+            print(
+                f"Cuerpo decodificado ({encoding}{', msgpack' if binary else ''}): "
+                f"{len(body)} bytes"
+            )
+            return await original_handler(decoded)
+
+        return handler
@@ -0,0 +1,94 @@
+import os
+
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware, GZipResponder, IdentityResponder
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import zstandard
+except ImportError:  # dependencia opcional: pip install zstandard
+    zstandard = None
+
+# Compresión de las respuestas según Accept-Encoding: zstd si el cliente lo acepta
+# y está instalado, si no gzip. Por debajo de este tamaño no compensa
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.getenv("RESPONSE_COMPRESSION_MIN_BYTES", 1024))
+RESPONSE_GZIP_LEVEL = int(os.getenv("RESPONSE_GZIP_LEVEL", 5))
+RESPONSE_ZSTD_LEVEL = int(os.getenv("RESPONSE_ZSTD_LEVEL", 3))
+
+# El snapshot FlatGeobuf se sirve con peticiones Range (los offsets son del
+# fichero sin comprimir) y las teselas ya van en gzip
+UNCOMPRESSED_CONTENT_TYPES = (
+    "text/event-stream",
+    "application/flatgeobuf",
+    "application/x-protobuf",
+    "application/vnd.mapbox-vector-tile",
+)
+
+
+class _SkipUncompressible:
+    async def send_with_compression(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            headers = Headers(raw=message["headers"])
+            skip = "content-range" in headers or headers.get("content-type", "").startswith(
+                UNCOMPRESSED_CONTENT_TYPES
+            )
+            await super().send_with_compression(message)
+            self.content_type_is_excluded = self.content_type_is_excluded or skip
+            return
+        await super().send_with_compression(message)
+
+
+class _IdentityResponder(_SkipUncompressible, IdentityResponder):
+    pass
+
+
+class _GZipResponder(_SkipUncompressible, GZipResponder):
+    pass
+
+
+class _ZstdResponder(_SkipUncompressible, IdentityResponder):
+    content_encoding = "zstd"
+
+    def __init__(self, app: ASGIApp, minimum_size: int, level: int):
+        super().__init__(app, minimum_size)
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def apply_compression(self, body: bytes, *, more_body: bool) -> bytes:
+        out = self.compressor.compress(body)
+        if more_body:
+            return out + self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        return out + self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH)
+
+
+class CompressionMiddleware(GZipMiddleware):
+    """
+    GZipMiddleware de Starlette con zstd como primera opción y sin tocar las
+    respuestas parciales (Range), los snapshots FlatGeobuf ni las teselas.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        minimum_size: int = RESPONSE_COMPRESSION_MIN_BYTES,
+        compresslevel: int = RESPONSE_GZIP_LEVEL,
+        zstd_level: int = RESPONSE_ZSTD_LEVEL,
+    ) -> None:
+        super().__init__(app, minimum_size, compresslevel)
+        self.zstd_level = zstd_level
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        accepted = {
+            part.split(";")[0].strip().lower()
+            for part in Headers(scope=scope).get("accept-encoding", "").split(",")
+        }
+        if zstandard is not None and "zstd" in accepted:
+            responder = _ZstdResponder(self.app, self.minimum_size, self.zstd_level)
+        elif "gzip" in accepted:
+            responder = _GZipResponder(self.app, self.minimum_size, self.compresslevel)
+        else:
+            responder = _IdentityResponder(self.app, self.minimum_size)
+        await responder(scope, receive, send)
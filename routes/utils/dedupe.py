@@ -0,0 +1,74 @@
+import hashlib
+import json
+import math
+from typing import Any, Dict, List, Tuple
+
+from .geometry import geometry_bbox, hausdorff_distance_m, iter_coords, meters_to_degrees
+
+
+class NearDuplicateIndex:
+    """
+    Índice en memoria para detectar geometrías casi duplicadas.
+
+    - Hash de coordenadas ajustadas a una rejilla de lado tolerance/√2: si
+      coincide, todos los vértices están a menos de la tolerancia (camino O(1)).
+    - Rejilla por centro del bbox: los candidatos se buscan en las 9 celdas
+      vecinas y se confirman con la distancia de Hausdorff.
+    """
+
+    def __init__(self, tolerance_m: float, ref_latitude: float = 0.0):
+        self.tolerance_m = tolerance_m
+        self.cell_x, self.cell_y = meters_to_degrees(tolerance_m, ref_latitude)
+        self.snap_x = self.cell_x / math.sqrt(2)
+        self.snap_y = self.cell_y / math.sqrt(2)
+        self._snapped: Dict[str, Any] = {}
+        self._cells: Dict[Tuple[int, int], List[Tuple[Tuple, Dict[str, Any], Any]]] = {}
+
+    def _snap_key(self, geometry: Dict[str, Any]) -> str:
+        snapped = [
+            (round(x / self.snap_x), round(y / self.snap_y))
+            for x, y in iter_coords(geometry)
+        ]
+        raw = json.dumps([geometry.get("type"), snapped], separators=(",", ":"))
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def _cell(self, bbox) -> Tuple[int, int]:
+        cx = (bbox[0] + bbox[2]) / 2
+        cy = (bbox[1] + bbox[3]) / 2
+        return math.floor(cx / self.cell_x), math.floor(cy / self.cell_y)
+
+    def add(self, geometry: Dict[str, Any], ref: Any = None) -> None:
+        bbox = geometry_bbox(geometry)
+        if bbox is None:
+            return
+        self._snapped.setdefault(self._snap_key(geometry), ref)
+        self._cells.setdefault(self._cell(bbox), []).append((bbox, geometry, ref))
+
+    def find(self, geometry: Dict[str, Any]) -> Tuple[bool, Any]:
+        """
+        Devuelve (True, ref) si existe una geometría del mismo tipo a una
+        distancia de Hausdorff menor o igual que la tolerancia.
+        """
+        bbox = geometry_bbox(geometry)
+        if bbox is None:
+            return False, None
+
+        key = self._snap_key(geometry)
+        if key in self._snapped:
+            return True, self._snapped[key]
+
+        gx, gy = self._cell(bbox)
+        for ix in (gx - 1, gx, gx + 1):
+            for iy in (gy - 1, gy, gy + 1):
+                for other_bbox, other, ref in self._cells.get((ix, iy), ()):
+                    if other.get("type") != geometry.get("type"):
+                        continue
+                    # Descarte rápido: los bordes del bbox no pueden alejarse más que la tolerancia
+                    if any(
+                        abs(bbox[i] - other_bbox[i]) > (self.cell_x if i % 2 == 0 else self.cell_y)
+                        for i in range(4)
+                    ):
+                        continue
+                    if hausdorff_distance_m(geometry, other) <= self.tolerance_m:
+                        return True, ref
+        return False, None
@@ -0,0 +1,413 @@
+import math
+import struct
+from typing import Any, BinaryIO, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from .geometry import BBox
+
+# Escritor FlatGeobuf (https://flatgeobuf.org) en Python puro: cabecera, índice
+# R-tree empaquetado por curva de Hilbert y features, todo en flatbuffers.
+# Solo geometrías 2D (la Z se descarta) en EPSG:4326.
+
+MAGIC = b"fgb\x03fgb\x01"
+INDEX_NODE_SIZE = 16
+
+# Tipos de geometría y de columna de los esquemas header.fbs / feature.fbs
+GEOMETRY_TYPES = {
+    "Point": 1,
+    "LineString": 2,
+    "Polygon": 3,
+    "MultiPoint": 4,
+    "MultiLineString": 5,
+    "MultiPolygon": 6,
+    "GeometryCollection": 7,
+}
+COLUMN_INT = 5
+COLUMN_LONG = 7
+
+_NODE = struct.Struct("<4dQ")
+NODE_ITEM_SIZE = _NODE.size
+
+_SCALARS = {
+    "bool": ("<B", 1),
+    "u8": ("<B", 1),
+    "u16": ("<H", 2),
+    "i32": ("<i", 4),
+    "u32": ("<I", 4),
+    "u64": ("<Q", 8),
+}
+
+
+class _Builder:
+    """
+    Serializador flatbuffers mínimo que escribe hacia delante: vtable, tabla y
+    después sus hijos (uoffsets siempre positivos), respetando la alineación
+    de cada campo respecto al inicio del buffer.
+    """
+
+    def __init__(self):
+        self.buf = bytearray(4)  # uoffset a la tabla raíz
+
+    def _pad(self, align: int, extra: int = 0) -> None:
+        self.buf.extend(b"\x00" * ((-(len(self.buf) + extra)) % align))
+
+    def table(self, fields: Sequence[Tuple[int, str, Any]]) -> int:
+        """
+        fields: (slot, tipo, valor). Tipo escalar de _SCALARS o "ref", cuyo valor
+        es una función que escribe el hijo y devuelve su posición.
+        """
+        fields = [f for f in fields if f[2] is not None]
+        # Campos grandes primero: menos relleno dentro de la tabla
+        ordered = sorted(
+            fields, key=lambda f: -(4 if f[1] == "ref" else _SCALARS[f[1]][1])
+        )
+        layout = []
+        size = 4  # soffset a la vtable
+        for slot, kind, value in ordered:
+            width = 4 if kind == "ref" else _SCALARS[kind][1]
+            size += (-size) % width
+            layout.append((slot, kind, value, size))
+            size += width
+        align = 8 if any(kind == "u64" for _, kind, _ in fields) else 4
+        size += (-size) % align
+
+        slots = max((f[0] for f in fields), default=-1) + 1
+        vtable = [0] * slots
+        for slot, _, _, offset in layout:
+            vtable[slot] = offset
+
+        self._pad(2)
+        vtable_pos = len(self.buf)
+        self.buf += struct.pack(f"<HH{slots}H", 4 + 2 * slots, size, *vtable)
+        self._pad(align)
+        table_pos = len(self.buf)
+        self.buf += b"\x00" * size
+        struct.pack_into("<i", self.buf, table_pos, table_pos - vtable_pos)
+
+        refs = []
+        for slot, kind, value, offset in layout:
+            if kind == "ref":
+                refs.append((table_pos + offset, value))
+            else:
+                struct.pack_into(_SCALARS[kind][0], self.buf, table_pos + offset, value)
+        for field_pos, write_child in refs:
+            child_pos = write_child()
+            struct.pack_into("<I", self.buf, field_pos, child_pos - field_pos)
+        return table_pos
+
+    def vector(self, fmt: str, values: Sequence[Any]) -> int:
+        width = struct.calcsize("<" + fmt)
+        self._pad(max(width, 4), 4)
+        pos = len(self.buf)
+        self.buf += struct.pack(f"<I{len(values)}{fmt}", len(values), *values)
+        return pos
+
+    def bytes_vector(self, data: bytes) -> int:
+        self._pad(4)
+        pos = len(self.buf)
+        self.buf += struct.pack("<I", len(data)) + data
+        return pos
+
+    def string(self, text: str) -> int:
+        data = text.encode("utf-8")
+        self._pad(4)
+        pos = len(self.buf)
+        self.buf += struct.pack("<I", len(data)) + data + b"\x00"
+        return pos
+
+    def table_vector(self, writers: Sequence) -> int:
+        self._pad(4)
+        pos = len(self.buf)
+        self.buf += struct.pack(f"<I{len(writers)}I", len(writers), *([0] * len(writers)))
+        for i, write_child in enumerate(writers):
+            slot_pos = pos + 4 + 4 * i
+            struct.pack_into("<I", self.buf, slot_pos, write_child() - slot_pos)
+        return pos
+
+    def finish(self, root_pos: int) -> bytes:
+        struct.pack_into("<I", self.buf, 0, root_pos)
+        return bytes(self.buf)
+
+
+def _flat_xy(points: Iterable[Sequence[float]]) -> List[float]:
+    xy: List[float] = []
+    for p in points:
+        xy.append(float(p[0]))
+        xy.append(float(p[1]))
+    return xy
+
+
+def _ends(parts: Sequence[Sequence[Any]]) -> Optional[List[int]]:
+    if len(parts) <= 1:
+        return None
+    ends, total = [], 0
+    for part in parts:
+        total += len(part)
+        ends.append(total)
+    return ends
+
+
+def _geometry_writer(b: _Builder, geometry: Dict[str, Any]):
+    geom_type = geometry["type"]
+    coords = geometry.get("coordinates")
+    xy = ends = parts = None
+
+    if geom_type == "Point":
+        xy = _flat_xy([coords]) if coords else []
+    elif geom_type in ("LineString", "MultiPoint"):
+        xy = _flat_xy(coords)
+    elif geom_type in ("Polygon", "MultiLineString"):
+        xy = _flat_xy(p for part in coords for p in part)
+        ends = _ends(coords)
+    elif geom_type == "MultiPolygon":
+        parts = [{"type": "Polygon", "coordinates": polygon} for polygon in coords]
+    elif geom_type == "GeometryCollection":
+        parts = geometry.get("geometries") or []
+    else:
+        raise ValueError(f"Tipo de geometría no soportado: {geom_type}")
+
+    def write() -> int:
+        return b.table(
+            [
+                (0, "ref", ends and (lambda: b.vector("I", ends))),
+                (1, "ref", xy is not None and (lambda: b.vector("d", xy)) or None),
+                (6, "u8", GEOMETRY_TYPES[geom_type]),
+                (
+                    7,
+                    "ref",
+                    parts is not None
+                    and (lambda: b.table_vector([_geometry_writer(b, p) for p in parts]))
+                    or None,
+                ),
+            ]
+        )
+
+    return write
+
+
+def encode_feature(geometry: Dict[str, Any], feature_id: int, version: Optional[int]) -> bytes:
+    """
+    Feature FlatGeobuf (con su prefijo de tamaño) con las columnas id y version.
+    """
+    properties = struct.pack("<Hq", 0, int(feature_id))
+    if version is not None:
+        properties += struct.pack("<Hi", 1, int(version))
+
+    b = _Builder()
+    root = b.table(
+        [
+            (0, "ref", _geometry_writer(b, geometry)),
+            (1, "ref", lambda: b.bytes_vector(properties)),
+        ]
+    )
+    data = b.finish(root)
+    return struct.pack("<I", len(data)) + data
+
+
+def encode_header(
+    name: str, envelope: Optional[BBox], geometry_type: int, features_count: int
+) -> bytes:
+    b = _Builder()
+
+    def column(col_name: str, col_type: int):
+        return lambda: b.table([(0, "ref", lambda: b.string(col_name)), (1, "u8", col_type)])
+
+    root = b.table(
+        [
+            (0, "ref", lambda: b.string(name)),
+            (1, "ref", envelope and (lambda: b.vector("d", list(envelope)))),
+            (2, "u8", geometry_type),
+            (
+                7,
+                "ref",
+                lambda: b.table_vector([column("id", COLUMN_LONG), column("version", COLUMN_INT)]),
+            ),
+            (8, "u64", features_count),
+            (9, "u16", INDEX_NODE_SIZE if features_count else 0),
+            (10, "ref", lambda: b.table([(0, "ref", lambda: b.string("EPSG")), (1, "i32", 4326)])),
+        ]
+    )
+    data = b.finish(root)
+    return struct.pack("<I", len(data)) + data
+
+
+def level_bounds(num_items: int, node_size: int = INDEX_NODE_SIZE) -> List[Tuple[int, int]]:
+    """
+    Rangos [inicio, fin) de cada nivel del R-tree empaquetado, de las hojas a la
+    raíz; la raíz ocupa el nodo 0 y las hojas el final del índice.
+    """
+    n = num_items
+    level_nodes = [n]
+    while True:
+        n = (n + node_size - 1) // node_size
+        level_nodes.append(n)
+        if n == 1:
+            break
+    total = sum(level_nodes)
+    bounds = []
+    for count in level_nodes:
+        total -= count
+        bounds.append((total, total + count))
+    return bounds
+
+
+def index_size(num_items: int, node_size: int = INDEX_NODE_SIZE) -> int:
+    if num_items == 0:
+        return 0
+    return level_bounds(num_items, node_size)[0][1] * NODE_ITEM_SIZE
+
+
+def hilbert(x: int, y: int) -> int:
+    """
+    Índice de Hilbert de 32 bits para (x, y) en una rejilla de 2^16 x 2^16
+    (misma función que la implementación de referencia de FlatGeobuf).
+    """
+    a = x ^ y
+    b = 0xFFFF ^ a
+    c = 0xFFFF ^ (x | y)
+    d = x & (y ^ 0xFFFF)
+    A = a | (b >> 1)
+    B = (a >> 1) ^ a
+    C = ((c >> 1) ^ (b & (d >> 1))) ^ c
+    D = ((a & (c >> 1)) ^ (d >> 1)) ^ d
+
+    a, b, c, d = A, B, C, D
+    A = (a & (a >> 2)) ^ (b & (b >> 2))
+    B = (a & (b >> 2)) ^ (b & ((a ^ b) >> 2))
+    C ^= (a & (c >> 2)) ^ (b & (d >> 2))
+    D ^= (b & (c >> 2)) ^ ((a ^ b) & (d >> 2))
+
+    a, b, c, d = A, B, C, D
+    A = (a & (a >> 4)) ^ (b & (b >> 4))
+    B = (a & (b >> 4)) ^ (b & ((a ^ b) >> 4))
+    C ^= (a & (c >> 4)) ^ (b & (d >> 4))
+    D ^= (b & (c >> 4)) ^ ((a ^ b) & (d >> 4))
+
+    a, b, c, d = A, B, C, D
+    C ^= (a & (c >> 8)) ^ (b & (d >> 8))
+    D ^= (b & (c >> 8)) ^ ((a ^ b) & (d >> 8))
+
+    a = C ^ (C >> 1)
+    b = D ^ (D >> 1)
+
+    i0 = x ^ y
+    i1 = b | (0xFFFF ^ (i0 | a))
+
+    i0 = (i0 | (i0 << 8)) & 0x00FF00FF
+    i0 = (i0 | (i0 << 4)) & 0x0F0F0F0F
+    i0 = (i0 | (i0 << 2)) & 0x33333333
+    i0 = (i0 | (i0 << 1)) & 0x55555555
+
+    i1 = (i1 | (i1 << 8)) & 0x00FF00FF
+    i1 = (i1 | (i1 << 4)) & 0x0F0F0F0F
+    i1 = (i1 | (i1 << 2)) & 0x33333333
+    i1 = (i1 | (i1 << 1)) & 0x55555555
+
+    return ((i1 << 1) | i0) & 0xFFFFFFFF
+
+
+def hilbert_sort(bboxes: Sequence[BBox], extent: BBox) -> List[int]:
+    """
+    Orden (índices) de las features por el valor de Hilbert del centro de su bbox.
+    """
+    max_h = (1 << 16) - 1
+    width = (extent[2] - extent[0]) or 1.0
+    height = (extent[3] - extent[1]) or 1.0
+
+    def key(i: int) -> int:
+        minx, miny, maxx, maxy = bboxes[i]
+        x = math.floor(max_h * ((minx + maxx) / 2 - extent[0]) / width)
+        y = math.floor(max_h * ((miny + maxy) / 2 - extent[1]) / height)
+        return hilbert(x, y)
+
+    return sorted(range(len(bboxes)), key=key, reverse=True)
+
+
+def build_index(bboxes: Sequence[BBox], offsets: Sequence[int]) -> bytes:
+    """
+    R-tree empaquetado: hojas = bbox y offset (en bytes) de cada feature, ya en
+    orden de Hilbert; cada nodo interno guarda el índice de su primer hijo.
+    """
+    bounds = level_bounds(len(bboxes))
+    nodes: List[Tuple[float, float, float, float, int]] = [None] * bounds[0][1]
+    leaf_start = bounds[0][0]
+    for i, (bbox, offset) in enumerate(zip(bboxes, offsets)):
+        nodes[leaf_start + i] = (*bbox, offset)
+
+    for level in range(len(bounds) - 1):
+        pos, end = bounds[level]
+        new_pos = bounds[level + 1][0]
+        while pos < end:
+            first = pos
+            minx = miny = math.inf
+            maxx = maxy = -math.inf
+            for _ in range(INDEX_NODE_SIZE):
+                if pos >= end:
+                    break
+                n = nodes[pos]
+                minx, miny = min(minx, n[0]), min(miny, n[1])
+                maxx, maxy = max(maxx, n[2]), max(maxy, n[3])
+                pos += 1
+            nodes[new_pos] = (minx, miny, maxx, maxy, first)
+            new_pos += 1
+
+    return b"".join(_NODE.pack(*n) for n in nodes)
+
+
+def read_leaves(f: BinaryIO, num_items: int) -> Tuple[List[BBox], List[int], int]:
+    """
+    Lee de un fichero escrito por write_flatgeobuf las hojas del índice
+    (bbox y offset de cada feature) y la posición donde empiezan las features.
+    """
+    f.seek(len(MAGIC))
+    (header_size,) = struct.unpack("<I", f.read(4))
+    index_start = len(MAGIC) + 4 + header_size
+    features_start = index_start + index_size(num_items)
+    if num_items == 0:
+        return [], [], features_start
+
+    leaf_start = level_bounds(num_items)[0][0]
+    f.seek(index_start + leaf_start * NODE_ITEM_SIZE)
+    data = f.read(num_items * NODE_ITEM_SIZE)
+    bboxes, offsets = [], []
+    for minx, miny, maxx, maxy, offset in _NODE.iter_unpack(data):
+        bboxes.append((minx, miny, maxx, maxy))
+        offsets.append(offset)
+    return bboxes, offsets, features_start
+
+
+def write_flatgeobuf(
+    out: BinaryIO,
+    name: str,
+    geometry_type: int,
+    entries: Sequence[Tuple[BBox, BinaryIO, int, int]],
+) -> List[int]:
+    """
+    Escribe el fichero completo a partir de features ya codificadas.
+    entries: (bbox, fichero_origen, offset, longitud) de cada feature.
+    Devuelve el orden de Hilbert aplicado (índices de entries).
+    """
+    bboxes = [e[0] for e in entries]
+    extent = None
+    for bbox in bboxes:
+        extent = bbox if extent is None else (
+            min(extent[0], bbox[0]),
+            min(extent[1], bbox[1]),
+            max(extent[2], bbox[2]),
+            max(extent[3], bbox[3]),
+        )
+
+    order = hilbert_sort(bboxes, extent) if entries else []
+    offsets, position = [], 0
+    for i in order:
+        offsets.append(position)
+        position += entries[i][3]
+
+    out.write(MAGIC)
+    out.write(encode_header(name, extent, geometry_type, len(entries)))
+    if entries:
+        out.write(build_index([bboxes[i] for i in order], offsets))
+    for i in order:
+        _, source, offset, length = entries[i]
+        source.seek(offset)
+        out.write(source.read(length))
+    return order
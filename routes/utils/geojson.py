@@ -0,0 +1,125 @@
+from typing import Annotated, Any, Dict, List, Literal, Optional, Union
+
+from pydantic import ConfigDict, Field, TypeAdapter, with_config
+from typing_extensions import NotRequired, TypedDict
+
+# Validación rápida de envíos grandes: TypedDicts + TypeAdapter compilados una vez.
+# pydantic-core valida directamente desde los bytes JSON y devuelve dicts/listas
+# sin construir un BaseModel por feature.
+
+Position = Annotated[List[float], Field(min_length=2, max_length=4)]
+LinearRing = Annotated[List[Position], Field(min_length=4)]
+
+_STRICT = ConfigDict(strict=True)
+
+
+@with_config(_STRICT)
+class PointGeometry(TypedDict):
+    type: Literal["Point"]
+    coordinates: Position
+
+
+@with_config(_STRICT)
+class MultiPointGeometry(TypedDict):
+    type: Literal["MultiPoint"]
+    coordinates: List[Position]
+
+
+@with_config(_STRICT)
+class LineStringGeometry(TypedDict):
+    type: Literal["LineString"]
+    coordinates: Annotated[List[Position], Field(min_length=2)]
+
+
+@with_config(_STRICT)
+class MultiLineStringGeometry(TypedDict):
+    type: Literal["MultiLineString"]
+    coordinates: List[Annotated[List[Position], Field(min_length=2)]]
+
+
+@with_config(_STRICT)
+class PolygonGeometry(TypedDict):
+    type: Literal["Polygon"]
+    coordinates: List[LinearRing]
+
+
+@with_config(_STRICT)
+class MultiPolygonGeometry(TypedDict):
+    type: Literal["MultiPolygon"]
+    coordinates: List[List[LinearRing]]
+
+
+@with_config(_STRICT)
+class GeometryCollectionGeometry(TypedDict):
+    type: Literal["GeometryCollection"]
+    geometries: List["Geometry"]
+
+
+Geometry = Annotated[
+    Union[
+        PointGeometry,
+        MultiPointGeometry,
+        LineStringGeometry,
+        MultiLineStringGeometry,
+        PolygonGeometry,
+        MultiPolygonGeometry,
+        GeometryCollectionGeometry,
+    ],
+    Field(discriminator="type"),
+]
+
+
+class FeatureIn(TypedDict):
+    geometry: Geometry
+    properties: NotRequired[Optional[Dict[str, Any]]]
+    id: NotRequired[Any]
+
+
+class UploadEnvelope(TypedDict):
+    layer_name: str
+    project_id: NotRequired[Optional[int]]
+    features: List[FeatureIn]
+    dedupe_tolerance_m: NotRequired[Optional[float]]
+
+
+class ChunkEnvelope(TypedDict):
+    features: List[FeatureIn]
+
+
+upload_adapter = TypeAdapter(UploadEnvelope)
+chunk_adapter = TypeAdapter(ChunkEnvelope)
+# Validación feature a feature (importación de ficheros: una feature inválida no descarta el lote)
+feature_adapter = TypeAdapter(FeatureIn)
+
+# Esquemas de los TypedDict para components/schemas del OpenAPI (los añade server.py)
+OPENAPI_SCHEMAS: Dict[str, Any] = {}
+
+
+def openapi_request_body(adapter: TypeAdapter, name: str) -> Dict[str, Any]:
+    """
+    openapi_extra para rutas que validan el cuerpo con validate_payload: sin
+    parámetro de cuerpo FastAPI no lo documenta, así que se declara a mano
+    con el esquema JSON del TypeAdapter.
+    """
+    schema = adapter.json_schema(ref_template="#/components/schemas/{model}")
+    OPENAPI_SCHEMAS.update(schema.pop("$defs", {}))
+    OPENAPI_SCHEMAS[name] = schema
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {
+                "application/json": {"schema": {"$ref": f"#/components/schemas/{name}"}}
+            },
+        }
+    }
+
+
+def validate_payload(adapter: TypeAdapter, payload: Union[bytes, Any]) -> Any:
+    """
+    Valida bytes JSON (camino rápido) u objetos ya decodificados (msgpack).
+    Lanza ValidationError como cualquier modelo pydantic.
+    """
+    if isinstance(payload, (bytes, bytearray)):
+        return adapter.validate_json(payload)
+    return adapter.validate_python(payload)
+
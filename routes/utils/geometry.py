@@ -0,0 +1,228 @@
+import hashlib
+import json
+import math
+import struct
+from typing import Any, Dict, Iterator, Tuple
+
+# Metros por grado de latitud (aproximación esférica, suficiente para tolerancias cortas)
+METERS_PER_DEGREE = 111320.0
+
+BBox = Tuple[float, float, float, float]
+
+
+def iter_coords(geometry: Dict[str, Any]) -> Iterator[Tuple[float, float]]:
+    """
+    Recorre todos los vértices (x, y) de una geometría GeoJSON,
+    sea simple, Multi-* o GeometryCollection.
+    """
+    if not geometry:
+        return
+    if geometry.get("type") == "GeometryCollection":
+        for part in geometry.get("geometries") or []:
+            yield from iter_coords(part)
+        return
+
+    stack = [geometry.get("coordinates")]
+    while stack:
+        item = stack.pop()
+        if not item:
+            continue
+        if isinstance(item[0], (int, float)):
+            yield float(item[0]), float(item[1])
+        else:
+            stack.extend(reversed(item))
+
+
+def geometry_bbox(geometry: Dict[str, Any]) -> BBox | None:
+    xs, ys = [], []
+    for x, y in iter_coords(geometry):
+        xs.append(x)
+        ys.append(y)
+    if not xs:
+        return None
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def bbox_union(a: BBox | None, b: BBox | None) -> BBox | None:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+
+def meters_to_degrees(meters: float, latitude: float = 0.0) -> Tuple[float, float]:
+    """
+    Convierte una distancia en metros a (grados_x, grados_y) en la latitud dada.
+    """
+    dy = meters / METERS_PER_DEGREE
+    cos_lat = max(math.cos(math.radians(latitude)), 1e-6)
+    return dy / cos_lat, dy
+
+
+def hausdorff_distance_m(a: Dict[str, Any], b: Dict[str, Any]) -> float:
+    """
+    Distancia de Hausdorff discreta (sobre vértices) entre dos geometrías
+    EPSG:4326, expresada en metros con una proyección equirectangular local.
+    """
+    pts_a = list(iter_coords(a))
+    pts_b = list(iter_coords(b))
+    if not pts_a or not pts_b:
+        return math.inf
+
+    lat = (pts_a[0][1] + pts_b[0][1]) / 2
+    kx = METERS_PER_DEGREE * math.cos(math.radians(lat))
+    ky = METERS_PER_DEGREE
+    pa = [(x * kx, y * ky) for x, y in pts_a]
+    pb = [(x * kx, y * ky) for x, y in pts_b]
+
+    def directed(src, dst):
+        worst = 0.0
+        for sx, sy in src:
+            best = math.inf
+            for dx, dy in dst:
+                d = (sx - dx) ** 2 + (sy - dy) ** 2
+                if d < best:
+                    best = d
+                    if best <= worst:
+                        # No puede superar el máximo actual, se descarta pronto
+                        break
+            if best > worst:
+                worst = best
+        return worst
+
+    return math.sqrt(max(directed(pa, pb), directed(pb, pa)))
+
+
+_WKB_TYPES = {
+    1: "Point",
+    2: "LineString",
+    3: "Polygon",
+    4: "MultiPoint",
+    5: "MultiLineString",
+    6: "MultiPolygon",
+    7: "GeometryCollection",
+}
+
+
+def wkb_to_geojson(data: bytes) -> Dict[str, Any]:
+    """
+    Convierte WKB (ISO o EWKB, con Z/M opcionales) a un dict GeoJSON.
+    La coordenada M se descarta; Z se conserva como tercera coordenada.
+    """
+    geometry, _ = _read_wkb(memoryview(data), 0)
+    return geometry
+
+
+def _read_wkb(buf: memoryview, offset: int) -> Tuple[Dict[str, Any], int]:
+    byte_order = "<" if buf[offset] == 1 else ">"
+    offset += 1
+    (type_code,) = struct.unpack_from(byte_order + "I", buf, offset)
+    offset += 4
+
+    # EWKB: flags en los bits altos
+    has_z = bool(type_code & 0x80000000)
+    has_m = bool(type_code & 0x40000000)
+    if type_code & 0x20000000:
+        offset += 4  # SRID
+    type_code &= 0x0FFFFFFF
+    # ISO: 1000 = Z, 2000 = M, 3000 = ZM
+    dims_code, base = divmod(type_code, 1000)
+    has_z = has_z or dims_code in (1, 3)
+    has_m = has_m or dims_code in (2, 3)
+
+    geom_type = _WKB_TYPES.get(base)
+    if geom_type is None:
+        raise ValueError(f"Tipo WKB no soportado: {type_code}")
+
+    ndims = 2 + has_z + has_m
+    point_fmt = byte_order + "d" * ndims
+    point_size = 8 * ndims
+    keep = 3 if has_z else 2
+
+    def read_points(count):
+        nonlocal offset
+        values = struct.unpack_from(byte_order + "d" * (ndims * count), buf, offset)
+        offset += point_size * count
+        return [list(values[i : i + keep]) for i in range(0, len(values), ndims)]
+
+    def read_count():
+        nonlocal offset
+        (count,) = struct.unpack_from(byte_order + "I", buf, offset)
+        offset += 4
+        return count
+
+    if geom_type == "Point":
+        coords = list(struct.unpack_from(point_fmt, buf, offset)[:keep])
+        offset += point_size
+        if all(math.isnan(c) for c in coords):
+            coords = []
+        return {"type": "Point", "coordinates": coords}, offset
+    if geom_type == "LineString":
+        return {"type": geom_type, "coordinates": read_points(read_count())}, offset
+    if geom_type == "Polygon":
+        rings = [read_points(read_count()) for _ in range(read_count())]
+        return {"type": geom_type, "coordinates": rings}, offset
+
+    parts = []
+    for _ in range(read_count()):
+        part, offset = _read_wkb(buf, offset)
+        parts.append(part)
+    if geom_type == "GeometryCollection":
+        return {"type": geom_type, "geometries": parts}, offset
+    return {"type": geom_type, "coordinates": [p["coordinates"] for p in parts]}, offset
+
+
+# Decimales con los que se normalizan las coordenadas antes de calcular el hash
+HASH_PRECISION = 9
+
+
+def geometry_hash(geometry: Dict[str, Any]) -> str:
+    """
+    Hash canónico de una geometría GeoJSON (64 bits en hex).
+
+    Coordenadas redondeadas a HASH_PRECISION decimales y siempre como float,
+    para que el plugin (asJson/WKB) y el servidor obtengan el mismo valor.
+    El plugin tiene una copia de esta función: cualquier cambio debe hacerse en ambos.
+    """
+
+    def normalize(value):
+        if isinstance(value, (list, tuple)):
+            return [normalize(v) for v in value]
+        return float(round(value, HASH_PRECISION))
+
+    if geometry.get("type") == "GeometryCollection":
+        canonical = [geometry_hash(g) for g in geometry.get("geometries") or []]
+    else:
+        canonical = normalize(geometry.get("coordinates") or [])
+    raw = json.dumps([geometry.get("type"), canonical], separators=(",", ":"))
+    return hashlib.sha1(raw.encode()).hexdigest()[:16]
+
+
+# Niveles de detalle precalculados al insertar (columnas geom_lod1..3 en la tabla QGIS).
+# Tolerancia de simplificación en grados (EPSG:4326); el nivel 0 es la geometría original.
+LOD_TOLERANCES = (0.0, 0.00001, 0.0001, 0.001)
+
+# Tamaño de píxel estándar OGC (0.28 mm) para pasar de escala a metros por píxel
+OGC_PIXEL_SIZE_M = 0.00028
+
+
+def pixel_size_degrees(scale: float) -> float:
+    """
+    Tamaño en grados de un píxel de pantalla a la escala dada (denominador, p.ej. 50000).
+    """
+    return scale * OGC_PIXEL_SIZE_M / METERS_PER_DEGREE
+
+
+def lod_for_scale(scale: float | None) -> int:
+    """
+    Nivel de detalle más simplificado cuyo error sigue siendo menor que un píxel.
+    """
+    if not scale:
+        return 0
+    pixel = pixel_size_degrees(scale)
+    level = 0
+    for i, tolerance in enumerate(LOD_TOLERANCES):
+        if tolerance <= pixel:
+            level = i
+    return level
@@ -0,0 +1,115 @@
+import os
+from typing import Any, Dict, Optional
+
+import httpx
+
+from .http_pool import get_http_client
+
+# Llamadas directas a la API REST de Supabase Auth (GoTrue), sin estado: cada
+# petición lleva sus propios tokens, así que los logins concurrentes no se pisan
+# la sesión como ocurría con el cliente global supabase_client.auth
+GOTRUE_URL = f"{os.getenv('SUPABASE_URL', '').rstrip('/')}/auth/v1"
+SUPABASE_ANON_KEY = os.getenv("SUPABASE_ANON_KEY")
+GOTRUE_TIMEOUT_SECONDS = float(os.getenv("GOTRUE_TIMEOUT_SECONDS", 10))
+# Retry-After de un 429 de GoTrue cuando no trae la cabecera
+GOTRUE_DEFAULT_RETRY_AFTER_SECONDS = 60
+# error_code (o error, en versiones antiguas) de un login con email o contraseña incorrectos
+INVALID_CREDENTIALS_CODES = ("invalid_credentials", "invalid_grant")
+
+
+class GoTrueError(Exception):
+    """
+    Respuesta de error de GoTrue: status HTTP, error_code (si lo trae) y, en
+    los 429, los segundos de Retry-After.
+    """
+
+    def __init__(
+        self,
+        status: int,
+        message: str,
+        code: Optional[str] = None,
+        retry_after: Optional[int] = None,
+    ):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+        self.retry_after = retry_after
+
+    @property
+    def invalid_credentials(self) -> bool:
+        return self.status in (400, 401) and self.code in INVALID_CREDENTIALS_CODES
+
+
+async def _post(
+    path: str,
+    params: Optional[Dict[str, str]] = None,
+    json: Optional[Dict[str, Any]] = None,
+    access_token: Optional[str] = None,
+) -> Optional[Dict[str, Any]]:
+    headers = {"apikey": SUPABASE_ANON_KEY}
+    if access_token:
+        headers["Authorization"] = f"Bearer {access_token}"
+    try:
+        response = await get_http_client().post(
+            f"{GOTRUE_URL}{path}",
+            params=params,
+            json=json,
+            headers=headers,
+            timeout=GOTRUE_TIMEOUT_SECONDS,
+        )
+    except httpx.HTTPError as e:
+        raise GoTrueError(503, f"Supabase Auth no disponible: {type(e).__name__}: {e}")
+
+    if response.status_code >= 400:
+        try:
+            body = response.json()
+        except ValueError:
+            body = {}
+        message = (
+            body.get("error_description")
+            or body.get("msg")
+            or body.get("message")
+            or response.text
+        )
+        retry_after = None
+        if response.status_code == 429:
+            header = response.headers.get("retry-after", "")
+            retry_after = int(header) if header.isdigit() else GOTRUE_DEFAULT_RETRY_AFTER_SECONDS
+        raise GoTrueError(
+            response.status_code,
+            message,
+            code=body.get("error_code") or body.get("error"),
+            retry_after=retry_after,
+        )
+    return response.json() if response.content else None
+
+
+async def password_grant(email: str, password: str) -> Dict[str, Any]:
+    """
+    Login con email y contraseña. Devuelve la sesión:
+    {access_token, refresh_token, expires_in, user: {id, ...}, ...}.
+    """
+    return await _post(
+        "/token",
+        params={"grant_type": "password"},
+        json={"email": email, "password": password},
+    )
+
+
+async def refresh_grant(refresh_token: str) -> Dict[str, Any]:
+    """
+    Nueva sesión a partir del refresh token (que queda consumido).
+    """
+    return await _post(
+        "/token",
+        params={"grant_type": "refresh_token"},
+        json={"refresh_token": refresh_token},
+    )
+
+
+async def revoke(access_token: str, scope: str = "local") -> None:
+    """
+    Cierra la sesión del token: revoca sus refresh tokens ("local" = solo esta
+    sesión, "global" = todas las del usuario).
+    """
+    await _post("/logout", params={"scope": scope}, access_token=access_token)
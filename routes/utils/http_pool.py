@@ -0,0 +1,92 @@
+import os
+from typing import Any, Dict, Optional
+
+import httpx
+
+from .metrics import rpc_tracer
+
+# Pool HTTP/2 asíncrono compartido por todos los clientes de Supabase del servidor.
+# Con HTTP/2 cada conexión multiplexa muchas peticiones a la vez, así que pocas
+# conexiones bastan para miles de RPC en vuelo desde el event loop
+HTTP_POOL_MAX_CONNECTIONS = int(os.getenv("HTTP_POOL_MAX_CONNECTIONS", 50))
+HTTP_POOL_MAX_KEEPALIVE = int(os.getenv("HTTP_POOL_MAX_KEEPALIVE", 50))
+HTTP_POOL_KEEPALIVE_SECONDS = float(os.getenv("HTTP_POOL_KEEPALIVE_SECONDS", 60))
+# Mismo timeout que el cliente PostgREST por defecto de supabase-py
+HTTP_POOL_TIMEOUT_SECONDS = float(os.getenv("HTTP_POOL_TIMEOUT_SECONDS", 120))
+
+
+class ConnectionStats:
+    """
+    Contadores de reutilización de conexiones a partir de los eventos de
+    trazas de httpcore: cada petición que no abre conexión TCP reutiliza una
+    del pool (con HTTP/2, varias peticiones comparten conexión a la vez).
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.connections_opened = 0
+        self.tls_handshakes = 0
+
+    async def trace(self, event_name: str, info: Dict[str, Any]) -> None:
+        if event_name.endswith("send_request_headers.started"):
+            field = "requests"
+        elif event_name == "connection.connect_tcp.complete":
+            field = "connections_opened"
+        elif event_name == "connection.start_tls.complete":
+            field = "tls_handshakes"
+        else:
+            return
+        setattr(self, field, getattr(self, field) + 1)
+
+    def snapshot(self) -> Dict[str, Any]:
+        requests, opened = self.requests, self.connections_opened
+        return {
+            "requests": requests,
+            "connections_opened": opened,
+            "tls_handshakes": self.tls_handshakes,
+            "connections_reused": max(requests - opened, 0),
+            "reuse_ratio": round(1 - opened / requests, 4) if requests else None,
+        }
+
+
+connection_stats = ConnectionStats()
+
+
+async def _attach_trace(request: httpx.Request) -> None:
+    # Reutilización de conexiones + latencia por RPC (/metrics)
+    request.extensions["trace"] = rpc_tracer(request, on_event=connection_stats.trace)
+
+
+async def _record_status(response: httpx.Response) -> None:
+    response.request.extensions["rpc_status"] = str(response.status_code)
+
+
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Pool del proceso. Se crea en el primer uso (no al importar el módulo) y
+    se cierra en el lifespan del servidor con close_http_client.
+    """
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            http2=True,
+            timeout=HTTP_POOL_TIMEOUT_SECONDS,
+            follow_redirects=True,
+            limits=httpx.Limits(
+                max_connections=HTTP_POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_POOL_MAX_KEEPALIVE,
+                keepalive_expiry=HTTP_POOL_KEEPALIVE_SECONDS,
+            ),
+            event_hooks={"request": [_attach_trace], "response": [_record_status]},
+        )
+    return _http_client
+
+
+async def close_http_client() -> None:
+    global _http_client
+    client, _http_client = _http_client, None
+    if client is not None:
+        await client.aclose()
@@ -0,0 +1,189 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from fastapi import HTTPException
+
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", 24 * 3600))
+# Claves compartidas por todos los workers de uvicorn de la máquina (fichero SQLite)
+IDEMPOTENCY_DB = os.getenv(
+    "IDEMPOTENCY_DB", os.path.join(tempfile.gettempdir(), "bridge_idempotency.sqlite3")
+)
+# Una ejecución "en curso" más antigua que esto se da por abandonada (worker caído)
+IDEMPOTENCY_CLAIM_TIMEOUT_SECONDS = float(os.getenv("IDEMPOTENCY_CLAIM_TIMEOUT_SECONDS", 600))
+# Cada cuánto se consulta una clave que está procesando otra petición
+IDEMPOTENCY_POLL_SECONDS = 0.2
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    scope TEXT NOT NULL,
+    key TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    result TEXT,
+    claimed_at REAL NOT NULL,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (scope, key)
+) WITHOUT ROWID;
+"""
+
+
+def fingerprint(body: bytes) -> str:
+    return hashlib.sha256(body).hexdigest()
+
+
+def payload_fingerprint(payload: Dict[str, Any], list_field: str = "features") -> str:
+    """
+    Fingerprint del contenido ya decodificado: no depende de la codificación
+    (JSON, msgpack, gzip), del orden de las claves ni del orden de payload[list_field],
+    igual que la clave que deriva el plugin de QGIS de ese mismo contenido.
+    """
+    items = sorted(
+        json.dumps(item, sort_keys=True, separators=(",", ":"), default=str)
+        for item in payload.get(list_field) or []
+    )
+    rest = {k: v for k, v in payload.items() if k != list_field}
+    raw = json.dumps([rest, items], sort_keys=True, separators=(",", ":"), default=str)
+    return fingerprint(raw.encode("utf-8"))
+
+
+class IdempotencyStore:
+    """
+    Guarda el resultado de cada petición identificada por (usuario, Idempotency-Key)
+    en un fichero SQLite (modo WAL) compartido entre los workers: un reintento
+    puede llegar a un proceso distinto del que atendió la primera petición.
+
+    - Repetición con el mismo fingerprint: devuelve el resultado guardado.
+    - Repetición mientras la primera sigue en curso (en cualquier worker):
+      espera a ese mismo resultado.
+    - Misma clave con otro cuerpo: 422.
+    - Si la primera ejecución falla, la clave se libera para poder reintentar.
+
+    Los resultados se guardan como JSON.
+    """
+
+    def __init__(self, path: str = IDEMPOTENCY_DB, ttl: float = IDEMPOTENCY_TTL_SECONDS):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def claim(self, scope: str, key: str, request_fingerprint: str) -> Tuple[str, Any]:
+        """
+        Reclama la clave. Devuelve:
+        ("claimed", None)         -> la ejecuta esta petición
+        ("committed", resultado)  -> ya se ejecutó con el mismo cuerpo
+        ("in_flight", None)       -> la está ejecutando otra petición
+        ("mismatch", None)        -> la clave se usó con otro cuerpo
+        """
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM idempotency_keys WHERE expires_at <= ?", (now,))
+            row = conn.execute(
+                "SELECT fingerprint, result, claimed_at FROM idempotency_keys"
+                " WHERE scope = ? AND key = ?",
+                (scope, key),
+            ).fetchone()
+            if row is not None:
+                stored_fingerprint, result, claimed_at = row
+                if stored_fingerprint != request_fingerprint:
+                    return "mismatch", None
+                if result is not None:
+                    return "committed", json.loads(result)
+                if claimed_at > now - IDEMPOTENCY_CLAIM_TIMEOUT_SECONDS:
+                    return "in_flight", None
+            conn.execute(
+                "INSERT OR REPLACE INTO idempotency_keys"
+                " (scope, key, fingerprint, result, claimed_at, expires_at)"
+                " VALUES (?, ?, ?, NULL, ?, ?)",
+                (scope, key, request_fingerprint, now, now + self.ttl),
+            )
+            return "claimed", None
+        finally:
+            conn.execute("COMMIT")
+
+    def commit(self, scope: str, key: str, result: Any) -> None:
+        self._conn().execute(
+            "UPDATE idempotency_keys SET result = ? WHERE scope = ? AND key = ?",
+            (json.dumps(result), scope, key),
+        )
+
+    def release(self, scope: str, key: str) -> None:
+        self._conn().execute(
+            "DELETE FROM idempotency_keys WHERE scope = ? AND key = ? AND result IS NULL",
+            (scope, key),
+        )
+
+    def result(self, scope: str, key: str) -> Tuple[str, Any]:
+        """
+        Estado de una clave reclamada por otra petición: "committed" (con su
+        resultado), "in_flight" o "released" (falló o se abandonó).
+        """
+        row = self._conn().execute(
+            "SELECT result, claimed_at FROM idempotency_keys WHERE scope = ? AND key = ?",
+            (scope, key),
+        ).fetchone()
+        if row is None or (
+            row[0] is None and row[1] <= time.time() - IDEMPOTENCY_CLAIM_TIMEOUT_SECONDS
+        ):
+            return "released", None
+        if row[0] is not None:
+            return "committed", json.loads(row[0])
+        return "in_flight", None
+
+    async def run(
+        self,
+        scope: str,
+        key: str,
+        request_fingerprint: str,
+        func: Callable[[], Awaitable[Any]],
+    ) -> Tuple[Any, bool]:
+        """
+        Ejecuta func una sola vez por clave entre todos los workers.
+        Devuelve (resultado, replayed).
+        """
+        while True:
+            state, result = await asyncio.to_thread(self.claim, scope, key, request_fingerprint)
+            if state == "mismatch":
+                raise HTTPException(
+                    status_code=422,
+                    detail="Idempotency-Key reutilizada con un cuerpo de petición distinto",
+                )
+            if state == "committed":
+                return result, True
+            if state == "claimed":
+                break
+            # Otra petición (quizá en otro worker) la está ejecutando: se espera a su resultado
+            while state == "in_flight":
+                await asyncio.sleep(IDEMPOTENCY_POLL_SECONDS)
+                state, result = await asyncio.to_thread(self.result, scope, key)
+            if state == "committed":
+                return result, True
+            # "released": la otra petición falló; se vuelve a intentar reclamarla
+
+        try:
+            result = await func()
+        except BaseException:
+            await asyncio.to_thread(self.release, scope, key)
+            raise
+        await asyncio.to_thread(self.commit, scope, key, result)
+        return result, False
+
+
+upload_idempotency = IdempotencyStore()
@@ -0,0 +1,293 @@
+import asyncio
+import json
+import os
+import re
+import sqlite3
+import tempfile
+from typing import Any, AsyncIterator, BinaryIO, Callable, Dict, Iterator, Optional, Tuple
+
+from fastapi import HTTPException
+
+from .body_codec import check_content_encoding, iter_decompressed
+from .geometry import wkb_to_geojson
+
+try:
+    import ijson  # opcional: parser JSON incremental en C
+except ImportError:
+    ijson = None
+
+# Tamaño máximo del fichero importado (ya descomprimido)
+IMPORT_MAX_BYTES = int(os.getenv("IMPORT_MAX_BYTES", 10 * 1024 * 1024 * 1024))
+# Features leídas y validadas por tramo antes de pasarlas al write buffer
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", 2000))
+# Directorio de los ficheros temporales (por defecto el del sistema)
+IMPORT_TMP_DIR = os.getenv("IMPORT_TMP_DIR") or None
+# Tamaño máximo de una feature en el parser en Python puro: si el buffer crece
+# más sin completar una feature, el GeoJSON se da por inválido
+IMPORT_MAX_FEATURE_BYTES = int(os.getenv("IMPORT_MAX_FEATURE_BYTES", 64 * 1024 * 1024))
+
+_READ_SIZE = 1024 * 1024
+_FEATURES_RE = re.compile(rb'"features"\s*:\s*\[')
+_DECODER = json.JSONDecoder()
+
+
+class ImportFormatError(ValueError):
+    pass
+
+
+async def spool_to_tempfile(
+    stream: AsyncIterator[bytes], encoding: str, suffix: str
+) -> Tuple[str, int]:
+    """
+    Vuelca el cuerpo de la petición a un fichero temporal según llega.
+    Con Content-Encoding se guarda primero tal cual y después se descomprime
+    en un hilo por bloques acotados (iter_decompressed), comprobando
+    IMPORT_MAX_BYTES antes de escribir cada uno: un cuerpo pequeño que se
+    expande a GB no llega a pasar por memoria. Devuelve (ruta, bytes escritos).
+    """
+    encoding = check_content_encoding(encoding)
+    fd, path = tempfile.mkstemp(suffix=suffix, dir=IMPORT_TMP_DIR)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            size = await _write_stream(f, stream)
+    except BaseException:
+        os.unlink(path)
+        raise
+    if encoding in ("", "identity"):
+        return path, size
+
+    fd, decoded_path = tempfile.mkstemp(suffix=suffix, dir=IMPORT_TMP_DIR)
+    os.close(fd)
+    try:
+        size = await asyncio.to_thread(_decompress_file, path, decoded_path, encoding)
+    except BaseException:
+        os.unlink(decoded_path)
+        raise
+    finally:
+        os.unlink(path)
+    return decoded_path, size
+
+
+def _too_large() -> HTTPException:
+    return HTTPException(status_code=413, detail=f"El fichero supera {IMPORT_MAX_BYTES} bytes")
+
+
+async def _write_stream(f: BinaryIO, stream: AsyncIterator[bytes]) -> int:
+    size = 0
+    pending = bytearray()
+    async for chunk in stream:
+        if size + len(pending) + len(chunk) > IMPORT_MAX_BYTES:
+            raise _too_large()
+        pending += chunk
+        if len(pending) >= _READ_SIZE:
+            await asyncio.to_thread(f.write, bytes(pending))
+            size += len(pending)
+            pending.clear()
+    await asyncio.to_thread(f.write, bytes(pending))
+    return size + len(pending)
+
+
+def _decompress_file(src: str, dst: str, encoding: str) -> int:
+    size = 0
+    with open(src, "rb") as source, open(dst, "wb") as target:
+        for chunk in iter_decompressed(source, encoding):
+            size += len(chunk)
+            if size > IMPORT_MAX_BYTES:
+                raise _too_large()
+            target.write(chunk)
+    return size
+
+
+def iter_geojson_features(
+    fileobj: BinaryIO, on_read: Optional[Callable[[int], None]] = None
+) -> Iterator[Dict[str, Any]]:
+    """
+    Recorre las features de un FeatureCollection GeoJSON sin cargar el fichero
+    entero: con ijson si está instalado, si no con un lector incremental propio
+    que decodifica feature a feature desde un buffer acotado.
+    on_read(bytes_leídos) permite informar del progreso.
+    """
+    if ijson is not None:
+        reader = _CountingReader(fileobj, on_read)
+        try:
+            yield from ijson.items(reader, "features.item", use_float=True)
+        except ijson.JSONError as e:
+            raise ImportFormatError(f"GeoJSON inválido: {e}")
+        return
+
+    buffer = b""
+    consumed = 0
+
+    def fill() -> bool:
+        nonlocal buffer, consumed
+        chunk = fileobj.read(_READ_SIZE)
+        if not chunk:
+            return False
+        consumed += len(chunk)
+        if on_read is not None:
+            on_read(consumed)
+        buffer += chunk
+        return True
+
+    # 1. Buscar el inicio del array "features"
+    while True:
+        match = _FEATURES_RE.search(buffer)
+        if match:
+            buffer = buffer[match.end() :]
+            break
+        # Conservar la cola por si la clave queda partida entre dos lecturas
+        buffer = buffer[-64:]
+        if not fill():
+            raise ImportFormatError("No se encontró el array 'features' en el GeoJSON")
+
+    # 2. Decodificar cada feature del array
+    text = ""
+    pos = 0
+    while True:
+        # Saltar separadores
+        while True:
+            while pos < len(text) and text[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(text):
+                break
+            text, buffer = _decode_utf8_prefix(buffer)
+            pos = 0
+            if not text and not fill():
+                raise ImportFormatError("GeoJSON truncado: falta cerrar el array 'features'")
+
+        if text[pos] == "]":
+            return
+
+        try:
+            feature, end = _DECODER.raw_decode(text, pos)
+        except json.JSONDecodeError as e:
+            # Feature incompleta en el buffer: leer más y reintentar, salvo que
+            # ya ocupe más de lo que puede ocupar una feature (JSON inválido:
+            # seguir leyendo solo haría crecer el buffer hasta el final del fichero)
+            if len(text) - pos > IMPORT_MAX_FEATURE_BYTES:
+                raise ImportFormatError(
+                    f"GeoJSON inválido o feature mayor que {IMPORT_MAX_FEATURE_BYTES} bytes: {e}"
+                )
+            if not fill():
+                raise ImportFormatError("GeoJSON truncado o inválido")
+            more, buffer = _decode_utf8_prefix(buffer)
+            text, pos = text[pos:] + more, 0
+            continue
+
+        yield feature
+        pos = end
+        if pos > _READ_SIZE:
+            text, pos = text[pos:], 0
+
+
+def _decode_utf8_prefix(data: bytes):
+    """
+    Decodifica todo lo posible sin partir un carácter UTF-8; devuelve (texto, resto).
+    """
+    for cut in range(len(data), max(len(data) - 4, -1), -1):
+        try:
+            return data[:cut].decode("utf-8"), data[cut:]
+        except UnicodeDecodeError:
+            continue
+    raise ImportFormatError("El GeoJSON no es UTF-8 válido")
+
+
+class _CountingReader:
+    def __init__(self, fileobj: BinaryIO, on_read: Optional[Callable[[int], None]]):
+        self.fileobj = fileobj
+        self.on_read = on_read
+        self.consumed = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.fileobj.read(size)
+        self.consumed += len(data)
+        if self.on_read is not None:
+            self.on_read(self.consumed)
+        return data
+
+
+# GeoPackage: cabecera de la geometría (ver especificación OGC GPKG, 2.1.3)
+_GPKG_ENVELOPE_SIZES = {0: 0, 1: 32, 2: 48, 3: 48, 4: 64}
+
+
+def gpkg_geometry_to_geojson(blob: bytes) -> Optional[Dict[str, Any]]:
+    if blob is None:
+        return None
+    if blob[:2] != b"GP":
+        raise ImportFormatError("Geometría GeoPackage sin cabecera GP")
+    flags = blob[3]
+    if flags & 0b10000:  # geometría vacía
+        return None
+    envelope = _GPKG_ENVELOPE_SIZES.get((flags >> 1) & 0b111)
+    if envelope is None:
+        raise ImportFormatError("Cabecera GeoPackage con envelope inválido")
+    # magic(2) + versión(1) + flags(1) + srs_id(4) + envelope
+    return wkb_to_geojson(blob[8 + envelope :])
+
+
+class GeoPackageLayer:
+    """
+    Capa de features de un GeoPackage (SQLite), leída por lotes con fetchmany.
+    Solo se admite EPSG:4326: no se reproyecta en el servidor.
+    """
+
+    def __init__(self, path: str, layer: Optional[str] = None):
+        with open(path, "rb") as f:
+            if f.read(16) != b"SQLite format 3\x00":
+                raise ImportFormatError("El fichero no es un GeoPackage")
+        # La conexión se abre y se recorre desde hilos distintos (asyncio.to_thread)
+        self.conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        try:
+            row = self.conn.execute(
+                """
+                SELECT c.table_name, g.column_name, s.organization, s.organization_coordsys_id
+                FROM gpkg_contents c
+                JOIN gpkg_geometry_columns g ON g.table_name = c.table_name
+                LEFT JOIN gpkg_spatial_ref_sys s ON s.srs_id = g.srs_id
+                WHERE c.data_type = 'features' AND (? IS NULL OR c.table_name = ?)
+                ORDER BY c.table_name
+                LIMIT 1
+                """,
+                (layer, layer),
+            ).fetchone()
+        except sqlite3.DatabaseError as e:
+            self.conn.close()
+            raise ImportFormatError(f"GeoPackage inválido: {e}")
+        if row is None:
+            self.conn.close()
+            raise ImportFormatError(f"No hay capa de features {layer or ''} en el GeoPackage")
+
+        self.table, self.geometry_column, organization, srs = row
+        if not (organization or "").upper() == "EPSG" or srs != 4326:
+            self.conn.close()
+            raise ImportFormatError(
+                f"La capa {self.table} está en {organization}:{srs}; solo se importa EPSG:4326"
+            )
+
+    def count(self) -> int:
+        return self.conn.execute(f'SELECT COUNT(*) FROM "{self.table}"').fetchone()[0]
+
+    def iter_features(self, batch_size: int = 1000) -> Iterator[Dict[str, Any]]:
+        cursor = self.conn.execute(f'SELECT * FROM "{self.table}"')
+        columns = [d[0] for d in cursor.description]
+        geom_index = columns.index(self.geometry_column)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            for row in rows:
+                properties = {
+                    name: value
+                    for i, (name, value) in enumerate(zip(columns, row))
+                    if i != geom_index and not isinstance(value, bytes)
+                }
+                try:
+                    geometry = gpkg_geometry_to_geojson(row[geom_index])
+                except Exception as e:
+                    # Sin geometría: la validación la cuenta como inválida
+                    print(f"GeoPackage {self.table}: geometría ilegible ({e})")
+                    geometry = None
+                yield {"geometry": geometry, "properties": properties}
+
+    def close(self) -> None:
+        self.conn.close()
@@ -0,0 +1,280 @@
+import asyncio
+import contextvars
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from .cache import TTLCache
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", 100))
+JOB_RETENTION_SECONDS = float(os.getenv("JOB_RETENTION_SECONDS", 24 * 3600))
+# Estado de los trabajos compartido por todos los workers de uvicorn de la máquina
+# (fichero SQLite): GET /jobs/{id} puede llegar a un proceso distinto del que lo ejecuta
+JOB_DB = os.getenv("JOB_DB", os.path.join(tempfile.gettempdir(), "bridge_jobs.sqlite3"))
+# Cada cuánto se publica el progreso de un trabajo en curso
+JOB_PROGRESS_INTERVAL_SECONDS = float(os.getenv("JOB_PROGRESS_INTERVAL_SECONDS", 1))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    total INTEGER,
+    processed INTEGER NOT NULL,
+    unit TEXT NOT NULL,
+    result TEXT,
+    errors TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    expires_at REAL NOT NULL
+);
+"""
+
+
+@dataclass
+class Job:
+    job_id: str
+    user_id: str
+    kind: str
+    status: str = "queued"  # queued | running | done | failed
+    total: Optional[int] = None
+    processed: int = 0
+    # Unidad de processed/total: "features" o "bytes" (importación de ficheros sin recuento previo)
+    unit: str = "features"
+    result: Optional[Dict[str, Any]] = None
+    errors: List[Any] = field(default_factory=list)
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+    def set_progress(self, processed: int, total: Optional[int] = None) -> None:
+        self.processed = processed
+        if total is not None:
+            self.total = total
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.job_id,
+            "kind": self.kind,
+            "status": self.status,
+            "progress": {
+                "processed": self.processed,
+                "total": self.total,
+                "unit": self.unit,
+                "percent": (
+                    round(100 * self.processed / self.total, 1) if self.total else None
+                ),
+            },
+            "result": self.result,
+            "errors": self.errors or None,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+JobFunc = Callable[[Job], Awaitable[Dict[str, Any]]]
+
+
+class JobStore:
+    """
+    Registro de trabajos en un fichero SQLite (modo WAL), compartido entre los
+    workers. El proceso que ejecuta un trabajo guarda su estado al encolarlo,
+    al empezar, periódicamente mientras avanza y al terminar; cualquier
+    proceso puede leerlo. Los registros caducan a JOB_RETENTION_SECONDS.
+
+    Los métodos son síncronos (SQLite): desde el event loop se llaman con
+    asyncio.to_thread.
+    """
+
+    def __init__(self, path: str = JOB_DB, retention: float = JOB_RETENTION_SECONDS):
+        self.path = path
+        self.retention = retention
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def save(self, job: Job) -> None:
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO jobs (job_id, user_id, kind, status, total, processed,"
+            " unit, result, errors, created_at, started_at, finished_at, expires_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                job.job_id,
+                job.user_id,
+                job.kind,
+                job.status,
+                job.total,
+                job.processed,
+                job.unit,
+                None if job.result is None else json.dumps(job.result),
+                json.dumps(job.errors),
+                job.created_at,
+                job.started_at,
+                job.finished_at,
+                job.created_at + self.retention,
+            ),
+        )
+        if job.status == "queued":
+            conn.execute("DELETE FROM jobs WHERE expires_at <= ?", (time.time(),))
+
+    def get(self, job_id: str, user_id: str) -> Optional[Job]:
+        row = self._conn().execute(
+            "SELECT user_id, kind, status, total, processed, unit, result, errors,"
+            " created_at, started_at, finished_at FROM jobs"
+            " WHERE job_id = ? AND expires_at > ?",
+            (job_id, time.time()),
+        ).fetchone()
+        if row is None or row[0] != str(user_id):
+            return None
+        return Job(
+            job_id=job_id,
+            user_id=row[0],
+            kind=row[1],
+            status=row[2],
+            total=row[3],
+            processed=row[4],
+            unit=row[5],
+            result=None if row[6] is None else json.loads(row[6]),
+            errors=json.loads(row[7]),
+            created_at=row[8],
+            started_at=row[9],
+            finished_at=row[10],
+        )
+
+    def delete(self, job_id: str) -> None:
+        self._conn().execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+
+
+class JobManager:
+    """
+    Cola local con un número fijo de workers para trabajos largos (subidas grandes).
+
+    Los trabajos se ejecutan en el proceso que los recibe, fuera del ciclo de la
+    petición HTTP, y como mucho JOB_WORKERS a la vez: las peticiones interactivas
+    no compiten con ellos por conexiones ni hilos. Su estado se publica en el
+    JobStore compartido, así que se puede consultar desde cualquier worker.
+    """
+
+    def __init__(
+        self,
+        workers: int = JOB_WORKERS,
+        queue_size: int = JOB_QUEUE_SIZE,
+        retention: float = JOB_RETENTION_SECONDS,
+        store: Optional[JobStore] = None,
+    ):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.store = store or JobStore(retention=retention)
+        # Trabajos de este proceso: su progreso está al día antes de publicarse
+        self._jobs = TTLCache(maxsize=10000, ttl=retention)
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker_tasks: List[asyncio.Task] = []
+
+    def _ensure_workers(self) -> None:
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._worker_tasks = [t for t in self._worker_tasks if not t.done()]
+        while len(self._worker_tasks) < self.workers:
+            # Contexto vacío: los workers viven más que la petición que los arranca
+            # y no deben heredar su traza (routes/utils/tracing.py)
+            self._worker_tasks.append(
+                asyncio.create_task(self._worker(), context=contextvars.Context())
+            )
+
+    async def submit(
+        self, user_id: str, kind: str, func: JobFunc, total: Optional[int] = None
+    ) -> Job:
+        """
+        Encola un trabajo. Lanza asyncio.QueueFull si la cola está llena.
+        """
+        self._ensure_workers()
+        if self._queue.full():
+            raise asyncio.QueueFull
+        job = Job(job_id=uuid.uuid4().hex, user_id=str(user_id), kind=kind, total=total)
+        # Se registra antes de encolarlo: el worker solo actualiza un registro que ya existe
+        await asyncio.to_thread(self.store.save, job)
+        try:
+            self._queue.put_nowait((job, func))
+        except asyncio.QueueFull:
+            await asyncio.to_thread(self.store.delete, job.job_id)
+            raise
+        self._jobs.set(job.job_id, job)
+        return job
+
+    async def get(self, job_id: str, user_id: str) -> Optional[Job]:
+        job = self._jobs.get(job_id)
+        if job is None:
+            return await asyncio.to_thread(self.store.get, job_id, user_id)
+        if job.user_id != str(user_id):
+            return None
+        return job
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def _worker(self) -> None:
+        while True:
+            job, func = await self._queue.get()
+            job.status = "running"
+            job.started_at = time.time()
+            publisher = asyncio.create_task(self._publish_progress(job))
+            try:
+                job.result = await func(job)
+                job.errors.extend((job.result or {}).get("errors") or [])
+                job.status = "done"
+            except Exception as e:
+                print(f"Job {job.job_id} falló: {type(e).__name__}: {e}")
+                print(traceback.format_exc())
+                job.errors.append({"error": str(getattr(e, "detail", e))})
+                job.status = "failed"
+            finally:
+                job.finished_at = time.time()
+                publisher.cancel()
+                await asyncio.gather(publisher, return_exceptions=True)
+                try:
+                    await asyncio.to_thread(self.store.save, job)
+                except sqlite3.Error as e:
+                    print(f"Job {job.job_id}: no se pudo guardar el estado final: {e}")
+                self._queue.task_done()
+
+    async def _publish_progress(self, job: Job) -> None:
+        """
+        Guarda el estado del trabajo al empezar y cada JOB_PROGRESS_INTERVAL_SECONDS.
+        set_progress se llama también desde hilos (lectura de ficheros), por eso
+        no escribe en SQLite directamente.
+        """
+        while True:
+            try:
+                await asyncio.to_thread(self.store.save, job)
+            except sqlite3.Error as e:
+                print(f"Job {job.job_id}: no se pudo publicar el progreso: {e}")
+            await asyncio.sleep(JOB_PROGRESS_INTERVAL_SECONDS)
+
+    async def shutdown(self) -> None:
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+
+
+job_manager = JobManager()
@@ -0,0 +1,294 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+import jwt
+
+from .cache import TTLCache
+from .http_pool import get_http_client
+
+# Secreto HS256 del proyecto (Supabase > Settings > API > JWT Secret); si no se
+# configura, solo se aceptan tokens firmados con las claves asimétricas del JWKS
+SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")
+SUPABASE_JWKS_URL = os.getenv("SUPABASE_JWKS_URL") or (
+    f"{os.getenv('SUPABASE_URL', '').rstrip('/')}/auth/v1/.well-known/jwks.json"
+)
+# Cada cuánto se recarga el JWKS en segundo plano (rotación de claves)
+JWKS_REFRESH_SECONDS = float(os.getenv("JWKS_REFRESH_SECONDS", 600))
+# Mínimo entre recargas forzadas por un kid desconocido (evita que tokens falsos
+# con kids inventados provoquen una petición al JWKS cada uno)
+JWKS_MIN_REFETCH_SECONDS = float(os.getenv("JWKS_MIN_REFETCH_SECONDS", 30))
+SUPABASE_JWT_AUDIENCE = os.getenv("SUPABASE_JWT_AUDIENCE", "authenticated")
+JWT_LEEWAY_SECONDS = float(os.getenv("JWT_LEEWAY_SECONDS", 5))
+# Tokens ya verificados que se recuerdan (cada uno hasta su exp)
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 10000))
+# Tokens revocados con logout, compartidos por todos los workers de la máquina
+# (por defecto en el mismo fichero SQLite que los contadores del rate limit)
+TOKEN_REVOCATION_DB = os.getenv(
+    "TOKEN_REVOCATION_DB", os.path.join(tempfile.gettempdir(), "bridge_rate_limits.sqlite3")
+)
+# Cada cuánto lee cada proceso las revocaciones hechas por los demás
+TOKEN_REVOCATION_POLL_SECONDS = float(os.getenv("TOKEN_REVOCATION_POLL_SECONDS", 1))
+
+
+class TokenError(Exception):
+    """
+    Token rechazado (firma, expiración, audiencia o formato); se traduce a 401.
+    """
+
+
+class RevocationStore:
+    """
+    Revocaciones de access tokens (SHA-256 del token y su exp) en un fichero
+    SQLite en modo WAL. Cada proceso lee solo las filas nuevas desde la última
+    consulta (rowid creciente). Se usa siempre desde asyncio.to_thread.
+    """
+
+    def __init__(self, path: str = TOKEN_REVOCATION_DB):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS revoked_tokens ("
+                " id INTEGER PRIMARY KEY, token_hash BLOB UNIQUE NOT NULL, expires_at REAL NOT NULL"
+                ")"
+            )
+            self._local.conn = conn
+        return conn
+
+    def add(self, token_hash: bytes, expires_at: float) -> None:
+        conn = self._conn()
+        conn.execute("DELETE FROM revoked_tokens WHERE expires_at <= ?", (time.time(),))
+        conn.execute(
+            "INSERT OR IGNORE INTO revoked_tokens (token_hash, expires_at) VALUES (?, ?)",
+            (token_hash, expires_at),
+        )
+
+    def since(self, last_id: int) -> List[Tuple[int, bytes, float]]:
+        return self._conn().execute(
+            "SELECT id, token_hash, expires_at FROM revoked_tokens"
+            " WHERE id > ? AND expires_at > ? ORDER BY id",
+            (last_id, time.time()),
+        ).fetchall()
+
+
+class TokenVerifier:
+    """
+    Verificación local de los access tokens de Supabase: firma y exp se comprueban
+    en el servidor, sin ir a Supabase.
+
+    Los claims de los tokens ya verificados se guardan en una LRU acotada,
+    indexada por el SHA-256 del token y con TTL hasta su exp: las peticiones
+    siguientes con el mismo token no vuelven a verificar la firma.
+    """
+
+    def __init__(
+        self,
+        secret: Optional[str] = SUPABASE_JWT_SECRET,
+        jwks_url: Optional[str] = SUPABASE_JWKS_URL,
+        refresh_seconds: float = JWKS_REFRESH_SECONDS,
+        audience: Optional[str] = SUPABASE_JWT_AUDIENCE,
+        leeway: float = JWT_LEEWAY_SECONDS,
+        cache_size: int = TOKEN_CACHE_SIZE,
+        revocations: Optional[RevocationStore] = None,
+    ):
+        self.secret = secret
+        self.jwks_url = jwks_url
+        self.refresh_seconds = refresh_seconds
+        self.audience = audience
+        self.leeway = leeway
+        self._keys: Dict[str, jwt.PyJWK] = {}
+        self._cache = TTLCache(maxsize=cache_size, ttl=0)
+        # Tokens de sesiones cerradas con logout, rechazados hasta su exp; copia
+        # local de las revocaciones compartidas, releída cada TOKEN_REVOCATION_POLL_SECONDS
+        self._revoked = TTLCache(maxsize=cache_size, ttl=0)
+        self._revocations = revocations
+        self._revocations_seen = 0
+        self._fetched_at = 0.0
+        self._fetch_lock = asyncio.Lock()
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._revocation_task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        """
+        Carga el JWKS (arranque del servidor) y lanza su recarga periódica,
+        y la lectura periódica de las revocaciones de los demás procesos.
+        """
+        if self._revocations is not None and (
+            self._revocation_task is None or self._revocation_task.done()
+        ):
+            await self.sync_revocations()
+            self._revocation_task = asyncio.create_task(self._revocation_loop())
+        if not self.jwks_url:
+            return
+        await self.refresh_keys()
+        if not self._keys and not self.secret:
+            print(
+                "AVISO: sin claves JWKS ni SUPABASE_JWT_SECRET; "
+                "todas las peticiones autenticadas se rechazarán"
+            )
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self) -> None:
+        for task in (self._refresh_task, self._revocation_task):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._refresh_task = self._revocation_task = None
+
+    async def refresh_keys(self) -> None:
+        """
+        Descarga el JWKS; si falla se mantienen las claves anteriores.
+        """
+        async with self._fetch_lock:
+            self._fetched_at = time.monotonic()
+            try:
+                response = await get_http_client().get(self.jwks_url, timeout=10)
+                response.raise_for_status()
+                jwks = response.json()
+            except (httpx.HTTPError, ValueError) as e:
+                print(f"No se pudo descargar el JWKS ({self.jwks_url}): {type(e).__name__}: {e}")
+                return
+
+            keys = {}
+            for data in jwks.get("keys") or []:
+                try:
+                    key = jwt.PyJWK(data)
+                except jwt.PyJWKError as e:
+                    print(f"Clave JWKS ignorada ({data.get('kid')}): {e}")
+                    continue
+                if key.key_id:
+                    keys[key.key_id] = key
+            self._keys = keys
+            print(f"JWKS cargado: {len(keys)} claves")
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_seconds)
+            await self.refresh_keys()
+
+    async def sync_revocations(self) -> None:
+        """
+        Aplica las revocaciones registradas por otros procesos desde la última
+        lectura; si el fichero no está disponible se reintenta en la siguiente.
+        """
+        try:
+            rows = await asyncio.to_thread(self._revocations.since, self._revocations_seen)
+        except sqlite3.Error as e:
+            print(f"No se pudieron leer las revocaciones de tokens: {e}")
+            return
+        for row_id, cache_key, expires_at in rows:
+            self._revoke_local(cache_key, expires_at)
+            self._revocations_seen = row_id
+
+    async def _revocation_loop(self) -> None:
+        while True:
+            await asyncio.sleep(TOKEN_REVOCATION_POLL_SECONDS)
+            await self.sync_revocations()
+
+    async def verify(self, token: str) -> Dict[str, Any]:
+        """
+        Claims del token si la firma y las fechas son válidas; TokenError si no.
+        """
+        cache_key = hashlib.sha256(token.encode()).digest()
+        if cache_key in self._revoked:
+            raise TokenError("Sesión cerrada")
+        claims = self._cache.get(cache_key)
+        if claims is not None:
+            return claims
+
+        try:
+            header = jwt.get_unverified_header(token)
+        except jwt.InvalidTokenError as e:
+            raise TokenError(f"Token mal formado: {e}")
+
+        key, algorithm = await self._signing_key(header)
+        try:
+            claims = jwt.decode(
+                token,
+                key,
+                algorithms=[algorithm],
+                audience=self.audience,
+                leeway=self.leeway,
+                options={"require": ["exp", "sub"], "verify_aud": bool(self.audience)},
+            )
+        except jwt.ExpiredSignatureError:
+            raise TokenError("Token expirado")
+        except jwt.InvalidTokenError as e:
+            raise TokenError(f"Token inválido: {e}")
+
+        ttl = claims["exp"] - time.time()
+        if ttl > 0:
+            self._cache.set(cache_key, claims, ttl=ttl)
+        return claims
+
+    def cached_claims(self, token: str) -> Optional[Dict[str, Any]]:
+        """
+        Claims del token solo si ya se verificó antes (sin verificar la firma ahora).
+        """
+        cache_key = hashlib.sha256(token.encode()).digest()
+        if cache_key in self._revoked:
+            return None
+        return self._cache.get(cache_key)
+
+    async def revoke(self, token: str, expires_at: float) -> None:
+        """
+        Rechaza el token hasta su exp (logout): la firma sigue siendo válida,
+        así que no basta con sacarlo de la caché. En este proceso es inmediato;
+        el resto de workers lo aplican en su siguiente sync_revocations.
+        """
+        cache_key = hashlib.sha256(token.encode()).digest()
+        self._revoke_local(cache_key, expires_at)
+        if self._revocations is not None:
+            try:
+                await asyncio.to_thread(self._revocations.add, cache_key, expires_at)
+            except sqlite3.Error as e:
+                print(f"Revocación del token solo en este proceso: {e}")
+
+    def _revoke_local(self, cache_key: bytes, expires_at: float) -> None:
+        self._cache.pop(cache_key)
+        ttl = expires_at - time.time()
+        if ttl > 0:
+            self._revoked.set(cache_key, True, ttl=ttl)
+
+    async def _signing_key(self, header: Dict[str, Any]):
+        algorithm = header.get("alg")
+        if algorithm == "HS256":
+            if not self.secret:
+                raise TokenError("Tokens HS256 no admitidos: falta SUPABASE_JWT_SECRET")
+            return self.secret, algorithm
+
+        kid = header.get("kid")
+        key = self._keys.get(kid)
+        if (
+            key is None
+            and self.jwks_url
+            and time.monotonic() - self._fetched_at >= JWKS_MIN_REFETCH_SECONDS
+        ):
+            # Posible rotación de claves: se recarga el JWKS antes de rechazar
+            await self.refresh_keys()
+            key = self._keys.get(kid)
+        if key is None:
+            raise TokenError("Clave de firma desconocida")
+        # El algoritmo lo fija la clave, no la cabecera del token
+        if key.algorithm_name != algorithm:
+            raise TokenError("Algoritmo no coincide con la clave")
+        return key, algorithm
+
+
+token_verifier = TokenVerifier(revocations=RevocationStore())
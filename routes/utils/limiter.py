@@ -1,4 +1,182 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from fastapi import HTTPException, Request
+from limits import parse
+from limits.storage import Storage
 from slowapi import Limiter
 from slowapi.util import get_remote_address
 
-limiter = Limiter(key_func=get_remote_address)
\ No newline at end of file
+from .jwt_verifier import token_verifier
+
+# Contadores compartidos por todos los workers de uvicorn de la máquina (fichero SQLite)
+RATE_LIMIT_STORAGE_URI = os.getenv(
+    "RATE_LIMIT_STORAGE_URI",
+    f"sqlite://{os.path.join(tempfile.gettempdir(), 'bridge_rate_limits.sqlite3')}",
+)
+# Cupos por usuario ponderados por el peso de cada petición
+RATE_LIMIT_READ_ROWS = os.getenv("RATE_LIMIT_READ_ROWS", "500000/minute")
+RATE_LIMIT_WRITE_FEATURES = os.getenv("RATE_LIMIT_WRITE_FEATURES", "200000/minute")
+RATE_LIMIT_IMPORT_MB = os.getenv("RATE_LIMIT_IMPORT_MB", "5120/hour")
+# Espera máxima por el bloqueo del fichero SQLite. slowapi consulta los contadores
+# de forma síncrona en el event loop: si otro proceso tiene el fichero bloqueado
+# más tiempo, la petición pasa sin contar (fail open) en lugar de parar el loop
+RATE_LIMIT_SQLITE_TIMEOUT_MS = int(os.getenv("RATE_LIMIT_SQLITE_TIMEOUT_MS", 20))
+
+
+class SQLiteStorage(Storage):
+    """
+    Almacenamiento de `limits` (ventana fija) en un fichero SQLite en modo WAL:
+    los contadores se comparten entre procesos sin servidor externo.
+    Si el fichero sigue bloqueado tras RATE_LIMIT_SQLITE_TIMEOUT_MS, incr y get
+    devuelven 0 (la petición no se limita) en lugar de bloquear el event loop.
+
+    URI: sqlite:///ruta/absoluta.sqlite3 o sqlite://ruta/relativa.sqlite3
+    """
+
+    STORAGE_SCHEME = ["sqlite"]
+    # Cada cuántos incr se borran las ventanas caducadas
+    PURGE_EVERY = 1000
+
+    def __init__(self, uri: str, wrap_exceptions: bool = False, **options):
+        self.path = uri.split("://", 1)[1]
+        self._local = threading.local()
+        self._incr_count = 0
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.path, timeout=RATE_LIMIT_SQLITE_TIMEOUT_MS / 1000, isolation_level=None
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rate_limits ("
+                " key TEXT PRIMARY KEY, value INTEGER NOT NULL, expires_at REAL NOT NULL"
+                ") WITHOUT ROWID"
+            )
+            self._local.conn = conn
+        return conn
+
+    def incr(self, key: str, expiry: int, amount: int = 1) -> int:
+        now = time.time()
+        try:
+            conn = self._conn()
+            # Una sola sentencia atómica: reinicia la ventana si ya caducó
+            (value,) = conn.execute(
+                "INSERT INTO rate_limits (key, value, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET "
+                " value = CASE WHEN expires_at <= ? THEN excluded.value ELSE value + excluded.value END,"
+                " expires_at = CASE WHEN expires_at <= ? THEN excluded.expires_at ELSE expires_at END "
+                "RETURNING value",
+                (key, amount, now + expiry, now, now),
+            ).fetchone()
+            self._incr_count += 1
+            if self._incr_count % self.PURGE_EVERY == 0:
+                conn.execute("DELETE FROM rate_limits WHERE expires_at <= ?", (now,))
+        except sqlite3.OperationalError as e:
+            print(f"Rate limit sin contar {key} ({e})")
+            return 0
+        return value
+
+    def get(self, key: str) -> int:
+        try:
+            row = self._conn().execute(
+                "SELECT value FROM rate_limits WHERE key = ? AND expires_at > ?",
+                (key, time.time()),
+            ).fetchone()
+        except sqlite3.OperationalError as e:
+            print(f"Rate limit sin leer {key} ({e})")
+            return 0
+        return row[0] if row else 0
+
+    def get_expiry(self, key: str) -> float:
+        try:
+            row = self._conn().execute(
+                "SELECT expires_at FROM rate_limits WHERE key = ? AND expires_at > ?",
+                (key, time.time()),
+            ).fetchone()
+        except sqlite3.OperationalError:
+            row = None
+        return row[0] if row else time.time()
+
+    def check(self) -> bool:
+        try:
+            self._conn().execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self) -> int:
+        return self._conn().execute("DELETE FROM rate_limits").rowcount
+
+    def clear(self, key: str) -> None:
+        self._conn().execute("DELETE FROM rate_limits WHERE key = ?", (key,))
+
+
+def rate_limit_key(request: Request) -> str:
+    """
+    Usuario del token si ya está verificado (caché de jwt_verifier); si no, la IP.
+    No se usa el sub de un token sin verificar: cambiándolo se obtendría un cupo nuevo.
+    """
+    token = request.cookies.get("access_token")
+    if token:
+        claims = token_verifier.cached_claims(token)
+        if claims and claims.get("sub"):
+            return f"user:{claims['sub']}"
+    return get_remote_address(request)
+
+
+limiter = Limiter(key_func=rate_limit_key, storage_uri=RATE_LIMIT_STORAGE_URI)
+
+
+def _too_many(item, key: str, scope: str) -> HTTPException:
+    reset, _ = limiter.limiter.get_window_stats(item, key, scope)
+    return HTTPException(
+        status_code=429,
+        detail=f"Límite excedido: {item} ({scope})",
+        headers={"Retry-After": str(max(int(reset - time.time()) + 1, 1))},
+    )
+
+
+def charge(request: Request, scope: str, limit: str, cost: int) -> None:
+    """
+    Descuenta `cost` unidades (features, filas, MB) del cupo `limit` del
+    usuario en `scope`; 429 si no caben. Una petición más cara que todo el cupo
+    lo consume entero en lugar de ser imposible.
+    """
+    if not limiter.enabled or cost <= 0:
+        return
+    item = parse(limit)
+    key = rate_limit_key(request)
+    if not limiter.limiter.hit(item, key, scope, cost=min(cost, item.amount)):
+        raise _too_many(item, key, scope)
+
+
+def ensure_budget(request: Request, scope: str, limit: str) -> None:
+    """
+    429 si el cupo ya está agotado; para pesos que solo se conocen al terminar
+    (filas devueltas), que se descuentan después con debit().
+    """
+    if not limiter.enabled:
+        return
+    item = parse(limit)
+    key = rate_limit_key(request)
+    if not limiter.limiter.test(item, key, scope):
+        raise _too_many(item, key, scope)
+
+
+def debit(request: Request, scope: str, limit: str, cost: int) -> None:
+    if not limiter.enabled or cost <= 0:
+        return
+    item = parse(limit)
+    limiter.limiter.hit(item, rate_limit_key(request), scope, cost=min(cost, item.amount))
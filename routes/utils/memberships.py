@@ -0,0 +1,103 @@
+import asyncio
+import os
+from typing import Any, Dict, List
+
+from fastapi import HTTPException
+
+from .cache import TTLCache
+from .tracing import span
+
+# Proyectos de cada usuario (RPC get_projects_by_user), cacheados por user_id
+PROJECT_MEMBERSHIP_TTL_SECONDS = float(os.getenv("PROJECT_MEMBERSHIP_TTL_SECONDS", 60))
+PROJECT_MEMBERSHIP_CACHE_SIZE = int(os.getenv("PROJECT_MEMBERSHIP_CACHE_SIZE", 10000))
+
+
+class ProjectMemberships:
+    """
+    Caché por usuario de los proyectos a los que tiene acceso: la usan
+    /api/auth/projects y las comprobaciones de project_id de las rutas QGIS.
+
+    Las entradas caducan a los `ttl` segundos y se invalidan explícitamente
+    con invalidate() (login, logout, ?refresh=true). Las consultas simultáneas
+    del mismo usuario comparten una sola llamada al RPC.
+
+    invalidate() sube la generación del usuario si hay una carga en curso: esa
+    carga ya no guarda su resultado en la caché y las consultas siguientes
+    lanzan una nueva. La generación solo se guarda mientras el usuario tiene
+    cargas en curso.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = PROJECT_MEMBERSHIP_CACHE_SIZE,
+        ttl: float = PROJECT_MEMBERSHIP_TTL_SECONDS,
+    ):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._generations: Dict[str, int] = {}
+        # Cargas en curso por usuario (incluidas las que invalidate() dejó obsoletas)
+        self._loading: Dict[str, int] = {}
+
+    async def projects(self, supabase, user_id: str) -> List[Dict[str, Any]]:
+        """
+        [{project_id, project_name}] del usuario.
+        """
+        return (await self._entry(supabase, str(user_id)))["list"]
+
+    async def _entry(self, supabase, user_id: str) -> Dict[str, Any]:
+        entry = self._cache.get(user_id)
+        if entry is not None:
+            return entry
+
+        future = self._inflight.get(user_id)
+        if future is None:
+            generation = self._generations.get(user_id, 0)
+            self._loading[user_id] = self._loading.get(user_id, 0) + 1
+            future = asyncio.ensure_future(self._load(supabase, user_id, generation))
+            self._inflight[user_id] = future
+            future.add_done_callback(lambda done: self._load_done(user_id, done))
+        return await asyncio.shield(future)
+
+    async def _load(self, supabase, user_id: str, generation: int) -> Dict[str, Any]:
+        response = await supabase.rpc(
+            "get_projects_by_user", {"p_user_id": user_id}
+        ).execute()
+        projects = [
+            {"project_id": p["project_id"], "project_name": p["project_name"]}
+            for p in response.data or []
+        ]
+        entry = {"list": projects, "ids": {p["project_id"] for p in projects}}
+        # Invalidada mientras se cargaba: el resultado puede ser anterior al cambio
+        if self._generations.get(user_id, 0) == generation:
+            self._cache.set(user_id, entry)
+        return entry
+
+    def _load_done(self, user_id: str, future: asyncio.Future) -> None:
+        if self._inflight.get(user_id) is future:
+            del self._inflight[user_id]
+        self._loading[user_id] -= 1
+        if not self._loading[user_id]:
+            del self._loading[user_id]
+            self._generations.pop(user_id, None)
+
+    async def has_access(self, supabase, user_id: str, project_id: int) -> bool:
+        return project_id in (await self._entry(supabase, str(user_id)))["ids"]
+
+    async def ensure_access(self, supabase, user_id: str, project_id: int) -> None:
+        """
+        404 si el proyecto no es del usuario (no se revela si existe).
+        """
+        with span("auth.project"):
+            allowed = await self.has_access(supabase, user_id, project_id)
+        if not allowed:
+            raise HTTPException(status_code=404, detail="Proyecto no encontrado")
+
+    def invalidate(self, user_id: str) -> None:
+        user_id = str(user_id)
+        self._cache.pop(user_id)
+        if user_id in self._loading:
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+            self._inflight.pop(user_id, None)
+
+
+project_memberships = ProjectMemberships()
@@ -0,0 +1,299 @@
+import abc
+import asyncio
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import anyio.to_thread
+
+from .jobs import job_manager
+from .tracing import current_trace
+
+# Métricas en memoria del proceso, expuestas en /metrics con el formato de texto
+# de Prometheus (0.0.4). Sin dependencias: registrar una observación es una
+# búsqueda binaria y dos sumas, así que pueden quedarse activas en producción.
+# Con varios workers de uvicorn cada proceso expone las suyas.
+
+# Buckets de latencia en segundos (RPC y peticiones)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class _Metric(abc.ABC):
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    @abc.abstractmethod
+    def render(self) -> List[str]:
+        """
+        Líneas de muestras en formato de texto de Prometheus (sin HELP/TYPE).
+        """
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, *labels: str) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        return [
+            f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+            for labels, value in self._values.items()
+        ]
+
+
+class Gauge(_Metric):
+    """
+    Valor instantáneo. Con `func` se calcula al leer /metrics (sin coste por petición).
+    """
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        func: Optional[Callable[[], Dict[LabelValues, float]]] = None,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self._func = func
+
+    def inc(self, amount: float = 1, *labels: str) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, amount: float = 1, *labels: str) -> None:
+        self._values[labels] = self._values.get(labels, 0) - amount
+
+    def render(self) -> List[str]:
+        values = self._func() if self._func is not None else self._values
+        return [
+            f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+            for labels, value in values.items()
+        ]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Por etiquetas: [recuento por bucket (+Inf al final), suma]
+        self._values: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def render(self) -> List[str]:
+        lines = []
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_number(bound)}"'
+                lines.append(
+                    f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}"
+                )
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {total!r}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Métrica duplicada: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.header())
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+def _thread_pool_depth() -> Dict[LabelValues, float]:
+    depths: Dict[LabelValues, float] = {}
+    # asyncio.to_thread: ThreadPoolExecutor por defecto del event loop
+    try:
+        executor = getattr(asyncio.get_running_loop(), "_default_executor", None)
+    except RuntimeError:
+        executor = None
+    depths[("asyncio",)] = executor._work_queue.qsize() if executor is not None else 0
+    # Endpoints y dependencias síncronos de FastAPI (limitador de hilos de anyio)
+    try:
+        statistics = anyio.to_thread.current_default_thread_limiter().statistics()
+        depths[("anyio",)] = statistics.tasks_waiting
+    except RuntimeError:
+        depths[("anyio",)] = 0
+    depths[("jobs",)] = job_manager.queue_depth()
+    return depths
+
+
+REQUEST_LATENCY = registry.register(Histogram(
+    "http_request_duration_seconds",
+    "Latencia de las peticiones HTTP por ruta",
+    ("route", "method"),
+))
+REQUESTS = registry.register(Counter(
+    "http_requests_total",
+    "Peticiones HTTP por ruta y código de estado",
+    ("route", "method", "status"),
+))
+REQUESTS_IN_FLIGHT = registry.register(Gauge(
+    "http_requests_in_flight",
+    "Peticiones HTTP en curso",
+))
+PAYLOAD_BYTES = registry.register(Counter(
+    "http_payload_bytes_total",
+    "Bytes de cuerpo recibidos (in) y enviados (out) por ruta",
+    ("route", "direction"),
+))
+RPC_LATENCY = registry.register(Histogram(
+    "supabase_rpc_duration_seconds",
+    "Latencia de los RPC de Supabase por nombre (hasta recibir el cuerpo completo)",
+    ("rpc", "status"),
+))
+FEATURES_RETURNED = registry.register(Counter(
+    "features_returned_total",
+    "Features devueltas al cliente por ruta",
+    ("route",),
+))
+FEATURES_INSERTED = registry.register(Counter(
+    "features_inserted_total",
+    "Features insertadas en la base de datos",
+))
+THREAD_POOL_QUEUE_DEPTH = registry.register(Gauge(
+    "thread_pool_queue_depth",
+    "Tareas esperando hilo (asyncio.to_thread, anyio) o worker (jobs)",
+    ("pool",),
+    func=_thread_pool_depth,
+))
+
+
+class MetricsMiddleware:
+    """
+    Middleware ASGI: latencia, código de estado y bytes por plantilla de ruta
+    (/api/qgis/projects/{project_id}/tiles/{z}/{x}/{y}.pbf, no la URL concreta,
+    para que el número de series no crezca con los ids).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        sizes = [0, 0]
+        status = [500]
+
+        async def receive_counted():
+            message = await receive()
+            if message["type"] == "http.request":
+                sizes[0] += len(message.get("body", b""))
+            return message
+
+        async def send_counted(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            elif message["type"] == "http.response.body":
+                sizes[1] += len(message.get("body", b""))
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive_counted, send_counted)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "unmatched"
+            method = scope["method"]
+            REQUEST_LATENCY.observe(time.perf_counter() - started, path, method)
+            REQUESTS.inc(1, path, method, str(status[0]))
+            if sizes[0]:
+                PAYLOAD_BYTES.inc(sizes[0], path, "in")
+            if sizes[1]:
+                PAYLOAD_BYTES.inc(sizes[1], path, "out")
+
+
+def rpc_tracer(request, on_event: Optional[Callable] = None) -> Callable:
+    """
+    Callback de trazas de httpcore para una petición a PostgREST: mide desde que
+    se envía hasta que se recibe el cuerpo completo y lo registra en
+    RPC_LATENCY con el nombre del RPC (/rest/v1/rpc/<nombre>), y como tramo
+    rpc.<nombre> en la traza de la petición que lo lanzó (Server-Timing).
+    """
+    path = request.url.path
+    rpc = path.rsplit("/rpc/", 1)[1] if "/rpc/" in path else None
+    request_trace = current_trace()
+    started = time.perf_counter()
+
+    async def trace(event_name: str, info) -> None:
+        if on_event is not None:
+            await on_event(event_name, info)
+        if rpc is None:
+            return
+        if event_name.endswith("receive_response_body.complete"):
+            # El código lo deja el hook de respuesta de http_pool (llega antes que el cuerpo)
+            duration = time.perf_counter() - started
+            RPC_LATENCY.observe(duration, rpc, request.extensions.get("rpc_status", "0"))
+            if request_trace is not None:
+                request_trace.add(f"rpc.{rpc}", started, duration)
+        elif event_name.endswith(".failed") and "rpc_observed" not in request.extensions:
+            request.extensions["rpc_observed"] = True
+            RPC_LATENCY.observe(time.perf_counter() - started, rpc, "error")
+
+    return trace
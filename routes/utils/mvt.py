@@ -0,0 +1,367 @@
+import math
+import struct
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Codificador Mapbox Vector Tile 2.1 (protobuf escrito a mano) para una sola capa.
+# Coordenadas de entrada en EPSG:4326; las teselas van en Web Mercator (XYZ).
+
+EXTENT = 4096
+# Margen alrededor de cada tesela (en unidades de EXTENT) para que los trazos no se corten en el borde
+BUFFER = 64
+MAX_LATITUDE = 85.0511287798066
+
+_MOVE_TO, _LINE_TO, _CLOSE_PATH = 1, 2, 7
+_POINT, _LINESTRING, _POLYGON = 1, 2, 3
+
+Point = Tuple[float, float]
+
+
+def lonlat_to_world(lon: float, lat: float) -> Point:
+    """
+    Posición en el mundo Web Mercator normalizada a [0, 1] (y hacia abajo).
+    """
+    lat = max(min(lat, MAX_LATITUDE), -MAX_LATITUDE)
+    x = (lon + 180.0) / 360.0
+    s = math.sin(math.radians(lat))
+    y = 0.5 - math.log((1 + s) / (1 - s)) / (4 * math.pi)
+    return x, y
+
+
+def tile_bounds(z: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    """
+    bbox (lon/lat) de la tesela XYZ.
+    """
+    n = 2**z
+
+    def lat(ty: float) -> float:
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * ty / n))))
+
+    return x / n * 360.0 - 180.0, lat(y + 1), (x + 1) / n * 360.0 - 180.0, lat(y)
+
+
+def tiles_for_bbox(
+    bbox: Tuple[float, float, float, float], z: int, buffer: float = BUFFER / EXTENT
+) -> Iterable[Tuple[int, int]]:
+    """
+    Teselas (x, y) de nivel z que tocan el bbox, incluido el margen de BUFFER.
+    """
+    n = 2**z
+    x0, y0 = lonlat_to_world(bbox[0], bbox[3])
+    x1, y1 = lonlat_to_world(bbox[2], bbox[1])
+    tx0 = max(int(math.floor(x0 * n - buffer)), 0)
+    tx1 = min(int(math.floor(x1 * n + buffer)), n - 1)
+    ty0 = max(int(math.floor(y0 * n - buffer)), 0)
+    ty1 = min(int(math.floor(y1 * n + buffer)), n - 1)
+    for tx in range(tx0, tx1 + 1):
+        for ty in range(ty0, ty1 + 1):
+            yield tx, ty
+
+
+# --- Recorte en coordenadas de tesela ---
+
+
+def _clip_polygon_ring(ring: List[Point], lo: float, hi: float) -> List[Point]:
+    # Sutherland-Hodgman contra los cuatro lados del cuadrado [lo, hi]
+    def clip(points, inside, intersect):
+        out = []
+        if not points:
+            return out
+        prev = points[-1]
+        for cur in points:
+            if inside(cur):
+                if not inside(prev):
+                    out.append(intersect(prev, cur))
+                out.append(cur)
+            elif inside(prev):
+                out.append(intersect(prev, cur))
+            prev = cur
+        return out
+
+    def at_x(v):
+        return lambda a, b: (v, a[1] + (b[1] - a[1]) * (v - a[0]) / (b[0] - a[0]))
+
+    def at_y(v):
+        return lambda a, b: (a[0] + (b[0] - a[0]) * (v - a[1]) / (b[1] - a[1]), v)
+
+    points = ring
+    points = clip(points, lambda p: p[0] >= lo, at_x(lo))
+    points = clip(points, lambda p: p[0] <= hi, at_x(hi))
+    points = clip(points, lambda p: p[1] >= lo, at_y(lo))
+    points = clip(points, lambda p: p[1] <= hi, at_y(hi))
+    return points
+
+
+def _clip_line(line: List[Point], lo: float, hi: float) -> List[List[Point]]:
+    # Liang-Barsky por segmento, uniendo los tramos consecutivos
+    parts: List[List[Point]] = []
+    current: List[Point] = []
+    for a, b in zip(line, line[1:]):
+        t0, t1 = 0.0, 1.0
+        dx, dy = b[0] - a[0], b[1] - a[1]
+        visible = True
+        for p, q in ((-dx, a[0] - lo), (dx, hi - a[0]), (-dy, a[1] - lo), (dy, hi - a[1])):
+            if p == 0:
+                if q < 0:
+                    visible = False
+                    break
+                continue
+            r = q / p
+            if p < 0:
+                t0 = max(t0, r)
+            else:
+                t1 = min(t1, r)
+            if t0 > t1:
+                visible = False
+                break
+        if not visible:
+            if current:
+                parts.append(current)
+                current = []
+            continue
+        start = (a[0] + t0 * dx, a[1] + t0 * dy)
+        end = (a[0] + t1 * dx, a[1] + t1 * dy)
+        if not current:
+            current = [start]
+        current.append(end)
+        if t1 < 1.0:
+            parts.append(current)
+            current = []
+    if current:
+        parts.append(current)
+    return parts
+
+
+def _simplify(points: List[Point], tolerance: float) -> List[Point]:
+    """
+    Douglas-Peucker en coordenadas de tesela: quita los vértices que se desvían
+    menos de tolerance (unidades de EXTENT) de la recta entre sus vecinos.
+    """
+    if tolerance <= 0 or len(points) < 3:
+        return points
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    tolerance2 = tolerance * tolerance
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        (ax, ay), (bx, by) = points[first], points[last]
+        dx, dy = bx - ax, by - ay
+        length2 = dx * dx + dy * dy
+        farthest, max_dist2 = 0, tolerance2
+        for i in range(first + 1, last):
+            px, py = points[i]
+            if length2 == 0:
+                dist2 = (px - ax) ** 2 + (py - ay) ** 2
+            else:
+                t = max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / length2))
+                dist2 = (px - ax - t * dx) ** 2 + (py - ay - t * dy) ** 2
+            if dist2 > max_dist2:
+                farthest, max_dist2 = i, dist2
+        if farthest:
+            keep[farthest] = True
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+    return [p for p, k in zip(points, keep) if k]
+
+
+def _quantize(points: Sequence[Point]) -> List[Tuple[int, int]]:
+    out: List[Tuple[int, int]] = []
+    for x, y in points:
+        p = (int(round(x)), int(round(y)))
+        if not out or out[-1] != p:
+            out.append(p)
+    return out
+
+
+def _ring_area(ring: Sequence[Tuple[int, int]]) -> float:
+    area = 0
+    for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]):
+        area += x1 * y2 - x2 * y1
+    return area / 2
+
+
+# --- Codificación protobuf ---
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _zigzag(n: int) -> int:
+    return (n << 1) ^ (n >> 63)
+
+
+def _field(number: int, wire: int) -> bytes:
+    return _varint((number << 3) | wire)
+
+
+def _bytes_field(number: int, data: bytes) -> bytes:
+    return _field(number, 2) + _varint(len(data)) + data
+
+
+def _packed(number: int, values: Iterable[int]) -> bytes:
+    return _bytes_field(number, b"".join(_varint(v) for v in values))
+
+
+def _value(value: Any) -> bytes:
+    if isinstance(value, bool):
+        return _field(7, 0) + _varint(int(value))
+    if isinstance(value, int):
+        if value >= 0:
+            return _field(5, 0) + _varint(value)
+        return _field(6, 0) + _varint(_zigzag(value))
+    if isinstance(value, float):
+        return _field(3, 1) + struct.pack("<d", value)
+    return _bytes_field(1, str(value).encode("utf-8"))
+
+
+class _Commands:
+    def __init__(self):
+        self.values: List[int] = []
+        self.cx = self.cy = 0
+
+    def path(self, points: Sequence[Tuple[int, int]], close: bool) -> None:
+        self.values.append(_MOVE_TO | (1 << 3))
+        self._delta(points[0])
+        if len(points) > 1:
+            self.values.append(_LINE_TO | ((len(points) - 1) << 3))
+            for p in points[1:]:
+                self._delta(p)
+        if close:
+            self.values.append(_CLOSE_PATH | (1 << 3))
+
+    def _delta(self, p: Tuple[int, int]) -> None:
+        self.values.append(_zigzag(p[0] - self.cx) & 0xFFFFFFFF)
+        self.values.append(_zigzag(p[1] - self.cy) & 0xFFFFFFFF)
+        self.cx, self.cy = p
+
+
+def _to_tile(coords, z: int, x: int, y: int) -> List[Point]:
+    scale = EXTENT * 2**z
+    out = []
+    for c in coords:
+        wx, wy = lonlat_to_world(c[0], c[1])
+        out.append((wx * scale - x * EXTENT, wy * scale - y * EXTENT))
+    return out
+
+
+def _geometry_commands(
+    geometry: Dict[str, Any], z: int, x: int, y: int, tolerance: float = 0.0
+) -> List[Tuple[int, List[int]]]:
+    """
+    Lista de (tipo MVT, comandos) de la geometría simplificada y recortada a la
+    tesela; una GeometryCollection produce una entrada por cada tipo.
+    """
+    lo, hi = -BUFFER, EXTENT + BUFFER
+    geom_type = geometry.get("type")
+    coords = geometry.get("coordinates")
+
+    if geom_type == "GeometryCollection":
+        out = []
+        for part in geometry.get("geometries") or []:
+            out += _geometry_commands(part, z, x, y, tolerance)
+        return out
+
+    if geom_type in ("Point", "MultiPoint"):
+        points = [coords] if geom_type == "Point" else coords
+        quantized = [
+            p
+            for p in _quantize(_to_tile([c for c in points if c], z, x, y))
+            if lo <= p[0] <= hi and lo <= p[1] <= hi
+        ]
+        if not quantized:
+            return []
+        cmd = _Commands()
+        cmd.values.append(_MOVE_TO | (len(quantized) << 3))
+        for p in quantized:
+            cmd._delta(p)
+        return [(_POINT, cmd.values)]
+
+    if geom_type in ("LineString", "MultiLineString"):
+        lines = [coords] if geom_type == "LineString" else coords
+        cmd = _Commands()
+        for line in lines:
+            for part in _clip_line(_simplify(_to_tile(line, z, x, y), tolerance), lo, hi):
+                quantized = _quantize(part)
+                if len(quantized) >= 2:
+                    cmd.path(quantized, close=False)
+        return [(_LINESTRING, cmd.values)] if cmd.values else []
+
+    if geom_type in ("Polygon", "MultiPolygon"):
+        polygons = [coords] if geom_type == "Polygon" else coords
+        cmd = _Commands()
+        for polygon in polygons:
+            for i, ring in enumerate(polygon):
+                simplified = _simplify(_to_tile(ring, z, x, y), tolerance)[:-1]
+                clipped = _clip_polygon_ring(simplified, lo, hi)
+                quantized = _quantize(clipped)
+                if len(quantized) > 1 and quantized[0] == quantized[-1]:
+                    quantized.pop()
+                area = _ring_area(quantized) if len(quantized) >= 3 else 0
+                if area == 0:
+                    if i == 0:
+                        break  # sin anillo exterior no hay polígono
+                    continue
+                # Exterior con área positiva, huecos con área negativa (MVT 2.1, 4.3.4.4)
+                if (area > 0) != (i == 0):
+                    quantized.reverse()
+                cmd.path(quantized, close=True)
+        return [(_POLYGON, cmd.values)] if cmd.values else []
+
+    return []
+
+
+def encode_tile(
+    layer_name: str,
+    features: Iterable[Tuple[Optional[int], Dict[str, Any], Dict[str, Any]]],
+    z: int,
+    x: int,
+    y: int,
+    tolerance: float = 0.0,
+) -> Optional[bytes]:
+    """
+    Tesela MVT con una capa a partir de (id, geometría GeoJSON, propiedades).
+    Las líneas y anillos se simplifican antes de recortar con la tolerancia
+    dada en unidades de EXTENT (0 = sin simplificar).
+    Devuelve None si ninguna feature cae dentro de la tesela.
+    """
+    keys: Dict[str, int] = {}
+    values: Dict[Tuple[type, Any], int] = {}
+    encoded_features = []
+
+    for feature_id, geometry, properties in features:
+        if not geometry:
+            continue
+        tags: List[int] = []
+        for key, value in properties.items():
+            if value is None:
+                continue
+            tags.append(keys.setdefault(key, len(keys)))
+            tags.append(values.setdefault((type(value), value), len(values)))
+        for mvt_type, commands in _geometry_commands(geometry, z, x, y, tolerance):
+            body = b""
+            if feature_id is not None:
+                body += _field(1, 0) + _varint(int(feature_id))
+            if tags:
+                body += _packed(2, tags)
+            body += _field(3, 0) + _varint(mvt_type)
+            body += _packed(4, commands)
+            encoded_features.append(_bytes_field(2, body))
+
+    if not encoded_features:
+        return None
+
+    layer = _field(15, 0) + _varint(2) + _bytes_field(1, layer_name.encode("utf-8"))
+    layer += b"".join(encoded_features)
+    layer += b"".join(_bytes_field(3, k.encode("utf-8")) for k in keys)
+    layer += b"".join(_bytes_field(4, _value(v)) for (_, v) in values)
+    layer += _field(5, 0) + _varint(EXTENT)
+    return _bytes_field(3, layer)
@@ -0,0 +1,298 @@
+import asyncio
+import cProfile
+import heapq
+import io
+import itertools
+import os
+import pstats
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs
+
+# Perfilado bajo demanda (cabecera X-Profile o ?profile=): solo en desarrollo
+# o con PROFILING_ENABLED=1
+PROFILING_ENABLED = (
+    os.getenv("ENVIRONMENT", "production").lower() == "development"
+    or os.getenv("PROFILING_ENABLED", "0").lower() in ("1", "true", "yes")
+)
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "bridge_profiles"))
+# Funciones que se listan en el informe pstats
+PROFILE_TOP_FUNCTIONS = int(os.getenv("PROFILE_TOP_FUNCTIONS", 60))
+# Muestreo en producción: fracción de peticiones perfiladas (0 = desactivado)
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+# Intervalo entre muestras de la pila del event loop
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", 5))
+# Perfiles muestreados que se guardan en memoria (los de las N peticiones más lentas)
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", 20))
+
+PROFILE_MODES = ("store", "pstats", "collapsed")
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_qualname}"
+
+
+class StackSampler(threading.Thread):
+    """
+    Perfilador por muestreo: cada `interval` segundos lee la pila del hilo
+    indicado (el del event loop) y cuenta las pilas en formato "collapsed"
+    (a;b;c N), el que usan flamegraph.pl y speedscope. Su coste no depende
+    del número de llamadas, solo del intervalo.
+
+    Con peticiones concurrentes la pila es la de la corrutina que esté en
+    marcha en ese momento, no necesariamente la de la petición perfilada.
+    """
+
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(name="stack-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(_frame_label(frame))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(labels))] += 1
+            self.samples += 1
+
+    def stop(self) -> None:
+        """
+        Bloquea hasta la última muestra en curso: desde el event loop se llama
+        con asyncio.to_thread.
+        """
+        self._stop_event.set()
+        self.join()
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+class SlowestProfiles:
+    """
+    Los PROFILE_KEEP perfiles muestreados de las peticiones más lentas
+    (montículo de mínimos por duración).
+    """
+
+    def __init__(self, keep: int = PROFILE_KEEP):
+        self.keep = keep
+        self._heap: List[tuple] = []
+        self._ids = itertools.count(1)
+
+    def add(self, duration: float, record: Dict[str, Any]) -> None:
+        if self.keep <= 0:
+            return
+        record["profile_id"] = next(self._ids)
+        item = (duration, record["profile_id"], record)
+        if len(self._heap) < self.keep:
+            heapq.heappush(self._heap, item)
+        elif duration > self._heap[0][0]:
+            heapq.heapreplace(self._heap, item)
+
+    def summary(self) -> List[Dict[str, Any]]:
+        return [
+            {k: v for k, v in record.items() if k != "collapsed"}
+            for _, _, record in sorted(self._heap, key=lambda item: item[0], reverse=True)
+        ]
+
+    def get(self, profile_id: int) -> Optional[Dict[str, Any]]:
+        for _, pid, record in self._heap:
+            if pid == profile_id:
+                return record
+        return None
+
+
+slowest_profiles = SlowestProfiles()
+
+
+def _requested_mode(scope) -> Optional[str]:
+    for name, value in scope["headers"]:
+        if name == b"x-profile":
+            mode = value.decode("latin-1").strip().lower()
+            return "store" if mode in ("1", "true") else mode
+    query = scope.get("query_string", b"")
+    if b"profile=" in query:
+        mode = parse_qs(query.decode("latin-1")).get("profile", [""])[0].lower()
+        return "store" if mode in ("1", "true") else mode
+    return None
+
+
+def _pstats_report(profiler: cProfile.Profile) -> str:
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(
+        PROFILE_TOP_FUNCTIONS
+    )
+    return stream.getvalue()
+
+
+def _write_text(path: str, text: str) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def _file_name(scope, extension: str) -> str:
+    slug = re.sub(r"[^A-Za-z0-9]+", "_", scope["path"]).strip("_") or "root"
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{slug}-{random.randrange(16**6):06x}.{extension}"
+
+
+class ProfilingMiddleware:
+    """
+    Middleware ASGI de perfilado.
+
+    - Bajo demanda (PROFILING_ENABLED): con X-Profile: <modo> o ?profile=<modo>
+      la petición se ejecuta bajo un perfilador.
+        store     -> respuesta normal; el .prof (pstats) se guarda en PROFILE_DIR
+                     y su nombre va en la cabecera X-Profile-File
+        pstats    -> la respuesta es el informe de cProfile (por tiempo acumulado)
+        collapsed -> la respuesta son las pilas muestreadas en formato collapsed
+      cProfile ve todo lo que ejecuta el event loop mientras tanto, también
+      otras peticiones: para medir una sola, perfilar sin carga concurrente.
+    - Muestreo (PROFILE_SAMPLE_RATE > 0, válido en producción): una fracción de
+      las peticiones se perfila con StackSampler y se guardan los perfiles de
+      las PROFILE_KEEP más lentas (GET /debug/profiles).
+
+    Como mucho hay un perfilado en curso a la vez; si ya hay uno, la petición
+    se atiende sin perfilar. Parar el muestreador, generar los informes y
+    escribir los ficheros se hace con asyncio.to_thread, fuera del event loop.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._busy = False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        mode = _requested_mode(scope) if PROFILING_ENABLED else None
+        if mode in PROFILE_MODES and not self._busy:
+            self._busy = True
+            try:
+                await self._profile(mode, scope, receive, send)
+            finally:
+                self._busy = False
+        elif PROFILE_SAMPLE_RATE and not self._busy and random.random() < PROFILE_SAMPLE_RATE:
+            self._busy = True
+            try:
+                await self._sample(scope, receive, send)
+            finally:
+                self._busy = False
+        else:
+            await self.app(scope, receive, send)
+
+    async def _profile(self, mode: str, scope, receive, send) -> None:
+        await asyncio.to_thread(os.makedirs, PROFILE_DIR, exist_ok=True)
+
+        if mode == "store":
+            file_name = _file_name(scope, "prof")
+            profiler = cProfile.Profile()
+
+            async def send_with_file(message):
+                if message["type"] == "http.response.start":
+                    message = {
+                        **message,
+                        "headers": [
+                            *message.get("headers", []),
+                            (b"x-profile-file", file_name.encode()),
+                        ],
+                    }
+                await send(message)
+
+            profiler.enable()
+            try:
+                await self.app(scope, receive, send_with_file)
+            finally:
+                profiler.disable()
+                await asyncio.to_thread(profiler.dump_stats, os.path.join(PROFILE_DIR, file_name))
+            return
+
+        # pstats / collapsed: la respuesta original se descarta y se devuelve el informe
+        status = [500]
+
+        async def capture(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+
+        started = time.perf_counter()
+        if mode == "pstats":
+            file_name = _file_name(scope, "prof")
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                await self.app(scope, receive, capture)
+            finally:
+                profiler.disable()
+            await asyncio.to_thread(profiler.dump_stats, os.path.join(PROFILE_DIR, file_name))
+            report = await asyncio.to_thread(_pstats_report, profiler)
+        else:
+            file_name = _file_name(scope, "collapsed")
+            sampler = StackSampler(threading.get_ident(), interval=0.001)
+            sampler.start()
+            try:
+                await self.app(scope, receive, capture)
+            finally:
+                await asyncio.to_thread(sampler.stop)
+            report = await asyncio.to_thread(sampler.collapsed)
+            await asyncio.to_thread(_write_text, os.path.join(PROFILE_DIR, file_name), report)
+
+        body = report.encode("utf-8")
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [
+                    (b"content-type", b"text/plain; charset=utf-8"),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"x-profile-file", file_name.encode()),
+                    (b"x-profile-status", str(status[0]).encode()),
+                    (b"x-profile-duration-ms", f"{(time.perf_counter() - started) * 1000:.1f}".encode()),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+    async def _sample(self, scope, receive, send) -> None:
+        status = [500]
+
+        async def send_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        sampler = StackSampler(threading.get_ident(), interval=PROFILE_SAMPLE_INTERVAL_MS / 1000)
+        started = time.perf_counter()
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            duration = time.perf_counter() - started
+            await asyncio.to_thread(sampler.stop)
+            route = scope.get("route")
+            slowest_profiles.add(
+                duration,
+                {
+                    "time": time.time(),
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "route": getattr(route, "path", None),
+                    "status": status[0],
+                    "duration_ms": round(duration * 1000, 3),
+                    "samples": sampler.samples,
+                    "collapsed": await asyncio.to_thread(sampler.collapsed),
+                },
+            )
@@ -0,0 +1,141 @@
+from typing import Any, Dict, List
+
+from .geometry import geometry_hash
+from .metrics import FEATURES_INSERTED
+
+# Tamaño máximo de cada llamada batch (limita el tamaño del payload de cada RPC)
+RPC_BATCH_SIZE = 500
+# Hashes por llamada en la negociación have/want (array text[] del RPC)
+HASH_BATCH_SIZE = 5000
+
+
+def rpc_rows(data: Any) -> List[Dict[str, Any]]:
+    """
+    Normaliza la respuesta de un RPC a lista de filas.
+    """
+    if data is None:
+        return []
+    if isinstance(data, dict):
+        return [data]
+    return list(data)
+
+
+def batched(items: List[Any], size: int = RPC_BATCH_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+async def insert_geometries_batch(
+    supabase, user_id: str, project_id: int, geometries: List[Dict[str, Any]]
+) -> List[Dict[str, Any]]:
+    """
+    Inserta un lote de geometrías en una sola sentencia, junto con su hash
+    canónico (índice de la negociación have/want).
+    Devuelve una fila por geometría, en el mismo orden: {idx, id, code}.
+    """
+    results: List[Dict[str, Any]] = []
+    for offset, batch in enumerate(batched(geometries)):
+        items = [{"geometry": g, "hash": geometry_hash(g)} for g in batch]
+        response = await supabase.rpc(
+            "insert_geometries_batch",
+            {
+                "p_items": items,
+                "p_user_id": str(user_id),
+                "p_project_id": project_id,
+            },
+        ).execute()
+        rows = sorted(rpc_rows(response.data), key=lambda r: r.get("idx", 0))
+        base = offset * RPC_BATCH_SIZE
+        for row in rows:
+            row["idx"] = base + row.get("idx", 0)
+        results.extend(rows)
+        FEATURES_INSERTED.inc(sum(1 for row in rows if row.get("code") == "OK_INSERT"))
+    return results
+
+
+async def update_geometries_batch(
+    supabase, user_id: str, project_id: int, updates: List[Dict[str, Any]]
+) -> List[Dict[str, Any]]:
+    """
+    Actualiza geometrías por id dentro del proyecto (un id de otro proyecto
+    es ERROR_NOT_FOUND). Si el item trae "version" solo se aplica
+    si coincide con la versión actual (concurrencia optimista).
+    Devuelve filas {id, code, version} con code OK_UPDATE / ERROR_CONFLICT / ERROR_NOT_FOUND.
+    """
+    results: List[Dict[str, Any]] = []
+    for batch in batched(updates):
+        batch = [{**item, "hash": geometry_hash(item["geometry"])} for item in batch]
+        response = await supabase.rpc(
+            "update_geometries_batch",
+            {"p_items": batch, "p_user_id": str(user_id), "p_project_id": project_id},
+        ).execute()
+        results.extend(rpc_rows(response.data))
+    return results
+
+
+async def delete_geometries_batch(
+    supabase, user_id: str, project_id: int, ids: List[int]
+) -> List[Dict[str, Any]]:
+    """
+    Borra geometrías por id dentro del proyecto.
+    Devuelve filas {id, code} con code OK_DELETE / ERROR_NOT_FOUND.
+    """
+    results: List[Dict[str, Any]] = []
+    for batch in batched(ids):
+        response = await supabase.rpc(
+            "delete_geometries_batch",
+            {"p_ids": batch, "p_user_id": str(user_id), "p_project_id": project_id},
+        ).execute()
+        results.extend(rpc_rows(response.data))
+    return results
+
+
+async def get_known_geometry_hashes(
+    supabase, project_id: int, hashes: List[str]
+) -> set:
+    """
+    Devuelve el subconjunto de hashes que ya existen en el proyecto
+    (consulta en bloque contra el índice (project_id, geom_hash)).
+    """
+    known = set()
+    for batch in batched(hashes, HASH_BATCH_SIZE):
+        response = await supabase.rpc(
+            "get_known_geometry_hashes",
+            {"p_project_id": project_id, "p_hashes": batch},
+        ).execute()
+        known.update(row.get("geom_hash") for row in rpc_rows(response.data))
+    return known
+
+
+async def get_project_geometries_page(
+    supabase, project_id: int, user_id: str, after_id: int, limit: int
+) -> List[Dict[str, Any]]:
+    """
+    Página de geometrías del proyecto creadas por user_id con id > after_id,
+    ordenadas por id (paginación por clave para volcar proyectos completos).
+    Filas {id, geometry, version}.
+    """
+    response = await supabase.rpc(
+        "get_project_geometries_page",
+        {
+            "p_project_id": project_id,
+            "p_user_id": str(user_id),
+            "p_after_id": after_id,
+            "p_limit": limit,
+        },
+    ).execute()
+    return rpc_rows(response.data)
+
+
+async def get_project_geometries_by_ids(
+    supabase, project_id: int, user_id: str, ids: List[int]
+) -> List[Dict[str, Any]]:
+    """
+    Geometrías del proyecto creadas por user_id con los ids dados; los que ya
+    no existen no aparecen.
+    """
+    response = await supabase.rpc(
+        "get_project_geometries_by_ids",
+        {"p_project_id": project_id, "p_user_id": str(user_id), "p_ids": ids},
+    ).execute()
+    return rpc_rows(response.data)
@@ -0,0 +1,161 @@
+import abc
+import asyncio
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, Optional, Set, Tuple
+
+
+def artifact_prefix(project_id: int) -> str:
+    return f"project_{project_id}_user_"
+
+
+def artifact_name(project_id: int, user_id: str) -> str:
+    """
+    Nombre base de los ficheros de un proyecto y usuario (sin extensión).
+    """
+    return artifact_prefix(project_id) + re.sub(r"[^A-Za-z0-9-]", "_", str(user_id))
+
+
+@dataclass
+class ProjectRebuildState:
+    project_id: int
+    user_id: str
+    supabase: Any = None
+    changed: Set[int] = field(default_factory=set)
+    deleted: Set[int] = field(default_factory=set)
+    full: bool = False
+    task: Optional[asyncio.Task] = None
+    built_at: Optional[float] = None
+    features: Optional[int] = None
+
+    def pending(self) -> bool:
+        return bool(self.full or self.changed or self.deleted)
+
+
+class DebouncedProjectRebuilder(abc.ABC):
+    """
+    Base de los artefactos derivados por proyecto (snapshots, teselas) que se
+    regeneran a partir de los ids cambiados.
+
+    Cada artefacto es de un proyecto y un usuario: igual que get_layer
+    (get_geometries_in_extent filtra por created_by), solo contiene las
+    geometrías creadas por ese usuario, así que nadie ve por esta vía
+    geometrías que no vería en QGIS.
+
+    Las escrituras marcan el artefacto como sucio; tras `debounce` segundos sin
+    cambios se llama a _build con los ids acumulados. Como mucho hay una
+    regeneración en curso por artefacto: lo que llegue mientras tanto se aplica
+    en la siguiente vuelta.
+    """
+
+    label = "artefacto"
+
+    def __init__(self, debounce: float):
+        self.debounce = debounce
+        self._projects: Dict[Tuple[int, str], ProjectRebuildState] = {}
+
+    @abc.abstractmethod
+    def exists(self, project_id: int, user_id: str) -> bool:
+        """
+        Si el artefacto del proyecto y usuario ya está generado.
+        """
+
+    @abc.abstractmethod
+    async def _build(
+        self,
+        project_id: int,
+        user_id: str,
+        supabase,
+        full: bool,
+        changed: Set[int],
+        deleted: Set[int],
+    ) -> int:
+        """
+        Regenera el artefacto y devuelve el número de features que contiene.
+        """
+
+    def _state(self, project_id: int, user_id: str) -> ProjectRebuildState:
+        key = (project_id, str(user_id))
+        state = self._projects.get(key)
+        if state is None:
+            state = self._projects[key] = ProjectRebuildState(project_id, str(user_id))
+        return state
+
+    def mark_dirty(
+        self,
+        project_id: int,
+        user_id: str,
+        supabase,
+        changed: Iterable[int] = (),
+        deleted: Iterable[int] = (),
+    ) -> None:
+        """
+        Registra ids insertados/actualizados y borrados; solo si el proyecto ya
+        tiene el artefacto generado (si no, se generará completo cuando se pida).
+        """
+        if not self.exists(project_id, user_id):
+            return
+        state = self._state(project_id, user_id)
+        state.supabase = supabase
+        state.changed.update(int(i) for i in changed)
+        state.deleted.update(int(i) for i in deleted)
+        state.changed.difference_update(state.deleted)
+        self._schedule(state, delay=self.debounce)
+
+    def request_rebuild(
+        self, project_id: int, user_id: str, supabase, full: bool = False
+    ) -> asyncio.Task:
+        state = self._state(project_id, user_id)
+        state.supabase = supabase
+        state.full = state.full or full
+        return self._schedule(state, delay=0)
+
+    def status(self, project_id: int, user_id: str) -> Dict[str, Any]:
+        state = self._projects.get((project_id, str(user_id)))
+        return {
+            "project_id": project_id,
+            "exists": self.exists(project_id, user_id),
+            "features": state.features if state else None,
+            "built_at": state.built_at if state else None,
+            "pending_changes": len(state.changed) + len(state.deleted) if state else 0,
+            "rebuilding": bool(state and state.task and not state.task.done()),
+        }
+
+    def _schedule(self, state: ProjectRebuildState, delay: float) -> asyncio.Task:
+        if state.task is None or state.task.done():
+            state.task = asyncio.create_task(self._run(state, delay))
+        return state.task
+
+    async def _run(self, state: ProjectRebuildState, delay: float) -> None:
+        while True:
+            if delay:
+                await asyncio.sleep(delay)
+            if not state.pending():
+                return
+            full = state.full
+            changed, deleted = state.changed, state.deleted
+            state.full, state.changed, state.deleted = False, set(), set()
+            started = time.perf_counter()
+            try:
+                count = await self._build(
+                    state.project_id, state.user_id, state.supabase, full, changed, deleted
+                )
+            except Exception as e:
+                print(
+                    f"{self.label} del proyecto {state.project_id} falló: "
+                    f"{type(e).__name__}: {e}"
+                )
+                # Se reintentará completo con el siguiente cambio o petición
+                state.full = True
+                return
+            state.features = count
+            state.built_at = time.time()
+            print(
+                f"{self.label} del proyecto {state.project_id} "
+                f"({'completo' if full else f'{len(changed)} cambios, {len(deleted)} borrados'}): "
+                f"{count} features en {time.perf_counter() - started:.2f}s"
+            )
+            if not state.pending():
+                return
+            delay = self.debounce
@@ -0,0 +1,253 @@
+import asyncio
+import json
+import os
+import struct
+import tempfile
+from array import array
+from typing import Any, Dict, List, Set, Tuple
+
+from .flatgeobuf import GEOMETRY_TYPES, encode_feature, read_leaves, write_flatgeobuf
+from .geometry import geometry_bbox
+from .qgis_rpc import get_project_geometries_by_ids, get_project_geometries_page
+from .rebuilds import DebouncedProjectRebuilder, artifact_name
+
+# Directorio de los snapshots FlatGeobuf por proyecto
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "snapshots")
+# Espera tras el último cambio antes de regenerar (agrupa subidas por chunks)
+SNAPSHOT_DEBOUNCE_SECONDS = float(os.getenv("SNAPSHOT_DEBOUNCE_SECONDS", 5))
+# Filas por página al volcar un proyecto completo
+SNAPSHOT_PAGE_SIZE = int(os.getenv("SNAPSHOT_PAGE_SIZE", 1000))
+
+# Cabecera del .ids: número de features y tamaño, mtime_ns e inodo del .fgb al que
+# corresponde. Si no coinciden con el .fgb actual (otro worker lo reemplazó entre
+# los dos os.replace, o se cortó ahí) la siguiente regeneración es completa
+_SIDECAR_HEADER = struct.Struct("<QQqQ")
+
+
+class SnapshotManager(DebouncedProjectRebuilder):
+    """
+    Snapshots FlatGeobuf por proyecto y usuario (índice R-tree de Hilbert
+    empaquetado), servidos con peticiones Range para que QGIS lea solo los
+    bytes del extent visible.
+
+    La regeneración es incremental: se reutilizan los bytes ya codificados de
+    las features sin cambios y solo se piden a la base de datos las insertadas
+    o modificadas.
+
+    Junto a cada project_<id>_user_<uuid>.fgb se guarda un .ids con los ids y tipos
+    de geometría en el orden del fichero, necesarios para la regeneración incremental.
+    Ambos se escriben en temporales con nombre único y se publican con os.replace:
+    varios workers (o ensure y una regeneración) pueden escribir el mismo snapshot.
+    """
+
+    label = "Snapshot"
+
+    def __init__(
+        self,
+        directory: str = SNAPSHOT_DIR,
+        debounce: float = SNAPSHOT_DEBOUNCE_SECONDS,
+        page_size: int = SNAPSHOT_PAGE_SIZE,
+    ):
+        super().__init__(debounce)
+        self.directory = directory
+        self.page_size = page_size
+
+    def path(self, project_id: int, user_id: str) -> str:
+        return os.path.join(self.directory, f"{artifact_name(project_id, user_id)}.fgb")
+
+    def _sidecar_path(self, project_id: int, user_id: str) -> str:
+        return os.path.join(self.directory, f"{artifact_name(project_id, user_id)}.ids")
+
+    def exists(self, project_id: int, user_id: str) -> bool:
+        return os.path.exists(self.path(project_id, user_id))
+
+    async def ensure(self, project_id: int, user_id: str, supabase) -> str:
+        """
+        Ruta del snapshot; la primera vez se genera completo antes de responder.
+        """
+        path = self.path(project_id, user_id)
+        if os.path.exists(path):
+            return path
+        await asyncio.shield(self.request_rebuild(project_id, user_id, supabase, full=True))
+        if not os.path.exists(path):
+            raise RuntimeError(f"No se pudo generar el snapshot del proyecto {project_id}")
+        return path
+
+    def status(self, project_id: int, user_id: str) -> Dict[str, Any]:
+        path = self.path(project_id, user_id)
+        return {
+            **super().status(project_id, user_id),
+            "size": os.path.getsize(path) if os.path.exists(path) else None,
+        }
+
+    async def _build(
+        self,
+        project_id: int,
+        user_id: str,
+        supabase,
+        full: bool,
+        changed: Set[int],
+        deleted: Set[int],
+    ) -> int:
+        os.makedirs(self.directory, exist_ok=True)
+        previous = (
+            None if full else await asyncio.to_thread(self._load_previous, project_id, user_id)
+        )
+
+        try:
+            return await self._build_from(project_id, user_id, supabase, previous, changed, deleted)
+        finally:
+            if previous is not None:
+                previous[-1].close()
+
+    async def _build_from(
+        self, project_id: int, user_id: str, supabase, previous, changed: Set[int], deleted: Set[int]
+    ) -> int:
+        with tempfile.TemporaryFile(dir=self.directory) as encoded:
+            # (id, tipo, bbox, fichero, offset, longitud) de cada feature nueva o modificada
+            fresh: List[Tuple[int, int, Any, Any, int, int]] = []
+            if previous is None:
+                after_id = 0
+                while True:
+                    rows = await get_project_geometries_page(
+                        supabase, project_id, user_id, after_id, self.page_size
+                    )
+                    if not rows:
+                        break
+                    fresh += await asyncio.to_thread(_encode_rows, rows, encoded)
+                    after_id = max(int(row["id"]) for row in rows)
+            elif changed:
+                ids = sorted(changed)
+                for start in range(0, len(ids), self.page_size):
+                    rows = await get_project_geometries_by_ids(
+                        supabase, project_id, user_id, ids[start : start + self.page_size]
+                    )
+                    fresh += await asyncio.to_thread(_encode_rows, rows, encoded)
+
+            return await asyncio.to_thread(
+                self._write, project_id, user_id, previous, fresh, changed | deleted
+            )
+
+    def _load_previous(self, project_id: int, user_id: str):
+        """
+        Índice del snapshot actual y el fichero abierto del que copiar sus bytes
+        (sigue siendo legible aunque otro worker lo reemplace), o None si no hay
+        snapshot o su .ids no le corresponde.
+        """
+        path, sidecar = self.path(project_id, user_id), self._sidecar_path(project_id, user_id)
+        try:
+            old_file = open(path, "rb")
+        except FileNotFoundError:
+            return None
+        try:
+            with open(sidecar, "rb") as f:
+                header = f.read(_SIDECAR_HEADER.size)
+                if len(header) != _SIDECAR_HEADER.size:
+                    old_file.close()
+                    return None
+                count, size, mtime_ns, inode = _SIDECAR_HEADER.unpack(header)
+                stat = os.fstat(old_file.fileno())
+                if (size, mtime_ns, inode) != (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+                    old_file.close()
+                    return None
+                ids = array("q")
+                ids.fromfile(f, count)
+                types = f.read(count)
+            bboxes, offsets, features_start = read_leaves(old_file, count)
+        except (FileNotFoundError, EOFError):
+            old_file.close()
+            return None
+        except BaseException:
+            old_file.close()
+            raise
+        if len(types) != count or len(offsets) != count:
+            old_file.close()
+            return None
+        ends = offsets[1:] + [stat.st_size - features_start]
+        return ids, types, bboxes, offsets, ends, features_start, old_file
+
+    def _write(
+        self, project_id: int, user_id: str, previous, fresh, replaced: Set[int]
+    ) -> int:
+        path, sidecar = self.path(project_id, user_id), self._sidecar_path(project_id, user_id)
+        entries = []
+        tmp_paths = []
+        try:
+            if previous is not None:
+                ids, types, bboxes, offsets, ends, features_start, old_file = previous
+                for i, feature_id in enumerate(ids):
+                    if feature_id in replaced:
+                        continue
+                    entries.append(
+                        (
+                            feature_id,
+                            types[i],
+                            bboxes[i],
+                            old_file,
+                            features_start + offsets[i],
+                            ends[i] - offsets[i],
+                        )
+                    )
+            entries += fresh
+
+            kinds = {e[1] for e in entries}
+            geometry_type = kinds.pop() if len(kinds) == 1 else 0
+
+            tmp_path, tmp_sidecar = _mkstemp_for(path), _mkstemp_for(sidecar)
+            tmp_paths += [tmp_path, tmp_sidecar]
+            with open(tmp_path, "wb") as out:
+                order = write_flatgeobuf(
+                    out,
+                    f"project_{project_id}",
+                    geometry_type,
+                    [(e[2], e[3], e[4], e[5]) for e in entries],
+                )
+            stat = os.stat(tmp_path)
+            with open(tmp_sidecar, "wb") as out:
+                out.write(
+                    _SIDECAR_HEADER.pack(len(entries), stat.st_size, stat.st_mtime_ns, stat.st_ino)
+                )
+                array("q", (entries[i][0] for i in order)).tofile(out)
+                out.write(bytes(entries[i][1] for i in order))
+
+            # os.replace conserva inodo y mtime: el .ids sigue identificando a su .fgb
+            os.replace(tmp_path, path)
+            os.replace(tmp_sidecar, sidecar)
+        finally:
+            for leftover in tmp_paths:
+                if os.path.exists(leftover):
+                    os.unlink(leftover)
+        return len(entries)
+
+
+def _mkstemp_for(path: str) -> str:
+    """
+    Temporal con nombre único junto a path (para publicarlo con os.replace).
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".", suffix=".tmp"
+    )
+    os.close(fd)
+    return tmp_path
+
+
+def _encode_rows(rows: List[Dict[str, Any]], out) -> List[Tuple[int, int, Any, Any, int, int]]:
+    out.seek(0, os.SEEK_END)
+    encoded = []
+    for row in rows:
+        geometry = row.get("geometry")
+        if isinstance(geometry, str):
+            geometry = json.loads(geometry)
+        bbox = geometry_bbox(geometry) if geometry else None
+        if bbox is None:
+            continue  # sin coordenadas: no se puede indexar
+        data = encode_feature(geometry, row["id"], row.get("version"))
+        offset = out.tell()
+        out.write(data)
+        encoded.append(
+            (int(row["id"]), GEOMETRY_TYPES[geometry["type"]], bbox, out, offset, len(data))
+        )
+    return encoded
+
+
+snapshot_manager = SnapshotManager()
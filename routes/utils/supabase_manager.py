@@ -1,12 +1,15 @@
-from supabase import create_client, Client
+from supabase import AsyncClient, AsyncClientOptions, acreate_client
+import hashlib
 import os
-from dotenv import load_dotenv
+import time
 from fastapi import HTTPException, Cookie
-from typing import Annotated
-import jwt
+from typing import Annotated, Optional
 from datetime import datetime
 
-load_dotenv()
+from .cache import TTLCache
+from .http_pool import close_http_client, get_http_client
+from .jwt_verifier import TokenError, token_verifier
+from .tracing import span
 
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_ANON_KEY = os.getenv("SUPABASE_ANON_KEY")
@@ -14,16 +17,76 @@ SUPABASE_ANON_KEY = os.getenv("SUPABASE_ANON_KEY")
 if not SUPABASE_URL or not SUPABASE_ANON_KEY:
     raise ValueError("SUPABASE_URL and SUPABASE_ANON_KEY must be set in .env")
 
-supabase_client: Client = create_client(
-    SUPABASE_URL,
-    SUPABASE_ANON_KEY,
-)
+# Cliente asíncrono: las llamadas se hacen con await desde el event loop, sin
+# ocupar hilos del executor, sobre el pool HTTP/2 compartido
+_supabase_client: Optional[AsyncClient] = None
+
+
+def get_supabase_client() -> AsyncClient:
+    """
+    Cliente anónimo del proceso, creado en el primer uso sobre el pool actual.
+    """
+    global _supabase_client
+    if _supabase_client is None:
+        _supabase_client = AsyncClient(
+            SUPABASE_URL,
+            SUPABASE_ANON_KEY,
+            options=AsyncClientOptions(httpx_client=get_http_client()),
+        )
+    return _supabase_client
+
+# Clientes autenticados reutilizados entre peticiones del mismo token (cada uno
+# hasta el exp del token); todos comparten el pool HTTP de http_pool.py
+SUPABASE_CLIENT_CACHE_SIZE = int(os.getenv("SUPABASE_CLIENT_CACHE_SIZE", 1000))
+SUPABASE_CLIENT_CACHE_TTL = float(os.getenv("SUPABASE_CLIENT_CACHE_TTL", 3600))
+user_clients = TTLCache(maxsize=SUPABASE_CLIENT_CACHE_SIZE, ttl=SUPABASE_CLIENT_CACHE_TTL)
+user_client_stats = {"hits": 0, "misses": 0}
+
+
+async def client_for_token(access_token: str, expires_at: float) -> AsyncClient:
+    """
+    Cliente de Supabase autenticado con el token (ya verificado) del usuario.
+    """
+    key = hashlib.sha256(access_token.encode()).digest()
+    client = user_clients.get(key)
+    if client is not None:
+        user_client_stats["hits"] += 1
+        return client
+
+    user_client_stats["misses"] += 1
+    # El token ya está verificado: se envía tal cual en Authorization, sin
+    # set_session (que pedía /auth/v1/user a Supabase en cada petición)
+    client = await acreate_client(
+        SUPABASE_URL,
+        SUPABASE_ANON_KEY,
+        options=AsyncClientOptions(
+            headers={"Authorization": f"Bearer {access_token}"},
+            httpx_client=get_http_client(),
+            auto_refresh_token=False,
+            persist_session=False,
+        ),
+    )
+    ttl = min(SUPABASE_CLIENT_CACHE_TTL, expires_at - time.time())
+    if ttl > 0:
+        user_clients.set(key, client, ttl=ttl)
+    return client
+
+
+async def close_clients() -> None:
+    """
+    Cierra el pool HTTP al apagar el proceso. Los clientes de Supabase no tienen
+    conexiones propias (usan ese pool), así que basta con olvidarlos.
+    """
+    global _supabase_client
+    _supabase_client = None
+    user_clients.clear()
+    await close_http_client()
 
 
 async def get_authenticated_supabase_client(
     access_token: Annotated[str | None, Cookie()] = None,
     refresh_token: Annotated[str | None, Cookie()] = None,
-) -> tuple[Client, str]:
+) -> tuple[AsyncClient, str]:
     print(
         f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Auth check - access_token present: {bool(access_token)}, refresh_token present: {bool(refresh_token)}"
     )
@@ -33,7 +96,9 @@ async def get_authenticated_supabase_client(
         raise HTTPException(status_code=401, detail="Not authenticated")
 
     try:
-        payload = jwt.decode(access_token, options={"verify_signature": False})
+        # Firma y expiración verificadas localmente (sin ida y vuelta a Supabase)
+        with span("auth.verify"):
+            payload = await token_verifier.verify(access_token)
         user_id = payload.get("sub")
         if not user_id:
             print("No user_id in token payload")
@@ -41,10 +106,10 @@ async def get_authenticated_supabase_client(
         print(
             f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Successfully authenticated user: {user_id}"
         )
-    except jwt.DecodeError as e:
-        print(f"JWT decode error: {str(e)}")
+    except TokenError as e:
+        print(f"JWT verification error: {str(e)}")
         raise HTTPException(status_code=401, detail="Invalid token")
 
-    client = create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
-    client.auth.set_session(access_token, refresh_token)
+    with span("auth.client"):
+        client = await client_for_token(access_token, payload["exp"])
     return client, user_id
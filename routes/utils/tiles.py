@@ -0,0 +1,332 @@
+import asyncio
+import gzip
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from .geometry import BBox, geometry_bbox
+from .mvt import EXTENT, encode_tile, tile_bounds, tiles_for_bbox
+from .qgis_rpc import get_project_geometries_by_ids, get_project_geometries_page
+from .rebuilds import DebouncedProjectRebuilder, artifact_name
+
+# Directorio de los ficheros MBTiles por proyecto
+TILES_DIR = os.getenv("TILES_DIR", "tiles")
+# Zoom máximo de la pirámide si no se indica al sembrar
+TILES_MAX_ZOOM = int(os.getenv("TILES_MAX_ZOOM", 14))
+TILES_DEBOUNCE_SECONDS = float(os.getenv("TILES_DEBOUNCE_SECONDS", 5))
+TILES_PAGE_SIZE = int(os.getenv("TILES_PAGE_SIZE", 1000))
+# Tolerancia de simplificación por zoom, en píxeles de una tesela de 256 px. En
+# maxzoom no se simplifica: es el nivel que se sobreamplía al acercarse más
+TILES_SIMPLIFY_PIXELS = float(os.getenv("TILES_SIMPLIFY_PIXELS", 1))
+TILE_LAYER_NAME = "geometries"
+
+# MBTiles 1.3 + copia local de las geometrías (feature_data / feature_index, R*Tree)
+# para poder regenerar una tesela sin volver a consultar Postgres
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS tiles (
+    zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB
+);
+CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row);
+CREATE TABLE IF NOT EXISTS feature_data (id INTEGER PRIMARY KEY, version INTEGER, geometry TEXT);
+CREATE VIRTUAL TABLE IF NOT EXISTS feature_index USING rtree(id, minx, maxx, miny, maxy);
+"""
+
+
+class TileStore(DebouncedProjectRebuilder):
+    """
+    Pirámide de teselas vectoriales (MVT) precalculada por proyecto y usuario en
+    un fichero MBTiles; servir una tesela es una consulta por clave a SQLite.
+
+    Tras cada escritura solo se regeneran las teselas que tocan el bbox anterior
+    o nuevo de las features cambiadas, en todos los niveles hasta maxzoom.
+    """
+
+    label = "Teselas"
+
+    def __init__(
+        self,
+        directory: str = TILES_DIR,
+        debounce: float = TILES_DEBOUNCE_SECONDS,
+        page_size: int = TILES_PAGE_SIZE,
+        max_zoom: int = TILES_MAX_ZOOM,
+    ):
+        super().__init__(debounce)
+        self.directory = directory
+        self.page_size = page_size
+        self.max_zoom = max_zoom
+        self._seed_zoom: Dict[Tuple[int, str], int] = {}
+        self._local = threading.local()
+
+    def path(self, project_id: int, user_id: str) -> str:
+        return os.path.join(self.directory, f"{artifact_name(project_id, user_id)}.mbtiles")
+
+    def exists(self, project_id: int, user_id: str) -> bool:
+        return os.path.exists(self.path(project_id, user_id))
+
+    def seed(
+        self, project_id: int, user_id: str, supabase, max_zoom: Optional[int] = None
+    ) -> asyncio.Task:
+        """
+        Genera (o regenera) la pirámide completa hasta max_zoom.
+        """
+        self._seed_zoom[(project_id, str(user_id))] = (
+            self.max_zoom if max_zoom is None else max_zoom
+        )
+        return self.request_rebuild(project_id, user_id, supabase, full=True)
+
+    # --- Lectura ---
+
+    def _reader(self, project_id: int, user_id: str) -> sqlite3.Connection:
+        # Una conexión de solo lectura por hilo del pool de asyncio.to_thread;
+        # se reabre si una siembra completa ha sustituido el fichero
+        connections = getattr(self._local, "connections", None)
+        if connections is None:
+            connections = self._local.connections = {}
+        path = self.path(project_id, user_id)
+        inode = os.stat(path).st_ino
+        cached = connections.get(path)
+        if cached is None or cached[1] != inode:
+            if cached is not None:
+                cached[0].close()
+            conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=5)
+            cached = connections[path] = (conn, inode)
+        return cached[0]
+
+    def get_tile(
+        self, project_id: int, user_id: str, z: int, x: int, y: int
+    ) -> Optional[bytes]:
+        """
+        Tesela XYZ comprimida con gzip, o None si está vacía.
+        """
+        row = self._reader(project_id, user_id).execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (z, x, (1 << z) - 1 - y),  # MBTiles usa filas TMS (origen abajo)
+        ).fetchone()
+        return row[0] if row else None
+
+    def metadata(self, project_id: int, user_id: str) -> Dict[str, str]:
+        rows = self._reader(project_id, user_id).execute("SELECT name, value FROM metadata").fetchall()
+        return dict(rows)
+
+    # --- Escritura ---
+
+    async def _build(
+        self,
+        project_id: int,
+        user_id: str,
+        supabase,
+        full: bool,
+        changed: Set[int],
+        deleted: Set[int],
+    ) -> int:
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(project_id, user_id)
+        max_zoom = self._seed_zoom.pop((project_id, str(user_id)), None)
+        if max_zoom is None:
+            max_zoom = await asyncio.to_thread(self._stored_max_zoom, project_id, user_id)
+
+        if full or not os.path.exists(path):
+            # Siembra completa en un fichero nuevo, página a página (memoria acotada);
+            # las lecturas siguen sirviendo el anterior hasta el os.replace. Nombre
+            # temporal único: otro worker puede estar sembrando el mismo fichero
+            fd, tmp_path = tempfile.mkstemp(
+                dir=self.directory, prefix=os.path.basename(path) + ".", suffix=".tmp"
+            )
+            os.close(fd)
+            try:
+                conn = _open(tmp_path)
+                try:
+                    after_id = 0
+                    while True:
+                        page = await get_project_geometries_page(
+                            supabase, project_id, user_id, after_id, self.page_size
+                        )
+                        if not page:
+                            break
+                        await asyncio.to_thread(_store_features, conn, page)
+                        after_id = max(int(row["id"]) for row in page)
+                    count = await asyncio.to_thread(self._render_all, conn, project_id, max_zoom)
+                finally:
+                    conn.close()
+                os.replace(tmp_path, path)
+            except BaseException:
+                for leftover in (tmp_path, tmp_path + "-journal"):
+                    if os.path.exists(leftover):
+                        os.unlink(leftover)
+                raise
+            return count
+
+        rows: List[Dict[str, Any]] = []
+        ids = sorted(changed)
+        for start in range(0, len(ids), self.page_size):
+            rows += await get_project_geometries_by_ids(
+                supabase, project_id, user_id, ids[start : start + self.page_size]
+            )
+        return await asyncio.to_thread(
+            self._apply_changes, project_id, user_id, max_zoom, rows, changed | deleted
+        )
+
+    def _stored_max_zoom(self, project_id: int, user_id: str) -> int:
+        if not self.exists(project_id, user_id):
+            return self.max_zoom
+        return int(self.metadata(project_id, user_id).get("maxzoom", self.max_zoom))
+
+    def _render_all(self, conn: sqlite3.Connection, project_id: int, max_zoom: int) -> int:
+        bboxes = [
+            (r[0], r[2], r[1], r[3])
+            for r in conn.execute("SELECT minx, maxx, miny, maxy FROM feature_index")
+        ]
+        tiles = _render_tiles(conn, _tiles_for_bboxes(bboxes, max_zoom), max_zoom)
+        self._write_metadata(conn, project_id, max_zoom)
+        conn.commit()
+        print(f"Teselas del proyecto {project_id}: {tiles} generadas (z0-{max_zoom})")
+        return len(bboxes)
+
+    def _apply_changes(
+        self,
+        project_id: int,
+        user_id: str,
+        max_zoom: int,
+        rows: List[Dict[str, Any]],
+        replaced: Set[int],
+    ) -> int:
+        conn = _open(self.path(project_id, user_id))
+        try:
+            with conn:
+                # bbox anterior de las features cambiadas o borradas
+                dirty: List[BBox] = []
+                ids = list(replaced)
+                for start in range(0, len(ids), 500):
+                    batch = ids[start : start + 500]
+                    marks = ",".join("?" * len(batch))
+                    dirty += [
+                        (r[0], r[2], r[1], r[3])
+                        for r in conn.execute(
+                            f"SELECT minx, maxx, miny, maxy FROM feature_index WHERE id IN ({marks})",
+                            batch,
+                        )
+                    ]
+                    conn.execute(f"DELETE FROM feature_data WHERE id IN ({marks})", batch)
+                    conn.execute(f"DELETE FROM feature_index WHERE id IN ({marks})", batch)
+                # ... y el nuevo
+                dirty += _store_features(conn, rows)
+                tiles = _render_tiles(conn, _tiles_for_bboxes(dirty, max_zoom), max_zoom)
+                self._write_metadata(conn, project_id, max_zoom)
+            print(f"Teselas del proyecto {project_id}: {tiles} regeneradas (z0-{max_zoom})")
+            return conn.execute("SELECT COUNT(*) FROM feature_data").fetchone()[0]
+        finally:
+            conn.close()
+
+    def _write_metadata(self, conn: sqlite3.Connection, project_id: int, max_zoom: int) -> None:
+        extent = conn.execute(
+            "SELECT MIN(minx), MIN(miny), MAX(maxx), MAX(maxy) FROM feature_index"
+        ).fetchone()
+        bounds = extent if extent[0] is not None else (-180.0, -85.0511, 180.0, 85.0511)
+        metadata = {
+            "name": f"project_{project_id}",
+            "format": "pbf",
+            "type": "overlay",
+            "version": "1",
+            "minzoom": "0",
+            "maxzoom": str(max_zoom),
+            "bounds": ",".join(f"{v:.6f}" for v in bounds),
+            "center": f"{(bounds[0] + bounds[2]) / 2:.6f},{(bounds[1] + bounds[3]) / 2:.6f},{min(max_zoom, 10)}",
+            "json": json.dumps(
+                {
+                    "vector_layers": [
+                        {
+                            "id": TILE_LAYER_NAME,
+                            "fields": {"id": "Number", "version": "Number"},
+                            "minzoom": 0,
+                            "maxzoom": max_zoom,
+                        }
+                    ]
+                }
+            ),
+        }
+        conn.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?)", metadata.items())
+
+
+def _open(path: str) -> sqlite3.Connection:
+    # Se usa desde varios hilos de asyncio.to_thread, nunca a la vez
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def _store_features(conn: sqlite3.Connection, rows: List[Dict[str, Any]]) -> List[BBox]:
+    bboxes = []
+    for row in rows:
+        geometry = row.get("geometry")
+        if isinstance(geometry, str):
+            geometry = json.loads(geometry)
+        bbox = geometry_bbox(geometry) if geometry else None
+        if bbox is None:
+            continue  # sin coordenadas: no aparece en ninguna tesela
+        conn.execute(
+            "INSERT OR REPLACE INTO feature_data (id, version, geometry) VALUES (?, ?, ?)",
+            (int(row["id"]), row.get("version"), json.dumps(geometry)),
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO feature_index VALUES (?, ?, ?, ?, ?)",
+            (int(row["id"]), bbox[0], bbox[2], bbox[1], bbox[3]),
+        )
+        bboxes.append(bbox)
+    return bboxes
+
+
+def _render_tiles(
+    conn: sqlite3.Connection, tiles: Iterable[Tuple[int, int, int]], max_zoom: int
+) -> int:
+    count = 0
+    for z, x, y in tiles:
+        tolerance = 0.0 if z >= max_zoom else TILES_SIMPLIFY_PIXELS * EXTENT / 256
+        data = _render_tile(conn, z, x, y, tolerance)
+        tms_y = (1 << z) - 1 - y
+        if data is None:
+            conn.execute(
+                "DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                (z, x, tms_y),
+            )
+        else:
+            conn.execute("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)", (z, x, tms_y, data))
+        count += 1
+    return count
+
+
+def _tiles_for_bboxes(bboxes: Iterable[BBox], max_zoom: int) -> Set[Tuple[int, int, int]]:
+    tiles: Set[Tuple[int, int, int]] = set()
+    bboxes = list(bboxes)
+    for z in range(max_zoom + 1):
+        for bbox in bboxes:
+            tiles.update((z, x, y) for x, y in tiles_for_bbox(bbox, z))
+    return tiles
+
+
+def _render_tile(
+    conn: sqlite3.Connection, z: int, x: int, y: int, tolerance: float = 0.0
+) -> Optional[bytes]:
+    minx, miny, maxx, maxy = tile_bounds(z, x, y)
+    # Margen equivalente al BUFFER de la tesela (1/64 del lado)
+    pad_x, pad_y = (maxx - minx) / 64, (maxy - miny) / 64
+    rows = conn.execute(
+        """
+        SELECT d.id, d.version, d.geometry
+        FROM feature_index i JOIN feature_data d ON d.id = i.id
+        WHERE i.minx <= ? AND i.maxx >= ? AND i.miny <= ? AND i.maxy >= ?
+        """,
+        (maxx + pad_x, minx - pad_x, maxy + pad_y, miny - pad_y),
+    )
+    features = (
+        (feature_id, json.loads(geometry), {"id": feature_id, "version": version})
+        for feature_id, version, geometry in rows
+    )
+    data = encode_tile(TILE_LAYER_NAME, features, z, x, y, tolerance)
+    return gzip.compress(data) if data else None
+
+
+tile_store = TileStore()
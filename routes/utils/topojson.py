@@ -0,0 +1,190 @@
+import json
+import math
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from .geometry import bbox_union, geometry_bbox
+
+# Codificación TopoJSON (https://github.com/topojson/topojson-specification):
+# las aristas compartidas entre polígonos vecinos se guardan una sola vez como
+# "arcs", cuantizadas a una rejilla entera y codificadas en deltas.
+# El plugin tiene el decodificador (topojson_a_features en main.py).
+
+QPoint = Tuple[int, int]
+
+
+def to_topology(
+    rows: Sequence[Dict[str, Any]], precision: int = 9, object_name: str = "features"
+) -> Dict[str, Any]:
+    """
+    Convierte las filas de get_geometries_in_extent ({id, geometry, ...resto})
+    en un objeto Topology. precision = decimales de la rejilla de cuantización
+    (9 conserva las coordenadas tal y como las compara geometry_hash).
+    """
+    geometries_in = []
+    bbox = None
+    for row in rows:
+        geometry = row.get("geometry")
+        if isinstance(geometry, str):
+            geometry = json.loads(geometry)
+        if geometry:
+            bbox = bbox_union(bbox, geometry_bbox(geometry))
+        geometries_in.append(geometry)
+
+    scale = 10.0 ** -precision
+    x0 = math.floor(bbox[0] / scale) * scale if bbox else 0.0
+    y0 = math.floor(bbox[1] / scale) * scale if bbox else 0.0
+
+    def quantize(position: Sequence[float]) -> QPoint:
+        return round((position[0] - x0) / scale), round((position[1] - y0) / scale)
+
+    builder = _ArcBuilder()
+    geometries = []
+    for row, geometry in zip(rows, geometries_in):
+        obj = _convert(geometry, quantize, builder) if geometry else {"type": None}
+        obj["id"] = row.get("id")
+        obj["properties"] = {k: v for k, v in row.items() if k not in ("id", "geometry")}
+        geometries.append(obj)
+
+    arcs = builder.finish()
+    return {
+        "type": "Topology",
+        "bbox": list(bbox) if bbox else None,
+        "transform": {"scale": [scale, scale], "translate": [x0, y0]},
+        "objects": {object_name: {"type": "GeometryCollection", "geometries": geometries}},
+        "arcs": [_delta_encode(arc) for arc in arcs],
+    }
+
+
+def _dedupe(points: List[QPoint]) -> List[QPoint]:
+    out: List[QPoint] = []
+    for p in points:
+        if not out or out[-1] != p:
+            out.append(p)
+    return out
+
+
+class _ArcBuilder:
+    """
+    Dos pasadas, como topojson-server: primero se registran todas las líneas y
+    anillos para detectar los nodos (vértices con vecinos distintos según la
+    geometría que los usa); después se cortan en arcos y se reutilizan los
+    arcos iguales, en cualquier sentido (índice ~i = arco i invertido).
+    """
+
+    def __init__(self):
+        # Por vértice: par de vecinos visto la primera vez, o None si es nodo
+        self._neighbors: Dict[QPoint, Optional[Tuple[QPoint, QPoint]]] = {}
+        self._pending: List[Tuple[List[QPoint], bool, List[int]]] = []
+        self._arcs: List[List[QPoint]] = []
+        self._index: Dict[Tuple[QPoint, ...], int] = {}
+
+    def _visit(self, point: QPoint, prev: QPoint, nxt: QPoint) -> None:
+        if point not in self._neighbors:
+            self._neighbors[point] = (prev, nxt)
+            return
+        seen = self._neighbors[point]
+        if seen is not None and seen != (prev, nxt) and seen != (nxt, prev):
+            self._neighbors[point] = None
+
+    def add_line(self, points: List[QPoint]) -> List[int]:
+        """
+        Registra una línea; devuelve la lista (aún vacía) que finish() rellena
+        con los índices de sus arcos.
+        """
+        for i, p in enumerate(points):
+            if i == 0 or i == len(points) - 1:
+                self._neighbors[p] = None  # los extremos siempre son nodo
+            else:
+                self._visit(p, points[i - 1], points[i + 1])
+        refs: List[int] = []
+        self._pending.append((points, False, refs))
+        return refs
+
+    def add_ring(self, points: List[QPoint]) -> List[int]:
+        n = len(points)
+        for i, p in enumerate(points):
+            self._visit(p, points[i - 1], points[(i + 1) % n])
+        if points:
+            # El vértice inicial también es nodo: el anillo decodificado empieza en
+            # el mismo punto y geometry_hash coincide con el original
+            self._neighbors[points[0]] = None
+        refs: List[int] = []
+        self._pending.append((points, True, refs))
+        return refs
+
+    def finish(self) -> List[List[QPoint]]:
+        for points, closed, refs in self._pending:
+            refs.extend(self._cut(points, closed))
+        return self._arcs
+
+    def _is_node(self, point: QPoint) -> bool:
+        return self._neighbors.get(point) is None
+
+    def _cut(self, points: List[QPoint], closed: bool) -> List[int]:
+        if not points:
+            return []
+        if closed:
+            points = points + points[:1]
+        refs = []
+        current = [points[0]]
+        for p in points[1:]:
+            current.append(p)
+            if self._is_node(p):
+                refs.append(self._arc(current))
+                current = [p]
+        if len(current) > 1:
+            refs.append(self._arc(current))
+        return refs
+
+    def _arc(self, points: List[QPoint]) -> int:
+        key = tuple(points)
+        if key in self._index:
+            return self._index[key]
+        reverse = tuple(reversed(points))
+        if reverse in self._index:
+            return ~self._index[reverse]
+        self._index[key] = len(self._arcs)
+        self._arcs.append(points)
+        return len(self._arcs) - 1
+
+
+def _convert(geometry: Dict[str, Any], quantize, builder: _ArcBuilder) -> Dict[str, Any]:
+    geom_type = geometry.get("type")
+    coords = geometry.get("coordinates")
+
+    def line(points):
+        return builder.add_line(_dedupe([quantize(p) for p in points]))
+
+    def ring(points):
+        quantized = _dedupe([quantize(p) for p in points])
+        if len(quantized) > 1 and quantized[0] == quantized[-1]:
+            quantized.pop()
+        return builder.add_ring(quantized)
+
+    if geom_type == "Point":
+        return {"type": geom_type, "coordinates": list(quantize(coords)) if coords else []}
+    if geom_type == "MultiPoint":
+        return {"type": geom_type, "coordinates": [list(quantize(p)) for p in coords]}
+    if geom_type == "LineString":
+        return {"type": geom_type, "arcs": line(coords)}
+    if geom_type == "MultiLineString":
+        return {"type": geom_type, "arcs": [line(part) for part in coords]}
+    if geom_type == "Polygon":
+        return {"type": geom_type, "arcs": [ring(r) for r in coords]}
+    if geom_type == "MultiPolygon":
+        return {"type": geom_type, "arcs": [[ring(r) for r in polygon] for polygon in coords]}
+    if geom_type == "GeometryCollection":
+        return {
+            "type": geom_type,
+            "geometries": [_convert(g, quantize, builder) for g in geometry.get("geometries") or []],
+        }
+    raise ValueError(f"Tipo de geometría no soportado: {geom_type}")
+
+
+def _delta_encode(arc: List[QPoint]) -> List[List[int]]:
+    out = []
+    px = py = 0
+    for x, y in arc:
+        out.append([x - px, y - py])
+        px, py = x, y
+    return out
@@ -0,0 +1,148 @@
+import json
+import os
+import re
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional, Tuple
+
+# Cabecera Server-Timing en todas las respuestas (SERVER_TIMING=0 la desactiva)
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING", "1").lower() not in ("0", "false", "no")
+# Registros estructurados por petición (una línea JSON): "stdout" o ruta de un fichero JSONL
+TRACE_RECORDS = os.getenv("TRACE_RECORDS")
+# Solo se registran las peticiones que tardan al menos esto (ms)
+TRACE_RECORDS_MIN_MS = float(os.getenv("TRACE_RECORDS_MIN_MS", 0))
+
+_NOT_TOKEN = re.compile(r"[^A-Za-z0-9!#$%&'*+\-.^_`|~]")
+
+
+class Trace:
+    """
+    Tramos (spans) de una petición: (nombre, inicio relativo, duración), en segundos.
+    """
+
+    __slots__ = ("trace_id", "started", "spans")
+
+    def __init__(self):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.started = time.perf_counter()
+        self.spans: List[Tuple[str, float, float]] = []
+
+    def add(self, name: str, started: float, duration: float) -> None:
+        self.spans.append((name, started - self.started, duration))
+
+    def server_timing(self, total: float) -> str:
+        # Los tramos con el mismo nombre (p. ej. varios lotes del mismo RPC) se suman
+        durations: Dict[str, float] = {}
+        for name, _, duration in self.spans:
+            durations[name] = durations.get(name, 0.0) + duration
+        parts = [
+            f"{_NOT_TOKEN.sub('_', name)};dur={duration * 1000:.1f}"
+            for name, duration in durations.items()
+        ]
+        parts.append(f"total;dur={total * 1000:.1f}")
+        return ", ".join(parts)
+
+
+_current: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current.get()
+
+
+@contextmanager
+def span(name: str):
+    """
+    Mide el bloque como un tramo de la traza de la petición en curso
+    (no hace nada fuera de una petición, p. ej. en los jobs en segundo plano).
+    """
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, started, time.perf_counter() - started)
+
+
+class _RecordWriter:
+    def __init__(self, target: Optional[str]):
+        self.target = target
+        self._file = None
+
+    def write(self, record: Dict[str, Any]) -> None:
+        line = json.dumps(record, separators=(",", ":"))
+        if self.target == "stdout":
+            print(line)
+            return
+        if self._file is None:
+            self._file = open(self.target, "a", buffering=1, encoding="utf-8")
+        self._file.write(line + "\n")
+
+
+trace_records = _RecordWriter(TRACE_RECORDS)
+
+
+class TracingMiddleware:
+    """
+    Middleware ASGI: abre la traza de cada petición, añade la cabecera
+    Server-Timing (tramos hasta que empieza la respuesta + total) y, con
+    TRACE_RECORDS, escribe un registro JSON por petición con todos los tramos.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not (SERVER_TIMING_ENABLED or TRACE_RECORDS):
+            await self.app(scope, receive, send)
+            return
+
+        trace = Trace()
+        token = _current.set(trace)
+        status = [500]
+
+        async def send_timed(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                if SERVER_TIMING_ENABLED:
+                    value = trace.server_timing(time.perf_counter() - trace.started)
+                    message = {
+                        **message,
+                        "headers": [
+                            *message.get("headers", []),
+                            (b"server-timing", value.encode("latin-1")),
+                        ],
+                    }
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            _current.reset(token)
+            total = time.perf_counter() - trace.started
+            if TRACE_RECORDS and total * 1000 >= TRACE_RECORDS_MIN_MS:
+                route = scope.get("route")
+                trace_records.write(
+                    {
+                        "trace_id": trace.trace_id,
+                        "time": time.time(),
+                        "method": scope["method"],
+                        "path": scope["path"],
+                        "route": getattr(route, "path", None),
+                        "status": status[0],
+                        "duration_ms": round(total * 1000, 3),
+                        "spans": [
+                            {
+                                "name": name,
+                                "start_ms": round(start * 1000, 3),
+                                "duration_ms": round(duration * 1000, 3),
+                            }
+                            for name, start, duration in trace.spans
+                        ],
+                    }
+                )
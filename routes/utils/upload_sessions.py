@@ -0,0 +1,351 @@
+import asyncio
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+UPLOAD_SESSION_TTL_SECONDS = float(os.getenv("UPLOAD_SESSION_TTL_SECONDS", 6 * 3600))
+# Sesiones compartidas por todos los workers de uvicorn de la máquina (fichero SQLite)
+UPLOAD_SESSION_DB = os.getenv(
+    "UPLOAD_SESSION_DB", os.path.join(tempfile.gettempdir(), "bridge_upload_sessions.sqlite3")
+)
+# Un chunk "en curso" más antiguo que esto se da por abandonado (worker caído)
+UPLOAD_CHUNK_CLAIM_TIMEOUT_SECONDS = float(os.getenv("UPLOAD_CHUNK_CLAIM_TIMEOUT_SECONDS", 600))
+# Cada cuánto se consulta un chunk que está procesando otra petición
+UPLOAD_CHUNK_POLL_SECONDS = 0.2
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS upload_sessions (
+    session_id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    project_id INTEGER NOT NULL,
+    layer_name TEXT NOT NULL,
+    total_chunks INTEGER,
+    dedupe_tolerance_m REAL,
+    finalized INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS upload_chunks (
+    session_id TEXT NOT NULL,
+    chunk_index INTEGER NOT NULL,
+    body_hash TEXT NOT NULL,
+    result TEXT,
+    claimed_at REAL NOT NULL,
+    PRIMARY KEY (session_id, chunk_index)
+) WITHOUT ROWID;
+"""
+
+
+class ChunkConflict(Exception):
+    """
+    Chunk rechazado: otro cuerpo con el mismo índice o sesión ya finalizada (409).
+    """
+
+
+@dataclass
+class UploadSession:
+    session_id: str
+    user_id: str
+    project_id: int
+    layer_name: str
+    total_chunks: Optional[int] = None
+    dedupe_tolerance_m: Optional[float] = None
+    # índice de chunk -> resumen devuelto por el pipeline de inserción
+    committed: Dict[int, Dict[str, Any]] = field(default_factory=dict)
+    # índice de chunk -> hash del cuerpo con el que se recibió
+    body_hashes: Dict[int, str] = field(default_factory=dict)
+    in_flight: Set[int] = field(default_factory=set)
+    finalized: bool = False
+    created_at: float = field(default_factory=time.time)
+
+    def missing(self) -> List[int]:
+        if self.total_chunks is None:
+            return []
+        return [
+            i
+            for i in range(self.total_chunks)
+            if i not in self.committed and i not in self.in_flight
+        ]
+
+    def summary(self) -> Dict[str, Any]:
+        results = [self.committed[i] for i in sorted(self.committed)]
+        errors = [e for r in results for e in (r.get("errors") or [])]
+        return {
+            "session_id": self.session_id,
+            "layer_name": self.layer_name,
+            "project_id": self.project_id,
+            "total_chunks": self.total_chunks,
+            "received": sorted(self.committed),
+            "in_progress": sorted(self.in_flight),
+            "missing": self.missing(),
+            "finalized": self.finalized,
+            "inserted": sum(r.get("inserted", 0) for r in results),
+            "duplicates": sum(r.get("duplicates", 0) for r in results),
+            "errors": errors or None,
+        }
+
+
+class UploadSessionStore:
+    """
+    Sesiones de subida por chunks en un fichero SQLite (modo WAL), compartidas
+    entre los workers: el PUT de un chunk, el GET de estado y el finalize
+    pueden llegar a procesos distintos.
+
+    Cada chunk se reclama de forma atómica antes de procesarlo (fila en
+    upload_chunks con el hash de su cuerpo), se inserta y se confirma con su
+    resumen. Un reenvío del mismo chunk devuelve ese resumen (o espera a que
+    termine si otro proceso lo está insertando); el mismo índice con otro
+    cuerpo es un conflicto. Las sesiones inactivas caducan.
+
+    Los métodos son síncronos (SQLite): desde el event loop se llaman con
+    asyncio.to_thread.
+    """
+
+    def __init__(self, path: str = UPLOAD_SESSION_DB, ttl: float = UPLOAD_SESSION_TTL_SECONDS):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def create(
+        self,
+        user_id: str,
+        project_id: int,
+        layer_name: str,
+        total_chunks: Optional[int] = None,
+        dedupe_tolerance_m: Optional[float] = None,
+    ) -> UploadSession:
+        now = time.time()
+        session = UploadSession(
+            session_id=uuid.uuid4().hex,
+            user_id=str(user_id),
+            project_id=project_id,
+            layer_name=layer_name,
+            total_chunks=total_chunks,
+            dedupe_tolerance_m=dedupe_tolerance_m,
+            created_at=now,
+        )
+        conn = self._conn()
+        conn.execute(
+            "INSERT INTO upload_sessions (session_id, user_id, project_id, layer_name,"
+            " total_chunks, dedupe_tolerance_m, created_at, expires_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                session.session_id,
+                session.user_id,
+                project_id,
+                layer_name,
+                total_chunks,
+                dedupe_tolerance_m,
+                now,
+                now + self.ttl,
+            ),
+        )
+        self._purge(conn, now)
+        return session
+
+    def get(self, session_id: str, user_id: str) -> Optional[UploadSession]:
+        conn = self._conn()
+        now = time.time()
+        row = conn.execute(
+            "SELECT user_id, project_id, layer_name, total_chunks, dedupe_tolerance_m,"
+            " finalized, created_at FROM upload_sessions"
+            " WHERE session_id = ? AND expires_at > ?",
+            (session_id, now),
+        ).fetchone()
+        if row is None or row[0] != str(user_id):
+            return None
+        # Cada acceso renueva la caducidad
+        conn.execute(
+            "UPDATE upload_sessions SET expires_at = ? WHERE session_id = ?",
+            (now + self.ttl, session_id),
+        )
+        session = UploadSession(
+            session_id=session_id,
+            user_id=row[0],
+            project_id=row[1],
+            layer_name=row[2],
+            total_chunks=row[3],
+            dedupe_tolerance_m=row[4],
+            finalized=bool(row[5]),
+            created_at=row[6],
+        )
+        stale_before = now - UPLOAD_CHUNK_CLAIM_TIMEOUT_SECONDS
+        for index, body_hash, result, claimed_at in conn.execute(
+            "SELECT chunk_index, body_hash, result, claimed_at FROM upload_chunks"
+            " WHERE session_id = ?",
+            (session_id,),
+        ):
+            if result is not None:
+                session.committed[index] = json.loads(result)
+                session.body_hashes[index] = body_hash
+            elif claimed_at > stale_before:
+                session.in_flight.add(index)
+        return session
+
+    def claim_chunk(
+        self, session_id: str, index: int, body_hash: str
+    ) -> Tuple[str, Optional[Dict[str, Any]]]:
+        """
+        Reclama el chunk para procesarlo. Devuelve:
+        ("claimed", None)       -> lo procesa esta petición
+        ("committed", resumen)  -> ya estaba confirmado con el mismo cuerpo
+        ("in_flight", None)     -> lo está procesando otra petición
+        Lanza ChunkConflict si el índice ya tiene otro cuerpo o la sesión está finalizada.
+        """
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT body_hash, result, claimed_at FROM upload_chunks"
+                " WHERE session_id = ? AND chunk_index = ?",
+                (session_id, index),
+            ).fetchone()
+            if row is not None:
+                stored_hash, result, claimed_at = row
+                if stored_hash != body_hash:
+                    raise ChunkConflict(
+                        f"El chunk {index} ya se recibió con un contenido distinto"
+                    )
+                if result is not None:
+                    return "committed", json.loads(result)
+                if claimed_at > now - UPLOAD_CHUNK_CLAIM_TIMEOUT_SECONDS:
+                    return "in_flight", None
+
+            (finalized,) = conn.execute(
+                "SELECT finalized FROM upload_sessions WHERE session_id = ?", (session_id,)
+            ).fetchone() or (1,)
+            if finalized:
+                raise ChunkConflict("La sesión de subida ya está finalizada")
+            conn.execute(
+                "INSERT OR REPLACE INTO upload_chunks"
+                " (session_id, chunk_index, body_hash, result, claimed_at)"
+                " VALUES (?, ?, ?, NULL, ?)",
+                (session_id, index, body_hash, now),
+            )
+            return "claimed", None
+        finally:
+            conn.execute("COMMIT")
+
+    def commit_chunk(self, session_id: str, index: int, result: Dict[str, Any]) -> None:
+        self._conn().execute(
+            "UPDATE upload_chunks SET result = ? WHERE session_id = ? AND chunk_index = ?",
+            (json.dumps(result), session_id, index),
+        )
+
+    def release_chunk(self, session_id: str, index: int) -> None:
+        """
+        Libera un chunk cuyo procesamiento falló, para que el cliente lo reintente.
+        """
+        self._conn().execute(
+            "DELETE FROM upload_chunks WHERE session_id = ? AND chunk_index = ? AND result IS NULL",
+            (session_id, index),
+        )
+
+    def chunk_result(self, session_id: str, index: int) -> Tuple[str, Optional[Dict[str, Any]]]:
+        """
+        Estado de un chunk reclamado por otra petición: "committed" (con su
+        resumen), "in_flight" o "released" (falló o se abandonó).
+        """
+        row = self._conn().execute(
+            "SELECT result, claimed_at FROM upload_chunks WHERE session_id = ? AND chunk_index = ?",
+            (session_id, index),
+        ).fetchone()
+        if row is None or (
+            row[0] is None and row[1] <= time.time() - UPLOAD_CHUNK_CLAIM_TIMEOUT_SECONDS
+        ):
+            return "released", None
+        if row[0] is not None:
+            return "committed", json.loads(row[0])
+        return "in_flight", None
+
+    def finalize(self, session_id: str) -> Optional[UploadSession]:
+        """
+        Marca la sesión como finalizada si no le faltan chunks ni tiene alguno
+        en curso. Devuelve la sesión (finalized=False si no se pudo cerrar).
+        """
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT user_id FROM upload_sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            session = self.get(session_id, row[0])
+            if session is not None and not session.in_flight and not session.missing():
+                conn.execute(
+                    "UPDATE upload_sessions SET finalized = 1 WHERE session_id = ?", (session_id,)
+                )
+                session.finalized = True
+            return session
+        finally:
+            conn.execute("COMMIT")
+
+    def delete(self, session_id: str) -> None:
+        conn = self._conn()
+        conn.execute("DELETE FROM upload_chunks WHERE session_id = ?", (session_id,))
+        conn.execute("DELETE FROM upload_sessions WHERE session_id = ?", (session_id,))
+
+    def _purge(self, conn: sqlite3.Connection, now: float) -> None:
+        expired = [
+            row[0]
+            for row in conn.execute(
+                "SELECT session_id FROM upload_sessions WHERE expires_at <= ?", (now,)
+            )
+        ]
+        for session_id in expired:
+            self.delete(session_id)
+
+
+upload_sessions = UploadSessionStore()
+
+
+async def run_chunk_once(
+    session: UploadSession, index: int, body_hash: str, func
+) -> Tuple[Dict[str, Any], bool]:
+    """
+    Procesa el chunk una sola vez entre todos los workers. Devuelve (resumen, replayed).
+    Lanza ChunkConflict (409) si el índice ya tiene otro cuerpo.
+    """
+    while True:
+        state, result = await asyncio.to_thread(
+            upload_sessions.claim_chunk, session.session_id, index, body_hash
+        )
+        if state == "committed":
+            return result, True
+        if state == "claimed":
+            break
+        # Otra petición (quizá en otro worker) lo está insertando: se espera a su resultado
+        while state == "in_flight":
+            await asyncio.sleep(UPLOAD_CHUNK_POLL_SECONDS)
+            state, result = await asyncio.to_thread(
+                upload_sessions.chunk_result, session.session_id, index
+            )
+        if state == "committed":
+            return result, True
+        # "released": la otra petición falló; se vuelve a intentar reclamarlo
+
+    try:
+        result = await func()
+    except BaseException:
+        await asyncio.to_thread(upload_sessions.release_chunk, session.session_id, index)
+        raise
+    await asyncio.to_thread(upload_sessions.commit_chunk, session.session_id, index, result)
+    return result, False
@@ -0,0 +1,90 @@
+import asyncio
+import glob
+import os
+import time
+from typing import Any, Dict, List
+
+from .http_pool import get_http_client
+from .jwt_verifier import token_verifier
+from .rebuilds import artifact_prefix
+from .snapshots import snapshot_manager
+from .supabase_manager import SUPABASE_ANON_KEY, SUPABASE_URL
+from .tiles import tile_store
+
+# Calentamiento al arrancar, antes de dar el servidor por listo (/health)
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "1").lower() not in ("0", "false", "no")
+# Tope del calentamiento completo: si se supera, el servidor se da por listo igualmente
+WARMUP_TIMEOUT_SECONDS = float(os.getenv("WARMUP_TIMEOUT_SECONDS", 15))
+# Proyectos cuyos snapshots y teselas se leen al arrancar (ids separados por comas)
+WARMUP_PROJECT_IDS = [
+    int(p) for p in os.getenv("WARMUP_PROJECT_IDS", "").split(",") if p.strip()
+]
+# Bytes de cada snapshot que se leen para dejarlos en la caché de páginas del SO
+WARMUP_SNAPSHOT_BYTES = int(os.getenv("WARMUP_SNAPSHOT_BYTES", 64 * 1024 * 1024))
+
+
+async def _open_connections() -> Dict[str, Any]:
+    # GoTrue /health es barato y no requiere sesión: deja abierta (TCP + TLS +
+    # HTTP/2) la conexión del pool que usarán después PostgREST y Auth
+    response = await get_http_client().get(
+        f"{SUPABASE_URL.rstrip('/')}/auth/v1/health",
+        headers={"apikey": SUPABASE_ANON_KEY},
+        timeout=5,
+    )
+    return {"status_code": response.status_code}
+
+
+def _project_files(directory: str, project_id: int, extension: str) -> List[str]:
+    # Snapshots y teselas son por proyecto y usuario: se leen los de todos los usuarios
+    return glob.glob(os.path.join(directory, f"{artifact_prefix(project_id)}*{extension}"))
+
+
+def _read_file(path: str) -> int:
+    read = 0
+    with open(path, "rb") as f:
+        while read < WARMUP_SNAPSHOT_BYTES:
+            chunk = f.read(min(1024 * 1024, WARMUP_SNAPSHOT_BYTES - read))
+            if not chunk:
+                break
+            read += len(chunk)
+    return read
+
+
+async def _prime_projects(project_ids: List[int]) -> Dict[str, Any]:
+    snapshot_bytes = 0
+    tiles = 0
+    for project_id in project_ids:
+        for path in _project_files(snapshot_manager.directory, project_id, ".fgb"):
+            snapshot_bytes += await asyncio.to_thread(_read_file, path)
+        for path in _project_files(tile_store.directory, project_id, ".mbtiles"):
+            await asyncio.to_thread(_read_file, path)
+            tiles += 1
+    return {"projects": len(project_ids), "snapshot_bytes": snapshot_bytes, "tilesets": tiles}
+
+
+async def _step(report: Dict[str, Any], name: str, coro) -> None:
+    started = time.perf_counter()
+    try:
+        result = await coro
+        report[name] = {"ok": True, **(result or {})}
+    except Exception as e:
+        # Un paso fallido no impide arrancar: la primera petición lo hará en frío
+        print(f"Calentamiento: {name} falló: {type(e).__name__}: {e}")
+        report[name] = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+    report[name]["seconds"] = round(time.perf_counter() - started, 3)
+
+
+async def warm_up() -> Dict[str, Any]:
+    """
+    Prepara el proceso antes de recibir tráfico: JWKS cargado, conexión al
+    pool de Supabase abierta y snapshots/teselas de WARMUP_PROJECT_IDS leídos
+    del disco. Devuelve un informe por paso (se muestra en /health).
+    """
+    report: Dict[str, Any] = {}
+    # El JWKS siempre: sin él la primera petición autenticada lo descargaría
+    await _step(report, "jwks", token_verifier.start())
+    if WARMUP_ENABLED:
+        await _step(report, "connections", _open_connections())
+        if WARMUP_PROJECT_IDS:
+            await _step(report, "projects", _prime_projects(WARMUP_PROJECT_IDS))
+    return report
@@ -0,0 +1,146 @@
+import asyncio
+import os
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from .metrics import FEATURES_INSERTED
+from .qgis_rpc import insert_geometries_batch, rpc_rows
+
+WRITE_BUFFER_DELAY_MS = float(os.getenv("WRITE_BUFFER_DELAY_MS", 2))
+WRITE_BUFFER_MAX_FEATURES = int(os.getenv("WRITE_BUFFER_MAX_FEATURES", 500))
+
+
+@dataclass
+class _Group:
+    supabase: Any
+    # (geometría, futuro con su resultado)
+    pending: List[Tuple[Dict[str, Any], asyncio.Future]] = field(default_factory=list)
+    timer: Optional[asyncio.TimerHandle] = None
+    flushing: bool = False
+
+
+class WriteBuffer:
+    """
+    Group commit de inserciones: junta las geometrías pendientes de peticiones
+    concurrentes y las escribe con un único insert_geometries_batch.
+
+    - Se agrupa por (usuario, proyecto): el RPC se lanza con el cliente
+      autenticado del propio usuario (RLS y created_by = p_user_id), nunca con
+      el de otro. Cada envío renueva el cliente del grupo, así que un grupo que
+      sigue vivo no se queda con un token caducado.
+    - Un lote sale a los WRITE_BUFFER_DELAY_MS o al llegar a
+      WRITE_BUFFER_MAX_FEATURES, lo primero que ocurra.
+    - Como mucho hay un flush en curso por grupo; lo que llega mientras tanto
+      se acumula para el siguiente, que es donde se gana el throughput.
+    """
+
+    def __init__(
+        self,
+        delay_ms: float = WRITE_BUFFER_DELAY_MS,
+        max_features: int = WRITE_BUFFER_MAX_FEATURES,
+    ):
+        self.delay = delay_ms / 1000
+        self.max_features = max_features
+        self._groups: Dict[Tuple[str, int], _Group] = {}
+        # Referencias a los flush en curso (el event loop solo guarda referencias débiles)
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def insert(
+        self, supabase, user_id: str, project_id: int, geometries: List[Dict[str, Any]]
+    ) -> List[Dict[str, Any]]:
+        """
+        Encola las geometrías y espera a su resultado. Devuelve una fila por
+        geometría, en el mismo orden: {code, id} o {code: ERROR_GENERIC, error}.
+        """
+        if not geometries:
+            return []
+
+        loop = asyncio.get_running_loop()
+        key = (str(user_id), project_id)
+        group = self._groups.get(key)
+        if group is None:
+            group = self._groups[key] = _Group(supabase=supabase)
+        else:
+            group.supabase = supabase  # el token más reciente del usuario
+
+        futures = []
+        for geometry in geometries:
+            future = loop.create_future()
+            group.pending.append((geometry, future))
+            futures.append(future)
+
+        self._schedule(key, group)
+        return list(await asyncio.gather(*futures))
+
+    def _schedule(self, key, group: _Group) -> None:
+        if group.flushing:
+            # Al terminar el flush actual se vuelve a programar
+            return
+        if len(group.pending) >= self.max_features:
+            if group.timer is not None:
+                group.timer.cancel()
+                group.timer = None
+            self._start_flush(key, group)
+        elif group.timer is None:
+            loop = asyncio.get_running_loop()
+            group.timer = loop.call_later(self.delay, self._start_flush, key, group)
+
+    def _start_flush(self, key, group: _Group) -> None:
+        task = asyncio.create_task(self._flush(key, group))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self, key, group: _Group) -> None:
+        group.timer = None
+        if group.flushing or not group.pending:
+            return
+
+        group.flushing = True
+        batch = group.pending[: self.max_features]
+        group.pending = group.pending[self.max_features :]
+        try:
+            await self._write(group.supabase, key, batch)
+        finally:
+            group.flushing = False
+            if group.pending:
+                self._schedule(key, group)
+            elif self._groups.get(key) is group:
+                del self._groups[key]
+
+    async def _write(self, supabase, key, batch) -> None:
+        user_id, project_id = key
+        geometries = [geometry for geometry, _ in batch]
+        try:
+            rows = await insert_geometries_batch(supabase, user_id, project_id, geometries)
+            by_idx = {row.get("idx"): row for row in rows}
+            for idx, (_, future) in enumerate(batch):
+                if not future.done():
+                    future.set_result(
+                        by_idx.get(idx)
+                        or {"code": "ERROR_GENERIC", "error": "Sin respuesta del batch"}
+                    )
+        except Exception as e:
+            # Una geometría inválida hace fallar toda la sentencia:
+            # se reintenta una a una para aislar el error
+            print(f"insert_geometries_batch falló ({e}), reintento por feature")
+            for geometry, future in batch:
+                if future.done():
+                    continue
+                try:
+                    response = await supabase.rpc(
+                        "insert_geometry",
+                        {
+                            "geom_json": geometry,
+                            "user_id": str(user_id),
+                            "project_id": project_id,
+                        },
+                    ).execute()
+                    rows = rpc_rows(response.data)
+                    if rows and rows[0].get("code") == "OK_INSERT":
+                        FEATURES_INSERTED.inc()
+                    future.set_result(rows[0] if rows else {"code": "ERROR_GENERIC", "error": "Sin respuesta"})
+                except Exception as feat_error:
+                    future.set_result({"code": "ERROR_GENERIC", "error": str(feat_error)})
+
+
+write_buffer = WriteBuffer()
@@ -3,48 +3,166 @@ Server:
 Este archivo ejecuta un entorno con FastAPI similar a la plataforma LPS360
 '''
 
-from fastapi import FastAPI, HTTPException
+import asyncio
+import hmac
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from supabase import create_client, Client
 import os
-from dotenv import load_dotenv
-from starlette.responses import FileResponse
+from starlette.responses import FileResponse, JSONResponse, PlainTextResponse
+# routes carga el .env al importarse, antes de que se lea ninguna configuración
 from routes import login, QGIS
+from routes.utils.compression import CompressionMiddleware
+from routes.utils.geojson import OPENAPI_SCHEMAS
 from routes.utils.limiter import limiter
+from routes.utils.jobs import job_manager
+from routes.utils.jwt_verifier import token_verifier
+from routes.utils.http_pool import connection_stats
+from routes.utils.metrics import MetricsMiddleware, registry
+from routes.utils.profiling import (
+    PROFILE_SAMPLE_RATE,
+    PROFILING_ENABLED,
+    ProfilingMiddleware,
+    slowest_profiles,
+)
+from routes.utils.tracing import TracingMiddleware
+from routes.utils.supabase_manager import close_clients, user_client_stats, user_clients
+from routes.utils.warmup import WARMUP_TIMEOUT_SECONDS, warm_up
 from slowapi import _rate_limit_exceeded_handler
 from slowapi.errors import RateLimitExceeded
 
-load_dotenv()
 is_development = os.getenv("ENVIRONMENT", "production").lower() == "development"
+# /metrics y /debug/profiles exigen "Authorization: Bearer <METRICS_TOKEN>". Sin
+# METRICS_TOKEN solo se registran en desarrollo: en producción no quedan abiertas
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+
+def _require_metrics_token(request: Request) -> None:
+    if not METRICS_TOKEN:
+        return  # solo en desarrollo (ver create_app)
+    authorization = request.headers.get("authorization", "")
+    if not hmac.compare_digest(authorization.encode(), f"Bearer {METRICS_TOKEN}".encode()):
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+
+async def _warm_up(app: FastAPI) -> None:
+    try:
+        app.state.warmup = await asyncio.wait_for(warm_up(), WARMUP_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        print(f"Calentamiento: superó {WARMUP_TIMEOUT_SECONDS}s, se continúa en frío")
+        app.state.warmup = {"timeout": True}
+    app.state.ready = True
+    print(f"Servidor listo: {app.state.warmup}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Los clientes y pools (pool HTTP, clientes de Supabase, cachés) son únicos por
+    # proceso: el pool HTTP se crea en su primer uso (el calentamiento) y se cierra
+    # aquí al apagar, no al importar routes. El calentamiento corre en segundo
+    # plano: uvicorn acepta conexiones enseguida y /health responde 503 hasta
+    # que termina, así Railway no envía tráfico a un proceso frío
+    app.state.ready = False
+    app.state.warmup = None
+    warmup_task = asyncio.create_task(_warm_up(app))
+    yield
+    warmup_task.cancel()
+    await asyncio.gather(warmup_task, return_exceptions=True)
+    await job_manager.shutdown()
+    await token_verifier.stop()
+    await close_clients()
+
+
+def create_app() -> FastAPI:
+    app = FastAPI(
+        lifespan=lifespan,
+        docs_url="/docs" if is_development else None,
+        redoc_url="/redoc" if is_development else None
+        )
 
-app = FastAPI(
-    docs_url="/docs" if is_development else None,
-    redoc_url="/redoc" if is_development else None
+    allowed_origins = ["http://localhost:5173"]
+
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=allowed_origins,
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
     )
+    # Respuestas comprimidas con zstd o gzip según Accept-Encoding
+    app.add_middleware(CompressionMiddleware)
+    # Por fuera de CORS: miden la petición completa (perfil, Server-Timing y /metrics)
+    app.add_middleware(ProfilingMiddleware)
+    app.add_middleware(TracingMiddleware)
+    app.add_middleware(MetricsMiddleware)
 
-supabase: Client = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_ANON_KEY"))
+    app.include_router(login.router)
+    app.include_router(QGIS.router)
 
-allowed_origins = ["http://localhost:5173"]
+    # Los cuerpos validados con TypeAdapter (upload_geometries, chunks) declaran
+    # sus esquemas en openapi_extra; aquí se añaden a components/schemas
+    default_openapi = app.openapi
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=allowed_origins,
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+    def openapi():
+        if app.openapi_schema is None:
+            schema = default_openapi()
+            schema.setdefault("components", {}).setdefault("schemas", {}).update(OPENAPI_SCHEMAS)
+        return app.openapi_schema
+
+    app.openapi = openapi
+
+    app.state.limiter = limiter
+    app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+
+    @app.get("/health")
+    async def health_check():
+        """Health check endpoint for Railway (503 mientras calienta)"""
+        if not app.state.ready:
+            return JSONResponse(status_code=503, content={"status": "starting"})
+        return {
+            "status": "healthy",
+            "warmup": app.state.warmup,
+            # Reutilización de conexiones y de clientes autenticados de Supabase
+            "supabase_pool": {
+                **connection_stats.snapshot(),
+                "cached_clients": len(user_clients),
+                "client_cache": dict(user_client_stats),
+            },
+        }
+
+    if not METRICS_TOKEN and not is_development:
+        print("Sin METRICS_TOKEN: /metrics y /debug/profiles no se registran")
+        return app
+
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics(request: Request):
+        """Métricas del proceso en formato de texto de Prometheus"""
+        _require_metrics_token(request)
+        return PlainTextResponse(
+            registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+        )
+
+    if PROFILING_ENABLED or PROFILE_SAMPLE_RATE:
+        @app.get("/debug/profiles", include_in_schema=False)
+        async def list_profiles(request: Request):
+            """Perfiles muestreados de las peticiones más lentas (PROFILE_SAMPLE_RATE)"""
+            _require_metrics_token(request)
+            return {"profiles": slowest_profiles.summary()}
+
+        @app.get("/debug/profiles/{profile_id}.collapsed", include_in_schema=False)
+        async def get_profile(profile_id: int, request: Request):
+            """Pilas del perfil en formato collapsed (flamegraph.pl, speedscope)"""
+            _require_metrics_token(request)
+            profile = slowest_profiles.get(profile_id)
+            if profile is None:
+                raise HTTPException(status_code=404, detail="Perfil no encontrado")
+            return PlainTextResponse(profile["collapsed"])
 
-app.include_router(login.router)
-app.include_router(QGIS.router)
+    return app
 
-app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
-@app.get("/health")
-async def health_check():
-    """Health check endpoint for Railway"""
-    return {"status": "healthy"}
+app = create_app()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,91 @@
+import inspect
+import itertools
+import os
+import tempfile
+from types import SimpleNamespace
+
+import pytest
+
+# routes.utils.supabase_manager exige estas variables al importarse; los tests
+# no llaman a Supabase
+os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:54321")
+os.environ.setdefault("SUPABASE_ANON_KEY", "test-anon-key")
+# Ficheros compartidos entre workers (SQLite, snapshots) en un directorio propio
+_TMP = tempfile.mkdtemp(prefix="bridge-tests-")
+for _name, _file in (
+    ("RATE_LIMIT_STORAGE_URI", "sqlite://" + os.path.join(_TMP, "limits.sqlite3")),
+    ("TOKEN_REVOCATION_DB", os.path.join(_TMP, "limits.sqlite3")),
+    ("UPLOAD_SESSION_DB", os.path.join(_TMP, "upload_sessions.sqlite3")),
+    ("JOB_DB", os.path.join(_TMP, "jobs.sqlite3")),
+    ("IDEMPOTENCY_DB", os.path.join(_TMP, "idempotency.sqlite3")),
+    ("SNAPSHOT_DIR", os.path.join(_TMP, "snapshots")),
+    ("TILES_DIR", os.path.join(_TMP, "tiles")),
+):
+    os.environ.setdefault(_name, _file)
+
+
+class FakeSupabase:
+    """
+    Cliente de Supabase mínimo para las rutas: supabase.rpc(nombre, params).execute()
+    responde con handlers[nombre](params) (función o corrutina) y anota
+    (usuario del cliente, nombre, params).
+    """
+
+    def __init__(self, user_id, handlers, calls):
+        self.user_id = user_id
+        self.handlers = handlers
+        self.calls = calls
+
+    def rpc(self, name, params):
+        async def execute():
+            self.calls.append((self.user_id, name, params))
+            handler = self.handlers.get(name)
+            data = handler(params) if handler else []
+            if inspect.isawaitable(data):
+                data = await data
+            return SimpleNamespace(data=data)
+
+        return SimpleNamespace(execute=execute)
+
+
+@pytest.fixture
+def supabase_backend():
+    """
+    Handlers por RPC (sobrescribibles en cada test) y registro de llamadas.
+    """
+    ids = itertools.count(1)
+    handlers = {
+        "get_projects_by_user": lambda params: [{"project_id": 1, "project_name": "p"}],
+        "insert_geometries_batch": lambda params: [
+            {"idx": i, "id": next(ids), "code": "OK_INSERT"} for i in range(len(params["p_items"]))
+        ],
+    }
+    return SimpleNamespace(handlers=handlers, calls=[])
+
+
+@pytest.fixture
+def qgis_app(supabase_backend, monkeypatch):
+    """
+    App con el router QGIS; el usuario autenticado sale de la cabecera X-Test-User
+    y cada usuario tiene su propio cliente (como los clientes con su token).
+    """
+    from fastapi import FastAPI, Request
+
+    from routes import QGIS
+    from routes.utils.memberships import ProjectMemberships
+    from routes.utils.supabase_manager import get_authenticated_supabase_client
+
+    clients = {}
+
+    def authenticated(request: Request):
+        user_id = request.headers.get("x-test-user", "u1")
+        client = clients.setdefault(
+            user_id, FakeSupabase(user_id, supabase_backend.handlers, supabase_backend.calls)
+        )
+        return client, user_id
+
+    app = FastAPI()
+    app.include_router(QGIS.router)
+    app.dependency_overrides[get_authenticated_supabase_client] = authenticated
+    monkeypatch.setattr(QGIS, "project_memberships", ProjectMemberships())
+    return app
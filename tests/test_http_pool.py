@@ -0,0 +1,35 @@
+import asyncio
+import os
+import subprocess
+import sys
+
+from routes.utils import http_pool, supabase_manager
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_importing_the_app_opens_no_pool():
+    # En un proceso aparte: otros tests pueden haber creado ya el pool en este
+    code = (
+        "import server\n"
+        "from routes.utils import http_pool, supabase_manager\n"
+        "assert http_pool._http_client is None\n"
+        "assert supabase_manager._supabase_client is None\n"
+    )
+    subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=os.environ, check=True)
+
+
+def test_clients_are_created_on_first_use_and_closed():
+    async def main():
+        client = supabase_manager.get_supabase_client()
+        pool = http_pool.get_http_client()
+        assert supabase_manager.get_supabase_client() is client
+        assert http_pool.get_http_client() is pool
+        await supabase_manager.close_clients()
+        return pool
+
+    pool = asyncio.run(main())
+    assert pool.is_closed
+    assert http_pool._http_client is None
+    assert supabase_manager._supabase_client is None
+    assert len(supabase_manager.user_clients) == 0
@@ -0,0 +1,150 @@
+import asyncio
+import gzip
+import json
+
+import httpx
+import pytest
+
+from routes.utils.idempotency import IdempotencyStore
+
+
+@pytest.fixture
+def idempotency_db(tmp_path, monkeypatch):
+    from routes import QGIS
+
+    path = str(tmp_path / "idempotency.sqlite3")
+    monkeypatch.setattr(QGIS, "upload_idempotency", IdempotencyStore(path))
+    return path
+
+
+def envelope(*xs):
+    return {
+        "layer_name": "parcelas",
+        "project_id": 1,
+        "features": [
+            {"geometry": {"type": "Point", "coordinates": [x, 40.0]}, "properties": {}}
+            for x in xs
+        ],
+    }
+
+
+def upload(client, payload, key, **headers):
+    body = json.dumps(payload).encode()
+    if headers.get("content-encoding") == "gzip":
+        body = gzip.compress(body)
+    return client.post(
+        "/api/qgis/upload_geometries",
+        content=body,
+        headers={"content-type": "application/json", "idempotency-key": key, **headers},
+    )
+
+
+def inserts(backend):
+    return [params for _, name, params in backend.calls if name == "insert_geometries_batch"]
+
+
+def run_uploads(app, steps):
+    async def main():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return [await step(client) for step in steps]
+
+    return asyncio.run(main())
+
+
+def test_retry_is_replayed_through_the_route(qgis_app, supabase_backend, idempotency_db):
+    first, retry = run_uploads(
+        qgis_app,
+        [lambda c: upload(c, envelope(1, 2), "k1"), lambda c: upload(c, envelope(1, 2), "k1")],
+    )
+    assert first.status_code == retry.status_code == 200
+    assert "idempotent-replayed" not in first.headers
+    assert retry.headers["idempotent-replayed"] == "true"
+    assert retry.json() == first.json()
+    assert len(inserts(supabase_backend)) == 1
+
+
+def test_reordered_and_reencoded_retry_is_the_same_upload(
+    qgis_app, supabase_backend, idempotency_db
+):
+    first, reordered, gzipped = run_uploads(
+        qgis_app,
+        [
+            lambda c: upload(c, envelope(1, 2, 3), "k1"),
+            lambda c: upload(c, envelope(3, 1, 2), "k1"),
+            lambda c: upload(c, envelope(2, 3, 1), "k1", **{"content-encoding": "gzip"}),
+        ],
+    )
+    assert reordered.status_code == gzipped.status_code == 200
+    assert reordered.headers["idempotent-replayed"] == gzipped.headers["idempotent-replayed"] == "true"
+    assert len(inserts(supabase_backend)) == 1
+
+
+def test_key_reused_with_other_content_is_rejected(qgis_app, supabase_backend, idempotency_db):
+    first, other = run_uploads(
+        qgis_app,
+        [lambda c: upload(c, envelope(1), "k1"), lambda c: upload(c, envelope(2), "k1")],
+    )
+    assert first.status_code == 200
+    assert other.status_code == 422
+    assert len(inserts(supabase_backend)) == 1
+
+
+def test_keys_are_shared_between_workers_and_scoped_per_user(
+    qgis_app, supabase_backend, idempotency_db
+):
+    from routes import QGIS
+
+    def other_worker(client):
+        QGIS.upload_idempotency = IdempotencyStore(idempotency_db)
+        return upload(client, envelope(1), "k1")
+
+    first, replayed, other_user = run_uploads(
+        qgis_app,
+        [
+            lambda c: upload(c, envelope(1), "k1"),
+            other_worker,
+            lambda c: upload(c, envelope(1), "k1", **{"x-test-user": "u2"}),
+        ],
+    )
+    assert replayed.headers["idempotent-replayed"] == "true"
+    assert "idempotent-replayed" not in other_user.headers
+    assert [p["p_user_id"] for p in inserts(supabase_backend)] == ["u1", "u2"]
+
+
+def test_concurrent_retry_waits_for_the_first_run(idempotency_db):
+    store = IdempotencyStore(idempotency_db)
+    runs = []
+
+    async def slow():
+        runs.append(1)
+        await asyncio.sleep(0.3)
+        return {"inserted": 1}
+
+    async def main():
+        return await asyncio.gather(
+            store.run("u1", "k1", "f", slow),
+            IdempotencyStore(idempotency_db).run("u1", "k1", "f", slow),
+        )
+
+    (first, first_replayed), (second, second_replayed) = asyncio.run(main())
+    assert first == second == {"inserted": 1}
+    assert sorted([first_replayed, second_replayed]) == [False, True]
+    assert runs == [1]
+
+
+def test_failed_run_releases_the_key(idempotency_db):
+    store = IdempotencyStore(idempotency_db)
+
+    async def failing():
+        raise RuntimeError("caída")
+
+    async def ok():
+        return {"inserted": 2}
+
+    async def main():
+        with pytest.raises(RuntimeError):
+            await store.run("u1", "k1", "f", failing)
+        return await store.run("u1", "k1", "f", ok)
+
+    assert asyncio.run(main()) == ({"inserted": 2}, False)
@@ -0,0 +1,121 @@
+import asyncio
+
+import httpx
+import pytest
+
+from routes.utils.jobs import JobManager, JobStore
+
+
+@pytest.fixture
+def job_db(tmp_path, monkeypatch):
+    from routes import QGIS
+
+    path = str(tmp_path / "jobs.sqlite3")
+    monkeypatch.setattr(QGIS, "job_manager", JobManager(store=JobStore(path)))
+    return path
+
+
+def envelope(n):
+    return {
+        "layer_name": "parcelas",
+        "project_id": 1,
+        "features": [
+            {"geometry": {"type": "Point", "coordinates": [i, 40.0]}, "properties": {}}
+            for i in range(1, n + 1)
+        ],
+    }
+
+
+async def wait_for_job(client, url, user_id="u1"):
+    for _ in range(100):
+        response = await client.get(url, headers={"x-test-user": user_id})
+        if response.status_code != 200 or response.json()["status"] in ("done", "failed"):
+            return response
+        await asyncio.sleep(0.05)
+    raise AssertionError("el trabajo no terminó")
+
+
+def test_background_upload_is_visible_from_any_worker(qgis_app, job_db):
+    from routes import QGIS
+
+    async def main():
+        transport = httpx.ASGITransport(app=qgis_app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            accepted = await client.post(
+                "/api/qgis/upload_geometries?background=true",
+                json=envelope(3),
+                headers={"x-test-user": "u1"},
+            )
+            assert accepted.status_code == 202
+            url = accepted.headers["location"]
+            assert url == accepted.json()["status_url"]
+
+            done = await wait_for_job(client, url)
+            assert done.status_code == 200
+            body = done.json()
+            assert body["status"] == "done"
+            assert body["result"]["inserted"] == 3
+            assert body["progress"]["processed"] == body["progress"]["total"] == 3
+
+            # Otro worker: su JobManager no tiene el trabajo en memoria y lo lee del fichero
+            QGIS.job_manager = JobManager(store=JobStore(job_db))
+            other_worker = await client.get(url, headers={"x-test-user": "u1"})
+            assert other_worker.status_code == 200
+            assert other_worker.json() == body
+
+            other_user = await client.get(url, headers={"x-test-user": "u2"})
+            assert other_user.status_code == 404
+
+    asyncio.run(main())
+
+
+def test_running_job_progress_is_published(qgis_app, job_db, supabase_backend, monkeypatch):
+    from routes.utils import jobs
+
+    monkeypatch.setattr(jobs, "JOB_PROGRESS_INTERVAL_SECONDS", 0.01)
+    release = asyncio.Event()
+    insert = supabase_backend.handlers["insert_geometries_batch"]
+
+    async def blocked(params):
+        # El RPC no vuelve hasta que el test lo deja: el trabajo sigue en curso
+        await release.wait()
+        return insert(params)
+
+    supabase_backend.handlers["insert_geometries_batch"] = blocked
+
+    async def main():
+        transport = httpx.ASGITransport(app=qgis_app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            accepted = await client.post(
+                "/api/qgis/upload_geometries?background=true", json=envelope(2)
+            )
+            job_id = accepted.json()["job_id"]
+            for _ in range(100):
+                job = JobStore(job_db).get(job_id, "u1")
+                if job.status == "running":
+                    break
+                await asyncio.sleep(0.01)
+            assert job.status == "running"
+            assert job.started_at is not None
+            release.set()
+            assert (await wait_for_job(client, accepted.headers["location"])).json()["status"] == "done"
+
+    asyncio.run(main())
+
+
+def test_full_queue_leaves_no_job_record(job_db):
+    manager = JobManager(workers=0, queue_size=1, store=JobStore(job_db))
+
+    async def never(job):
+        return {}
+
+    async def main():
+        first = await manager.submit("u1", "test", never)
+        with pytest.raises(asyncio.QueueFull):
+            await manager.submit("u1", "test", never)
+        return first
+
+    first = asyncio.run(main())
+    assert JobStore(job_db).get(first.job_id, "u1").status == "queued"
+    conn = JobStore(job_db)._conn()
+    assert conn.execute("SELECT count(*) FROM jobs").fetchone() == (1,)
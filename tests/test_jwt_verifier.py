@@ -0,0 +1,84 @@
+import asyncio
+import time
+
+import jwt
+import pytest
+from fastapi import Depends, FastAPI
+from fastapi.testclient import TestClient
+
+from routes.utils import supabase_manager
+from routes.utils.jwt_verifier import RevocationStore, TokenError, TokenVerifier
+from routes.utils.supabase_manager import get_authenticated_supabase_client
+
+SECRET = "test-secret-" + "x" * 32
+
+
+def make_token(secret=SECRET, expires_in=600, **claims):
+    payload = {"sub": "u1", "aud": "authenticated", "exp": int(time.time()) + expires_in}
+    return jwt.encode({**payload, **claims}, secret, "HS256")
+
+
+@pytest.fixture
+def verifier(tmp_path):
+    return TokenVerifier(
+        secret=SECRET,
+        jwks_url=None,
+        leeway=0,
+        revocations=RevocationStore(str(tmp_path / "revoked.sqlite3")),
+    )
+
+
+@pytest.fixture
+def client(verifier, monkeypatch):
+    monkeypatch.setattr(supabase_manager, "token_verifier", verifier)
+    app = FastAPI()
+
+    @app.get("/me")
+    async def me(auth=Depends(get_authenticated_supabase_client)):
+        return {"user_id": auth[1]}
+
+    return TestClient(app)
+
+
+def test_valid_token(verifier):
+    claims = asyncio.run(verifier.verify(make_token()))
+    assert claims["sub"] == "u1"
+
+
+@pytest.mark.parametrize(
+    "token",
+    [
+        make_token(expires_in=-60),
+        make_token(secret="other-secret-" + "y" * 32),
+        make_token(aud="anon"),
+        "not-a-jwt",
+    ],
+    ids=["expired", "bad-signature", "wrong-audience", "malformed"],
+)
+def test_rejected_tokens_return_401(client, verifier, token):
+    with pytest.raises(TokenError):
+        asyncio.run(verifier.verify(token))
+    client.cookies.set("access_token", token)
+    assert client.get("/me").status_code == 401
+
+
+def test_missing_token_returns_401(client):
+    assert client.get("/me").status_code == 401
+
+
+def test_revocation_reaches_other_workers(tmp_path):
+    path = str(tmp_path / "revoked.sqlite3")
+    token = make_token()
+
+    async def main():
+        workers = [
+            TokenVerifier(secret=SECRET, jwks_url=None, revocations=RevocationStore(path))
+            for _ in range(2)
+        ]
+        await workers[1].verify(token)
+        await workers[0].revoke(token, time.time() + 600)
+        await workers[1].sync_revocations()
+        with pytest.raises(TokenError):
+            await workers[1].verify(token)
+
+    asyncio.run(main())
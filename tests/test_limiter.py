@@ -0,0 +1,63 @@
+import multiprocessing
+import sqlite3
+import time
+
+from routes.utils import limiter
+from routes.utils.limiter import SQLiteStorage
+
+INCREMENTS = 200
+
+
+def _hit(uri, key, start):
+    # Proceso hijo: importa limiter de nuevo (spawn) y lee el entorno del padre
+    storage = SQLiteStorage(uri)
+    start.wait()
+    for _ in range(INCREMENTS):
+        storage.incr(key, 60)
+
+
+def test_counts_are_shared_between_processes(tmp_path, monkeypatch):
+    # Con contención real se espera lo necesario: aquí se comprueba el recuento, no el fail open
+    monkeypatch.setenv("RATE_LIMIT_SQLITE_TIMEOUT_MS", "5000")
+    uri = f"sqlite://{tmp_path / 'limits.sqlite3'}"
+    context = multiprocessing.get_context("spawn")
+    start = context.Event()
+    workers = [context.Process(target=_hit, args=(uri, "user:u1", start)) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    start.set()
+    for worker in workers:
+        worker.join(60)
+        assert worker.exitcode == 0
+
+    storage = SQLiteStorage(uri)
+    assert storage.get("user:u1") == 4 * INCREMENTS
+    assert storage.get("user:u2") == 0
+
+
+def test_window_restarts_after_expiry(tmp_path):
+    storage = SQLiteStorage(f"sqlite://{tmp_path / 'limits.sqlite3'}")
+    assert storage.incr("k", 1, amount=5) == 5
+    assert storage.incr("k", 1, amount=2) == 7
+    time.sleep(1.05)
+    assert storage.get("k") == 0
+    assert storage.incr("k", 1, amount=2) == 2
+
+
+def test_locked_file_fails_open(tmp_path, monkeypatch):
+    monkeypatch.setattr(limiter, "RATE_LIMIT_SQLITE_TIMEOUT_MS", 20)
+    path = tmp_path / "limits.sqlite3"
+    storage = SQLiteStorage(f"sqlite://{path}")
+    assert storage.incr("k", 60) == 1
+
+    lock = sqlite3.connect(path, isolation_level=None)
+    lock.execute("BEGIN IMMEDIATE")
+    try:
+        other = SQLiteStorage(f"sqlite://{path}")
+        started = time.perf_counter()
+        assert other.incr("k", 60) == 0
+        assert time.perf_counter() - started < 1
+    finally:
+        lock.execute("ROLLBACK")
+        lock.close()
+    assert storage.incr("k", 60) == 2
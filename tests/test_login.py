@@ -0,0 +1,70 @@
+import httpx
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from routes import login
+from routes.utils import http_pool
+from routes.utils.limiter import limiter
+
+
+@pytest.fixture
+def gotrue(monkeypatch):
+    """
+    GoTrue simulado: responde con la (status, cuerpo, cabeceras) de state["reply"].
+    """
+    state = {}
+
+    def handler(request):
+        status, body, headers = state["reply"]
+        return httpx.Response(status, json=body, headers=headers)
+
+    monkeypatch.setattr(
+        http_pool, "_http_client", httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    )
+    monkeypatch.setattr(limiter, "enabled", False)
+    app = FastAPI()
+    app.include_router(login.router)
+    client = TestClient(app)
+
+    def post(status, body, headers=None):
+        state["reply"] = (status, body, headers or {})
+        return client.post("/api/auth/login", json={"email": "a@b.c", "password": "x"})
+
+    return post
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        {"code": 400, "error_code": "invalid_credentials", "msg": "Invalid login credentials"},
+        {"error": "invalid_grant", "error_description": "Invalid login credentials"},
+    ],
+)
+def test_wrong_password_is_401(gotrue, body):
+    response = gotrue(400, body)
+    assert response.status_code == 401
+    assert response.json()["detail"] == "User or Password are incorrect"
+
+
+def test_gotrue_rate_limit_is_passed_through(gotrue):
+    response = gotrue(429, {"error_code": "over_request_rate_limit"}, {"Retry-After": "17"})
+    assert response.status_code == 429
+    assert response.headers["retry-after"] == "17"
+
+    response = gotrue(429, {"error_code": "over_request_rate_limit"})
+    assert response.status_code == 429
+    assert int(response.headers["retry-after"]) > 0
+
+
+def test_other_rejections_are_not_reported_as_bad_credentials(gotrue):
+    response = gotrue(400, {"error_code": "email_not_confirmed", "msg": "Email not confirmed"})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Email not confirmed"
+
+    response = gotrue(422, {"error_code": "validation_failed", "msg": "Invalid email"})
+    assert response.status_code == 422
+
+    # apikey rechazada: es un fallo de configuración del servidor, no del usuario
+    response = gotrue(401, {"message": "Invalid API key"})
+    assert response.status_code == 500
@@ -0,0 +1,66 @@
+import asyncio
+from types import SimpleNamespace
+
+from routes.utils.memberships import ProjectMemberships
+
+
+class SlowProjects:
+    """
+    get_projects_by_user que devuelve el valor de `projects` al empezar la
+    llamada y tarda hasta que se libera `release`.
+    """
+
+    def __init__(self, projects):
+        self.projects = projects
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    def rpc(self, name, params):
+        async def execute():
+            self.calls += 1
+            snapshot = list(self.projects)
+            await self.release.wait()
+            return SimpleNamespace(
+                data=[{"project_id": p, "project_name": f"p{p}"} for p in snapshot]
+            )
+
+        return SimpleNamespace(execute=execute)
+
+
+def test_invalidate_discards_a_load_in_flight():
+    async def main():
+        memberships = ProjectMemberships()
+        supabase = SlowProjects([1])
+        stale = asyncio.create_task(memberships.projects(supabase, "u1"))
+        await asyncio.sleep(0)
+        # El usuario entra en el proyecto 2 mientras la primera carga sigue en vuelo
+        supabase.projects.append(2)
+        memberships.invalidate("u1")
+        fresh = asyncio.create_task(memberships.projects(supabase, "u1"))
+        await asyncio.sleep(0)
+        supabase.release.set()
+        await asyncio.gather(stale, fresh)
+
+        assert supabase.calls == 2
+        assert [p["project_id"] for p in fresh.result()] == [1, 2]
+        assert await memberships.has_access(supabase, "u1", 2)
+        assert supabase.calls == 2
+        assert memberships._generations == {} and memberships._loading == {}
+
+    asyncio.run(main())
+
+
+def test_concurrent_lookups_share_one_load():
+    async def main():
+        memberships = ProjectMemberships()
+        supabase = SlowProjects([1])
+        lookups = [asyncio.create_task(memberships.projects(supabase, "u1")) for _ in range(5)]
+        await asyncio.sleep(0)
+        supabase.release.set()
+        await asyncio.gather(*lookups)
+        assert supabase.calls == 1
+        # Sin cargas en curso invalidate no guarda generación
+        memberships.invalidate("u1")
+        assert memberships._generations == {}
+
+    asyncio.run(main())
@@ -0,0 +1,92 @@
+import math
+
+import pytest
+
+from routes.utils.mvt import EXTENT, _simplify, encode_tile, tiles_for_bbox
+
+LAYER = "geometries"
+
+
+def circle(cx, cy, radius, vertices=400):
+    angles = [2 * math.pi * i / vertices for i in range(vertices)]
+    ring = [[cx + radius * math.cos(a), cy + radius * math.sin(a)] for a in angles]
+    return {"type": "Polygon", "coordinates": [ring + [ring[0]]]}
+
+
+FEATURES = [
+    (1, circle(-3.70, 40.40, 0.01), {"id": 1, "version": 2}),
+    (
+        2,
+        {"type": "LineString", "coordinates": [[-3.72, 40.39], [-3.69, 40.41]]},
+        {"id": 2, "version": 1},
+    ),
+    (3, {"type": "Point", "coordinates": [-3.705, 40.405]}, {"id": 3, "version": 1}),
+]
+
+
+def tile_for(z):
+    return next(iter(tiles_for_bbox((-3.70, 40.40, -3.70, 40.40), z, buffer=0)))
+
+
+def test_simplify_keeps_endpoints_and_drops_collinear_points():
+    line = [(0.0, 0.0), (1.0, 0.1), (2.0, 0.0), (3.0, 5.0)]
+    assert _simplify(line, 0.5) == [(0.0, 0.0), (2.0, 0.0), (3.0, 5.0)]
+    assert _simplify(line, 0) == line
+
+
+def test_simplification_shrinks_low_zoom_tiles():
+    x, y = tile_for(10)
+    full = encode_tile(LAYER, FEATURES, 10, x, y)
+    simplified = encode_tile(LAYER, FEATURES, 10, x, y, tolerance=EXTENT / 256)
+    assert simplified is not None
+    assert len(simplified) < len(full) / 2
+
+
+@pytest.mark.parametrize("tolerance", [0, EXTENT / 256])
+def test_tile_readable_by_gdal(tmp_path, tolerance):
+    ogr = pytest.importorskip("osgeo.ogr")
+    z = 12
+    x, y = tile_for(z)
+    data = encode_tile(LAYER, FEATURES, z, x, y, tolerance)
+    # El driver MVT georreferencia la tesela a partir de la ruta z/x/y.pbf
+    path = tmp_path / str(z) / str(x) / f"{y}.pbf"
+    path.parent.mkdir(parents=True)
+    path.write_bytes(data)
+
+    dataset = ogr.Open(str(path))
+    assert dataset is not None
+    layer = dataset.GetLayerByName(LAYER)
+    features = {f.GetField("id"): f for f in layer}
+    assert sorted(features) == [1, 2, 3]
+    assert features[1].GetField("version") == 2
+    envelope = features[1].GetGeometryRef().GetEnvelope()  # (minx, maxx, miny, maxy) en EPSG:3857
+    lon = math.degrees(((envelope[0] + envelope[1]) / 2) / 6378137.0)
+    assert lon == pytest.approx(-3.70, abs=1e-3)
+
+
+def test_concurrent_seeds_use_their_own_temporary_files(tmp_path, monkeypatch):
+    import asyncio
+    import os
+
+    from routes.utils import tiles
+
+    rows = [{"id": i, "version": 1, "geometry": g} for i, g, _ in FEATURES]
+
+    async def page(supabase, project_id, user_id, after_id, limit):
+        await asyncio.sleep(0)  # deja avanzar a la otra siembra entre páginas
+        return [r for r in rows if r["id"] > after_id][:limit]
+
+    monkeypatch.setattr(tiles, "get_project_geometries_page", page)
+    store = tiles.TileStore(directory=str(tmp_path), max_zoom=6, page_size=1)
+
+    async def main():
+        return await asyncio.gather(
+            store._build(7, "u1", None, True, set(), set()),
+            store._build(7, "u1", None, True, set(), set()),
+        )
+
+    first, second = asyncio.run(main())
+    assert first == second > 0
+    assert os.listdir(tmp_path) == ["project_7_user_u1.mbtiles"]
+    x, y = tile_for(6)
+    assert store.get_tile(7, "u1", 6, x, y)
@@ -0,0 +1,54 @@
+import os
+import threading
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from routes.utils import profiling
+from routes.utils.profiling import ProfilingMiddleware, StackSampler
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILING_ENABLED", True)
+    monkeypatch.setattr(profiling, "PROFILE_DIR", str(tmp_path))
+    app = FastAPI()
+
+    @app.get("/busy")
+    async def busy():
+        return {"total": sum(i * i for i in range(200_000))}
+
+    app.add_middleware(ProfilingMiddleware)
+    return TestClient(app)
+
+
+@pytest.mark.parametrize("mode, extension", [("store", "prof"), ("pstats", "prof"), ("collapsed", "collapsed")])
+def test_profile_is_written_to_profile_dir(client, tmp_path, mode, extension):
+    response = client.get("/busy", headers={"x-profile": mode})
+    assert response.status_code == 200
+    file_name = response.headers["x-profile-file"]
+    assert file_name.endswith(f".{extension}")
+    assert os.listdir(tmp_path) == [file_name]
+    if mode == "store":
+        assert response.json()["total"] > 0
+    else:
+        assert response.headers["x-profile-status"] == "200"
+        assert response.text
+
+
+def test_sampled_requests_keep_their_stacks(client, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILE_SAMPLE_RATE", 1.0)
+    monkeypatch.setattr(profiling, "PROFILE_SAMPLE_INTERVAL_MS", 1)
+    monkeypatch.setattr(profiling, "slowest_profiles", profiling.SlowestProfiles(keep=5))
+    assert client.get("/busy").status_code == 200
+    [profile] = profiling.slowest_profiles.summary()
+    assert profile["path"] == "/busy"
+    assert profile["status"] == 200
+
+
+def test_sampler_stops_and_joins():
+    sampler = StackSampler(threading.get_ident(), interval=0.001)
+    sampler.start()
+    sampler.stop()
+    assert not sampler.is_alive()
@@ -0,0 +1,112 @@
+import asyncio
+import os
+
+import pytest
+
+from routes.utils import snapshots
+from routes.utils.flatgeobuf import MAGIC
+from routes.utils.snapshots import SnapshotManager
+
+ROWS = [
+    {"id": 1, "version": 1, "geometry": {"type": "Point", "coordinates": [-3.7, 40.4]}},
+    {
+        "id": 2,
+        "version": 3,
+        "geometry": {
+            "type": "Polygon",
+            "coordinates": [[[-3.71, 40.41], [-3.70, 40.41], [-3.70, 40.42], [-3.71, 40.41]]],
+        },
+    },
+    {
+        "id": 3,
+        "version": 1,
+        "geometry": {"type": "LineString", "coordinates": [[-3.69, 40.43], [-3.68, 40.44]]},
+    },
+]
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    calls = []
+
+    async def page(supabase, project_id, user_id, after_id, limit):
+        calls.append(("page", user_id, after_id))
+        return [r for r in ROWS if r["id"] > after_id][:limit]
+
+    async def by_ids(supabase, project_id, user_id, ids):
+        calls.append(("by_ids", user_id, list(ids)))
+        return [r for r in ROWS if r["id"] in ids]
+
+    monkeypatch.setattr(snapshots, "get_project_geometries_page", page)
+    monkeypatch.setattr(snapshots, "get_project_geometries_by_ids", by_ids)
+    manager = SnapshotManager(directory=str(tmp_path), page_size=2)
+    manager.calls = calls
+    return manager
+
+
+def build(manager, full=True, changed=(), deleted=()):
+    return asyncio.run(manager._build(7, "u1", None, full, set(changed), set(deleted)))
+
+
+def test_snapshot_is_per_user(manager):
+    assert build(manager) == 3
+    assert manager.exists(7, "u1")
+    assert not manager.exists(7, "u2")
+    assert {call[1] for call in manager.calls} == {"u1"}
+    with open(manager.path(7, "u1"), "rb") as f:
+        assert f.read(len(MAGIC)) == MAGIC
+
+
+def test_incremental_rebuild_keeps_unchanged_features(manager):
+    build(manager)
+    manager.calls.clear()
+    assert build(manager, full=False, changed={2}, deleted={3}) == 2
+    assert manager.calls == [("by_ids", "u1", [2])]
+
+
+def test_snapshot_readable_by_gdal(manager):
+    ogr = pytest.importorskip("osgeo.ogr")
+    build(manager)
+    build(manager, full=False, changed={2})
+    dataset = ogr.Open(manager.path(7, "u1"))
+    assert dataset is not None
+    layer = dataset.GetLayer(0)
+    assert layer.GetFeatureCount() == 3
+    features = {f.GetField("id"): f for f in layer}
+    assert sorted(features) == [1, 2, 3]
+    assert features[2].GetField("version") == 3
+    assert features[2].GetGeometryRef().GetGeometryName() == "POLYGON"
+
+    layer.SetSpatialFilterRect(-3.705, 40.405, -3.695, 40.415)
+    assert [f.GetField("id") for f in layer] == [2]
+
+
+def test_sidecar_of_another_build_forces_full_rebuild(manager):
+    build(manager)
+    sidecar = manager._sidecar_path(7, "u1")
+    with open(sidecar, "rb") as f:
+        stale = f.read()
+    # Otro worker publica un .fgb nuevo y el .ids aún es el anterior
+    build(manager)
+    with open(sidecar, "wb") as f:
+        f.write(stale)
+    manager.calls.clear()
+    assert build(manager, full=False, changed={2}) == 3
+    assert [call[0] for call in manager.calls] == ["page", "page", "page"]
+
+
+def test_concurrent_builds_use_their_own_temporary_files(manager):
+    async def main():
+        return await asyncio.gather(
+            manager._build(7, "u1", None, True, set(), set()),
+            manager._build(7, "u1", None, True, set(), set()),
+        )
+
+    assert asyncio.run(main()) == [3, 3]
+    assert sorted(os.listdir(manager.directory)) == [
+        "project_7_user_u1.fgb",
+        "project_7_user_u1.ids",
+    ]
+    manager.calls.clear()
+    assert build(manager, full=False, changed={2}) == 3
+    assert manager.calls == [("by_ids", "u1", [2])]
@@ -0,0 +1,94 @@
+import ast
+import math
+import random
+from pathlib import Path
+
+import pytest
+
+from routes.utils.geometry import geometry_hash
+from routes.utils.topojson import to_topology
+
+PLUGIN_MAIN = Path(__file__).resolve().parents[1] / "plugin" / "QGIS_Supabase_Sync" / "main.py"
+
+
+def plugin_decoder():
+    # main.py importa qgis: se carga solo la función del decodificador
+    tree = ast.parse(PLUGIN_MAIN.read_text(encoding="utf-8"))
+    (func,) = [
+        n for n in tree.body if isinstance(n, ast.FunctionDef) and n.name == "topojson_a_features"
+    ]
+    namespace = {"math": math}
+    exec(compile(ast.Module(body=[func], type_ignores=[]), str(PLUGIN_MAIN), "exec"), namespace)
+    return namespace["topojson_a_features"]
+
+
+def parcels(n=6, seed=1):
+    # Rejilla de parcelas contiguas (bordes compartidos) con coordenadas de 9 decimales
+    rnd = random.Random(seed)
+    def jitter(value):
+        return round(value + rnd.uniform(-1e-4, 1e-4), 9)
+
+    corner = {
+        (i, j): [jitter(-3.7 + i * 0.001), jitter(40.4 + j * 0.001)]
+        for i in range(n + 1)
+        for j in range(n + 1)
+    }
+    rows = []
+    for i in range(n):
+        for j in range(n):
+            ring = [corner[i, j], corner[i + 1, j], corner[i + 1, j + 1], corner[i, j + 1]]
+            geometry = {"type": "Polygon", "coordinates": [ring + [ring[0]]]}
+            rows.append({"id": i * n + j + 1, "geometry": geometry, "version": 1})
+    return rows
+
+
+def other_geometries():
+    return [
+        {"id": 100, "geometry": {"type": "Point", "coordinates": [-3.123456789, 40.987654321]}},
+        {
+            "id": 101,
+            "geometry": {
+                "type": "LineString",
+                "coordinates": [[-3.7, 40.4], [-3.699999999, 40.400000001]],
+            },
+        },
+        {
+            "id": 102,
+            "geometry": {
+                "type": "MultiPolygon",
+                "coordinates": [
+                    [[[-3.8, 40.3], [-3.79, 40.3], [-3.79, 40.31], [-3.8, 40.3]]],
+                    [[[-3.78, 40.3], [-3.77, 40.3], [-3.77, 40.31], [-3.78, 40.3]]],
+                ],
+            },
+        },
+        {"id": 103, "geometry": None},
+    ]
+
+
+def test_round_trip_preserves_geometry_hash_at_precision_9():
+    rows = parcels() + other_geometries()
+    decoded = plugin_decoder()(to_topology(rows, precision=9))
+    assert [f["id"] for f in decoded] == [r["id"] for r in rows]
+    for row, feature in zip(rows, decoded):
+        if row["geometry"] is None:
+            assert feature["geometry"] is None
+        else:
+            assert geometry_hash(feature["geometry"]) == geometry_hash(row["geometry"])
+    assert decoded[0]["version"] == 1
+
+
+def test_shared_edges_are_encoded_once():
+    topology = to_topology(parcels(n=2), precision=9)
+    # 2x2 parcelas: 12 aristas de la rejilla, fusionadas en arcos entre nodos
+    assert len(topology["arcs"]) < 4 * 4
+
+
+@pytest.mark.parametrize("precision", [6, 7])
+def test_default_display_precision_changes_hashes(precision):
+    # Por eso la carga para editar no usa menos de 9 decimales
+    rows = parcels(n=2)
+    decoded = plugin_decoder()(to_topology(rows, precision=precision))
+    assert any(
+        geometry_hash(f["geometry"]) != geometry_hash(r["geometry"]) for r, f in zip(rows, decoded)
+    )
@@ -0,0 +1,86 @@
+import asyncio
+
+import httpx
+import pytest
+
+
+def envelope(*features, project_id=1):
+    return {
+        "layer_name": "parcelas",
+        "project_id": project_id,
+        "features": [{"geometry": g, "properties": {}} for g in features],
+    }
+
+
+def point(x):
+    return {"type": "Point", "coordinates": [x, 40.0]}
+
+
+async def upload_concurrently(app, uploads):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        responses = await asyncio.gather(
+            *(
+                client.post(
+                    "/api/qgis/upload_geometries",
+                    json=envelope(*geometries),
+                    headers={"x-test-user": user_id},
+                )
+                for user_id, geometries in uploads
+            )
+        )
+    return [r.json() for r in responses]
+
+
+def batch_calls(backend):
+    return [(client, params) for client, name, params in backend.calls if name == "insert_geometries_batch"]
+
+
+def test_users_never_share_a_batch(qgis_app, supabase_backend):
+    results = asyncio.run(
+        upload_concurrently(
+            qgis_app,
+            [("u1", [point(1), point(2)]), ("u2", [point(3)]), ("u1", [point(4)])],
+        )
+    )
+    assert [r["inserted"] for r in results] == [2, 1, 1]
+
+    calls = batch_calls(supabase_backend)
+    # Cada lote sale con el cliente autenticado y el p_user_id de quien lo envió
+    assert all(client == params["p_user_id"] for client, params in calls)
+    assert all("created_by" not in item for _, params in calls for item in params["p_items"])
+    by_user = {}
+    for client, params in calls:
+        by_user.setdefault(client, []).extend(i["geometry"]["coordinates"][0] for i in params["p_items"])
+    assert sorted(by_user["u1"]) == [1, 2, 4]
+    assert by_user["u2"] == [3]
+
+
+def test_concurrent_uploads_of_one_user_share_a_batch(qgis_app, supabase_backend):
+    results = asyncio.run(
+        upload_concurrently(qgis_app, [("u1", [point(i)]) for i in range(5)])
+    )
+    assert [r["inserted"] for r in results] == [1] * 5
+    assert len(batch_calls(supabase_backend)) == 1
+
+
+def test_failed_batch_retries_per_feature_with_the_same_user(qgis_app, supabase_backend):
+    def failing(params):
+        raise RuntimeError("geometría inválida en el lote")
+
+    supabase_backend.handlers["insert_geometries_batch"] = failing
+    supabase_backend.handlers["insert_geometry"] = lambda params: [{"id": 9, "code": "OK_INSERT"}]
+    results = asyncio.run(
+        upload_concurrently(qgis_app, [("u1", [point(1)]), ("u2", [point(2)])])
+    )
+    assert [r["inserted"] for r in results] == [1, 1]
+    retries = [(c, p["user_id"]) for c, name, p in supabase_backend.calls if name == "insert_geometry"]
+    assert sorted(retries) == [("u1", "u1"), ("u2", "u2")]
+
+
+@pytest.fixture(autouse=True)
+def _fresh_buffer(monkeypatch):
+    from routes import QGIS
+    from routes.utils.write_buffer import WriteBuffer
+
+    monkeypatch.setattr(QGIS, "write_buffer", WriteBuffer(delay_ms=20))